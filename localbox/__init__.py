@@ -2,10 +2,11 @@
 LocalBox main initialization class.
 """
 from logging import getLogger
-from os import remove
+from os.path import abspath
 from os.path import join
 from shutil import rmtree
-from ssl import wrap_socket
+from socket import error as socket_error
+from ssl import SSLError
 from sys import argv
 
 from localbox import defaults
@@ -16,12 +17,33 @@ config = ConfigSingleton('localbox')
 import localbox.utils as lb_utils
 from localbox.auth import authorize
 from localbox.files import create_user_home
+from localbox.files import sync_caches
+from localbox.server import create_server
+from localbox.server import DEFAULT_KEEPALIVE_REQUESTS
+from localbox.server import DEFAULT_KEEPALIVE_TIMEOUT
+from localbox.server import PooledHTTPServer
+from localbox.server import serve
+from localbox.server import shutdown_requested
+from localbox.transfer import BodyReader
+from localbox.transfer import encode_body
+from localbox.transfer import encode_chunk
+from localbox.transfer import FileBody
+from localbox.transfer import is_body_stream
+from localbox.tls import create_ssl_context
 from localbox.utils import get_bindpoint, get_ssl_cert
 
+try:
+    from urlparse import urlsplit  # pylint: disable=F0401
+except ImportError:
+    from urllib.parse import urlsplit  # pylint: disable=E0611,F0401
+
 try:
     from cStringIO import StringIO
 except ImportError:
-    from io import StringIO
+    from io import BytesIO as StringIO
+
+#: largest unread request body which is skipped to keep the connection open
+MAX_SKIPPED_BODY = 1024 * 1024
 
 try:
     HALTER = raw_input  # pylint: disable=E0602
@@ -37,10 +59,13 @@ except ImportError:
     from http.server import BaseHTTPRequestHandler  # pylint: disable=F0401
     from http.server import HTTPServer  # pylint: disable=F0401
 
-from localbox.api import ROUTING_LIST
+from localbox.api import ROUTER
 from .cache import TimedCache
 from .files import SymlinkCache
+from .trash import reap_trash
+from .dedup import start_deduplication
 from .database import database_execute
+from .database import get_connection_pool
 
 
 class LocalBoxHTTPRequestHandler(BaseHTTPRequestHandler, object):
@@ -48,55 +73,149 @@ class LocalBoxHTTPRequestHandler(BaseHTTPRequestHandler, object):
     class extending the BaseHTTPRequestHandler and handling the HTTP requests
     in do_POST and do_GET (which in their turn forward said requests to
     do_request)
+
+    Connections are kept open for further requests (HTTP/1.1 keep-alive)
+    when the server handles connections in a thread pool, for at most
+    'keepalive_requests' requests and 'keepalive_timeout' idle seconds (httpd
+    section). One instance handles all requests of a connection.
     """
+    protocol_version = 'HTTP/1.1'
 
     def __init__(self, request, client_address, server):
+        self.reset()
+        self.requests_handled = 0
+        self.keep_alive = isinstance(server, PooledHTTPServer)
+        self.max_requests = int(config.get('httpd', 'keepalive_requests', default=DEFAULT_KEEPALIVE_REQUESTS))
+        if self.keep_alive:
+            self.timeout = int(config.get('httpd', 'keepalive_timeout', default=DEFAULT_KEEPALIVE_TIMEOUT))
+        self.protocol = "https://" if config.getboolean('httpd', 'insecure-http', True) else "http://"
+        self.back_url = config.get('oauth', 'direct_back_url', default=defaults.DIRECT_BACK_URL)
+        BaseHTTPRequestHandler.__init__(self, request, client_address, server)
+
+    def handle(self):
+        """
+        Handle the requests of the connection, after completing the TLS
+        handshake when the connection is encrypted.
+        """
+        if hasattr(self.connection, 'do_handshake'):
+            try:
+                self.connection.do_handshake()
+            except (SSLError, socket_error) as error:
+                getLogger(__name__).debug("TLS handshake failed: %s" % error,
+                                          extra={'user': None, 'ip': self.client_address[0], 'path': None})
+                return
+        BaseHTTPRequestHandler.handle(self)
+
+    def reset(self):
+        """
+        Clear the state of the previous request on the connection.
+        """
         self.user = None
         self.new_headers = {}
+        self.route_params = {}
         self.body = None
         self.old_body = None
         self.status = 500
-        self.protocol = ""
-        self.protocol = "https://" if config.getboolean('httpd', 'insecure-http', True) else "http://"
-        self.back_url = config.get('oauth', 'direct_back_url', default=defaults.DIRECT_BACK_URL)
-        BaseHTTPRequestHandler.__init__(self, request, client_address, server)
 
     def send_response(self):
         """
         Returns an answer to an HTTPRequest in the proper order of status,
         new_headers, body. Other functions can set these values and this
-        function will send it over the line properly.
+        function will send it over the line properly. A FileBody is streamed
+        from disk instead of being written at once; a body which is an
+        iterator is sent with chunked transfer coding as it is produced.
 
         :return:
         """
         super(LocalBoxHTTPRequestHandler, self).send_response(self.status)
         for header in self.new_headers:
             self.send_header(header, self.new_headers[header])
+        chunked = False
+        if isinstance(self.body, FileBody):
+            self.send_header('Content-Length', self.body.length)
+        elif is_body_stream(self.body):
+            if self.request_version == 'HTTP/1.0':
+                # the end of the body is marked by closing the connection
+                self.close_connection = True
+            else:
+                chunked = True
+                self.send_header('Transfer-Encoding', 'chunked')
+        elif self.status == 304:
+            # no body; a Content-Length would be that of the full response
+            self.body = b''
+        else:
+            self.body = encode_body(self.body)
+            self.send_header('Content-Length', len(self.body))
+        if self.close_connection:
+            self.send_header('Connection', 'close')
+        elif self.request_version == 'HTTP/1.0':
+            self.send_header('Connection', 'keep-alive')
         self.end_headers()
-        if self.body is not None:
+        if isinstance(self.body, FileBody):
+            self.body.write_to(self.wfile, self.connection)
+        elif is_body_stream(self.body):
+            for piece in self.body:
+                data = encode_body(piece)
+                if data:
+                    self.wfile.write(encode_chunk(data) if chunked else data)
+            if chunked:
+                self.wfile.write(encode_chunk(b''))
+        else:
             self.wfile.write(self.body)
 
+    def start_request(self):
+        """
+        Prepare for handling a request: clear the state of the previous one,
+        decide whether the connection can stay open afterwards and make rfile
+        give exactly the body of this request.
+        """
+        self.reset()
+        self.requests_handled += 1
+        try:
+            length = int(self.headers.get('content-length') or 0)
+        except ValueError:
+            length = 0
+            self.close_connection = True
+        if not self.keep_alive or self.requests_handled >= self.max_requests or shutdown_requested() or \
+                'chunked' in (self.headers.get('transfer-encoding') or '').lower():
+            self.close_connection = True
+        self.connection_rfile = self.rfile
+        self.rfile = BodyReader(self.rfile, length)
+
+    def finish_request(self):
+        """
+        Skip the part of the request body the handler did not read, so the
+        next request on the connection can be read; when that part is large,
+        close the connection instead.
+        """
+        body = self.rfile
+        self.rfile = self.connection_rfile
+        try:
+            if not self.close_connection and not body.skip(MAX_SKIPPED_BODY):
+                self.close_connection = True
+        except (IOError, OSError):
+            self.close_connection = True
+
     def get_log_dict(self):
         """
         returns a dictionary of 'extra' information from the request for the
         logger. Extra information consists of 'user', 'ip' and 'path', or None
         where this information does not make sense.
         """
-        try:
-            ip = self.headers['x-forwarded-for']
-        except KeyError:
-            ip = self.client_address[0]
+        ip = self.headers.get('x-forwarded-for') or self.client_address[0]
         extra = {'user': self.user, 'ip': ip, 'path': self.path}
         return extra
 
     def wrap_request(func):
         def handle(request):
+            request.start_request()
             try:
                 getLogger(__name__).info("%s: %s" % (func.__name__, request.path), extra=request.get_log_dict())
                 func(request)
             except Exception as ex:
                 getLogger(__name__).exception('failed %s: %s' % (func.__name__, ex), extra=request.get_log_dict())
             finally:
+                request.finish_request()
                 request.send_response()
 
         return handle
@@ -117,33 +236,12 @@ class LocalBoxHTTPRequestHandler(BaseHTTPRequestHandler, object):
         """
         self.do_request()
 
-    @authorize
     def do_request(self):
         """
-        Handle a request (do_POST and do_GET both forward to this function).
-        Handling of a requests is done in three phases. First, the
-        authorization is checked. When this is in order, the ROUTING_LIST is
-        consulted to find the function to do the actual work. After this
-        function has executed, the request is responded using send_response.
+        Handle a request (do_POST and do_GET both forward to this function) by
+        passing it to handle_request.
         """
-        log = getLogger('api')
-        # Log headers
-        map(lambda k: log.debug('Header: %s: %s' % (k, self.headers[k]), extra=self.get_log_dict()), self.headers)
-
-        match_found = False
-        for regex, function in ROUTING_LIST:
-            if regex.match(self.path):
-                log.info("Running " + function.__name__ + " on " + self.path +
-                         " for " + self.user, extra=self.get_log_dict())
-
-                match_found = True
-
-                create_user_home(self.user)
-                self.read_request_body()
-                function(self)
-                break
-        if not match_found:
-            log.debug("Could not match the path: " + self.path, extra=self.get_log_dict())
+        handle_request(self)
 
     def read_request_body(self):
         """
@@ -162,16 +260,74 @@ class LocalBoxHTTPRequestHandler(BaseHTTPRequestHandler, object):
             file_str.write(self.rfile.read(read_size))
             length -= read_size
         self.old_body = file_str.getvalue()
+        if not isinstance(self.old_body, str):
+            # python 3: the handlers expect text, as on python 2
+            self.old_body = self.old_body.decode('UTF-8', 'replace')
         if self.body is None:
             self.body = ""
 
 
+@authorize
+def handle_request(request_handler):
+    """
+    Handle a request for any of the HTTP front ends. Handling of a requests is
+    done in three phases. First, the authorization is checked. When this is in
+    order, the ROUTER is consulted to find the function to do the actual
+    work (or to respond with a 404 or 405). After this function has executed, the front end responds to the
+    request (see LocalBoxHTTPRequestHandler.send_response).
+
+    :param request_handler: object holding the request; either a
+                            LocalBoxHTTPRequestHandler or an object with the
+                            same attributes
+    """
+    log = getLogger('api')
+    sync_caches()
+    # Log headers
+    for k in request_handler.headers:
+        log.debug('Header: %s: %s' % (k, request_handler.headers[k]), extra=request_handler.get_log_dict())
+
+    function, request_handler.route_params, allowed = ROUTER.resolve(request_handler.command,
+                                                                     urlsplit(request_handler.path).path)
+    if function is None:
+        log.debug("Could not match the path: " + request_handler.path, extra=request_handler.get_log_dict())
+        if allowed:
+            request_handler.status = 405
+            request_handler.new_headers['Allow'] = ', '.join(allowed)
+        else:
+            request_handler.status = 404
+        return
+    log.info("Running " + function.__name__ + " on " + request_handler.path +
+             " for " + request_handler.user, extra=request_handler.get_log_dict())
+    create_user_home(request_handler.user)
+    if getattr(function, 'streams_body', False):
+        if request_handler.body is None:
+            request_handler.body = ""
+    else:
+        request_handler.read_request_body()
+    function(request_handler)
+
+
+def start_background():
+    """
+    Start the background threads of the server: the removal of the trash
+    left by an earlier run and, when configured, the verification of the
+    symlink index and the removal of unused blobs.
+    """
+    reap_trash()
+    start_deduplication()
+    SymlinkCache().verify_in_background()
+
+
 def main():
     """
     run the actual LocalBox Server. Initialises the symlink cache, starts a
-    HTTPServer and serves requests forever, unless '--test-single-call' has
-    been specified as command line argument
+    HTTPServer and serves requests until a shutdown is requested, unless
+    '--test-single-call' has been specified as command line argument. The
+    concurrency of the server is configured with the 'workers' and 'threads'
+    options in the httpd section.
     """
+    # apply pending database migrations before any worker process is forked
+    get_connection_pool()
     symlinkcache = SymlinkCache()
     try:
         position = argv.index("--clear-user")
@@ -182,18 +338,18 @@ def main():
             "Deleting info for user " + user, extra={'ip': 'cli', 'user': user})
         for sqlstring in 'delete from users where name = ?', 'delete from keys where user = ?', 'delete from invitations where sender = ?', 'delete from invitations where receiver = ?', 'delete from shares where user = ?':
             database_execute(sqlstring, (user,))
-        for symlinkdest in symlinkcache:
-            if symlinkdest.startswith(user_folder):
-                symlinks = symlinkcache.get(symlinkdest)
-                for symlink in symlinks:
-                    remove(symlink)
+        # deletes the links to the shares of the user as well
+        symlinkcache.remove(abspath(user_folder))
         rmtree(user_folder)
         return
     except (ValueError, IndexError):
         port = int(config.get('httpd', 'port', 443))
         insecure_mode = config.getboolean('httpd', 'insecure-http', default=False)
         server_address = ('', port)
-        httpd = HTTPServer(server_address, LocalBoxHTTPRequestHandler)
+        if "--test-single-call" in argv:
+            httpd = HTTPServer(server_address, LocalBoxHTTPRequestHandler)
+        else:
+            httpd = create_server(server_address, LocalBoxHTTPRequestHandler)
         if insecure_mode:
             getLogger(__name__).warn('Running Insecure HTTP')
             getLogger(__name__).warn('Therefore, SSL has not been enabled.')
@@ -202,11 +358,19 @@ def main():
                 HALTER("Press a key to continue.")
         else:
             certfile, keyfile = get_ssl_cert()
-            httpd.socket = wrap_socket(httpd.socket, server_side=True, certfile=certfile, keyfile=keyfile)
+            ssl_context = create_ssl_context(certfile, keyfile)
+            if hasattr(httpd, 'ssl_context'):
+                # the asyncio front end does the handshakes in its event loop
+                httpd.ssl_context = ssl_context
+            else:
+                # handshakes are done by the handler (in a worker thread), not
+                # in the accept loop
+                httpd.socket = ssl_context.wrap_socket(httpd.socket, server_side=True,
+                                                       do_handshake_on_connect=False)
 
         getLogger().info("Server ready", extra={'user': None, 'ip': None, 'path': None})
 
         if "--test-single-call" in argv:
             httpd.handle_request()
         else:
-            httpd.serve_forever()
+            serve(httpd, start_background)
@@ -3,12 +3,17 @@ Start the LocalBox server
 """
 import logging
 from logging import getLogger
+import signal as signals
 from signal import SIGINT, signal
 from sys import exit as sysexit, stdout
 
 import localbox.utils
 from loxcommon.log import prepare_logging
 from .__init__ import main
+from .server import shutdown
+from .server import signal_children
+from .tls import log_session_stats
+from .tls import reload_certificates
 from loxcommon.config import ConfigSingleton
 from loxcommon import os_utils
 
@@ -20,8 +25,16 @@ def sig_handler(signum, frame):  # pylint: disable=W0613
     if signum == SIGINT:
         getLogger('api').info('SIGINT received, shutting down',
                               extra={'user': None, 'ip': None, 'path': None})
-        # TODO: Graceful shutdown that lets people finish their things
-        sysexit(1)
+        # Let running requests finish; a second SIGINT (or one received before
+        # the server runs) exits immediately.
+        if not shutdown():
+            sysexit(1)
+    elif signum == getattr(signals, 'SIGHUP', None):
+        getLogger('api').info('SIGHUP received, reloading certificates',
+                              extra={'user': None, 'ip': None, 'path': None})
+        reload_certificates()
+        log_session_stats()
+        signal_children(signum)
     else:
         getLogger('api').info('Verbosely ignoring signal ' + str(signum),
                               extra={'user': None, 'ip': None, 'path': None})
@@ -33,6 +46,8 @@ def run():
     HTTPServer component of LocalBox
     """
     signal(SIGINT, sig_handler)
+    if hasattr(signals, 'SIGHUP'):
+        signal(signals.SIGHUP, sig_handler)
     main()
 
 
@@ -0,0 +1,353 @@
+"""
+asyncio based HTTP(S) front end for LocalBox. Connections are handled by an
+event loop, so one process can keep many idle keep-alive connections open
+cheaply. Parsed requests are passed to the same handle_request (and thus the
+same handlers of ROUTING_LIST) as the BaseHTTPServer front end; handlers do
+blocking filesystem and database work and therefore run in a thread pool.
+
+This front end requires python 3.
+"""
+import asyncio
+import socket
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import formatdate
+from http.client import parse_headers
+from http.server import BaseHTTPRequestHandler
+from io import BytesIO
+from logging import getLogger
+
+from localbox import config
+from localbox import defaults
+from localbox import handle_request
+from localbox import LocalBoxHTTPRequestHandler
+from localbox import MAX_SKIPPED_BODY
+from localbox.server import DEFAULT_DRAIN_TIMEOUT
+from localbox.server import get_worker_config
+from localbox.transfer import BodyReader
+from localbox.transfer import CHUNK_SIZE
+from localbox.transfer import encode_body
+from localbox.transfer import encode_chunk
+from localbox.transfer import FileBody
+from localbox.transfer import is_body_stream
+from localbox.utils import get_logging_empty_extra
+
+#: maximum size of the request line plus headers
+MAX_HEADER_SIZE = 65536
+#: number of seconds an idle keep-alive connection is kept open
+DEFAULT_IDLE_TIMEOUT = 300
+#: HTTP methods the handlers know about
+SUPPORTED_METHODS = ('GET', 'POST')
+
+
+class StreamReaderFile(object):
+    """
+    Blocking file-like access to an asyncio connection for the handlers,
+    which run in the executor. The request body is only read from the
+    connection when a handler reads it, so, as with the BaseHTTPServer front
+    end, nothing is read before the request has been authorized.
+    """
+
+    def __init__(self, reader, loop, timeout):
+        """
+        :param reader: asyncio StreamReader of the connection
+        :param loop: the event loop the reader belongs to
+        :param timeout: number of seconds to wait for data
+        """
+        self.reader = reader
+        self.loop = loop
+        self.timeout = timeout
+        self.failed = False
+
+    def read(self, size):
+        """
+        :param size: maximum number of bytes to read
+        :returns: the data read, empty when the connection has been closed
+        :raises IOError: when reading fails or times out
+        """
+        future = asyncio.run_coroutine_threadsafe(asyncio.wait_for(self.reader.read(size), self.timeout),
+                                                  self.loop)
+        try:
+            return future.result()
+        except Exception as error:  # pylint: disable=W0703
+            self.failed = True
+            raise IOError("cannot read the request body: %r" % error)
+
+
+class AsyncLocalBoxRequest(object):
+    """
+    A request received by the asyncio front end. It offers the attributes of
+    LocalBoxHTTPRequestHandler that the API handlers use (path, command,
+    headers, user, status, body, old_body, new_headers, ...).
+    """
+    get_log_dict = LocalBoxHTTPRequestHandler.get_log_dict
+    read_request_body = LocalBoxHTTPRequestHandler.read_request_body
+
+    def __init__(self, command, path, request_version, headers, client_address):
+        self.command = command
+        self.path = path
+        self.request_version = request_version
+        self.headers = headers
+        self.client_address = client_address
+        self.rfile = None
+        self.user = None
+        self.new_headers = {}
+        self.route_params = {}
+        self.body = None
+        self.old_body = None
+        self.status = 500
+        self.protocol = "https://" if config.getboolean('httpd', 'insecure-http', True) else "http://"
+        self.back_url = config.get('oauth', 'direct_back_url', default=defaults.DIRECT_BACK_URL)
+
+    def process(self):
+        """
+        Handle the request. Blocks, so this runs in the executor.
+        """
+        try:
+            getLogger(__name__).info("%s: %s" % (self.command, self.path), extra=self.get_log_dict())
+            handle_request(self)
+        except Exception as ex:  # pylint: disable=W0703
+            getLogger(__name__).exception('failed %s: %s' % (self.command, ex), extra=self.get_log_dict())
+
+    def wants_keep_alive(self):
+        """
+        :returns: whether the client wants to keep the connection open
+        """
+        connection = (self.headers.get('Connection') or '').lower()
+        if self.request_version == 'HTTP/1.0':
+            return connection == 'keep-alive'
+        return connection != 'close'
+
+    def can_keep_alive(self):
+        """
+        :returns: whether the response can be framed so the connection can be
+                  used for another request; a streamed body sent to a
+                  HTTP/1.0 client is ended by closing the connection
+        """
+        return not (is_body_stream(self.body) and self.request_version == 'HTTP/1.0')
+
+    def render_head(self, keep_alive):
+        """
+        :param keep_alive: whether the connection stays open after this
+                           response
+        :returns: the status line and headers of the response as bytes
+        """
+        reason = BaseHTTPRequestHandler.responses.get(self.status, ('',))[0]
+        lines = ['HTTP/1.1 %d %s' % (self.status, reason),
+                 'Server: LocalBox',
+                 'Date: %s' % formatdate(usegmt=True)]
+        for header in self.new_headers:
+            lines.append('%s: %s' % (header, self.new_headers[header]))
+        if isinstance(self.body, FileBody):
+            lines.append('Content-Length: %d' % self.body.length)
+        elif is_body_stream(self.body):
+            if self.request_version != 'HTTP/1.0':
+                lines.append('Transfer-Encoding: chunked')
+        elif self.status == 304:
+            # no body; a Content-Length would be that of the full response
+            self.body = b''
+        else:
+            self.body = encode_body(self.body)
+            lines.append('Content-Length: %d' % len(self.body))
+        lines.append('Connection: %s' % ('keep-alive' if keep_alive else 'close'))
+        return ('\r\n'.join(lines) + '\r\n\r\n').encode('iso-8859-1')
+
+
+def parse_request_head(head, client_address):
+    """
+    Parse the request line and headers of a request.
+
+    :param head: request line and headers up to and including the empty line
+    :param client_address: (host, port) of the client
+    :returns: an AsyncLocalBoxRequest, or None if the request is malformed
+    """
+    request_line, _, header_block = head.lstrip(b'\r\n').partition(b'\r\n')
+    words = request_line.decode('iso-8859-1').split()
+    if len(words) != 3 or not words[2].startswith('HTTP/'):
+        return None
+    headers = parse_headers(BytesIO(header_block))
+    return AsyncLocalBoxRequest(words[0], words[1], words[2], headers, client_address)
+
+
+def simple_response(status):
+    """
+    :param status: HTTP status code
+    :returns: a bodyless response which closes the connection
+    """
+    reason = BaseHTTPRequestHandler.responses.get(status, ('',))[0]
+    return ('HTTP/1.1 %d %s\r\nContent-Length: 0\r\nConnection: close\r\n\r\n' % (status, reason)).encode(
+        'iso-8859-1')
+
+
+class AsyncHTTPServer(object):
+    """
+    Server running the asyncio front end. Offers the serve_forever, shutdown
+    and server_close methods of a SocketServer, so it can be run by
+    :py:func:`~localbox.server.serve`, including in forked worker processes.
+    Set ssl_context before serving to enable TLS.
+    """
+
+    def __init__(self, server_address):
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind(server_address)
+        self.socket.listen(128)
+        self.ssl_context = None
+        self.loop = None
+        self.stopping = None
+        self.executor = None
+        self.connections = set()
+        self.idle_connections = set()
+        self.idle_timeout = int(config.get('httpd', 'idle_timeout', default=DEFAULT_IDLE_TIMEOUT))
+
+    def serve_forever(self):
+        """
+        Run the event loop until shutdown() is called and the running
+        requests have finished.
+        """
+        self.loop = asyncio.new_event_loop()
+        try:
+            self.loop.run_until_complete(self.serve())
+        finally:
+            self.loop.close()
+            self.loop = None
+
+    def shutdown(self):
+        """
+        Stop serving. May be called from any thread.
+        """
+        loop = self.loop
+        if loop is not None:
+            loop.call_soon_threadsafe(self.stopping.set)
+
+    def server_close(self):
+        """
+        Close the listening socket.
+        """
+        self.socket.close()
+
+    async def serve(self):
+        """
+        Accept connections until stopped, then close idle connections and
+        wait for the running requests.
+        """
+        self.stopping = asyncio.Event()
+        self.executor = ThreadPoolExecutor(get_worker_config()[1] or 1)
+        server = await asyncio.start_server(self.handle_connection, sock=self.socket, ssl=self.ssl_context,
+                                            limit=MAX_HEADER_SIZE)
+        getLogger(__name__).info("asyncio front end serving", extra=get_logging_empty_extra())
+        await self.stopping.wait()
+        server.close()
+        for task in list(self.idle_connections):
+            task.cancel()
+        if self.connections:
+            getLogger(__name__).info("draining %d connections" % len(self.connections),
+                                     extra=get_logging_empty_extra())
+            await asyncio.wait(list(self.connections),
+                               timeout=int(config.get('httpd', 'drain_timeout', default=DEFAULT_DRAIN_TIMEOUT)))
+        self.executor.shutdown(wait=False)
+
+    async def handle_connection(self, reader, writer):
+        """
+        Handle all requests on one connection.
+
+        :param reader: asyncio StreamReader of the connection
+        :param writer: asyncio StreamWriter of the connection
+        """
+        task = asyncio.current_task()
+        self.connections.add(task)
+        peer = writer.get_extra_info('peername') or ('', 0)
+        client_address = peer[:2]
+        try:
+            keep_alive = True
+            while keep_alive and not self.stopping.is_set():
+                self.idle_connections.add(task)
+                try:
+                    head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), self.idle_timeout)
+                except asyncio.LimitOverrunError:
+                    writer.write(simple_response(431))
+                    break
+                finally:
+                    self.idle_connections.discard(task)
+                request = parse_request_head(head, client_address)
+                if request is None:
+                    writer.write(simple_response(400))
+                    break
+                if request.command not in SUPPORTED_METHODS:
+                    writer.write(simple_response(501))
+                    break
+                keep_alive = request.wants_keep_alive()
+                try:
+                    length = int(request.headers.get('content-length') or 0)
+                except ValueError:
+                    length = 0
+                    keep_alive = False
+                if 'chunked' in (request.headers.get('transfer-encoding') or '').lower():
+                    # chunked request bodies are not supported; close the
+                    # connection so the body is not taken for the next request
+                    keep_alive = False
+                connection_file = StreamReaderFile(reader, self.loop, self.idle_timeout)
+                request.rfile = BodyReader(connection_file, length)
+                await self.loop.run_in_executor(self.executor, request.process)
+                keep_alive = keep_alive and request.can_keep_alive() and not connection_file.failed and \
+                    await self.skip_body(reader, request.rfile)
+                await self.send_response(request, keep_alive, writer)
+        except (asyncio.CancelledError, asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            self.connections.discard(task)
+            writer.close()
+
+    async def skip_body(self, reader, body):
+        """
+        Skip the part of the request body the handler did not read (e.g. of
+        an unauthorized request), so the next request on the connection can
+        be read, unless it is larger than MAX_SKIPPED_BODY.
+
+        :param reader: asyncio StreamReader of the connection
+        :param body: the BodyReader of the request
+        :returns: whether the connection can be used for another request
+        """
+        if body.remaining > MAX_SKIPPED_BODY:
+            return False
+        while body.remaining > 0:
+            data = await asyncio.wait_for(reader.read(min(CHUNK_SIZE, body.remaining)), self.idle_timeout)
+            if not data:
+                return False
+            body.remaining -= len(data)
+        return True
+
+    async def send_response(self, request, keep_alive, writer):
+        """
+        Send the response of a handled request. A FileBody is sent with
+        loop.sendfile, which uses sendfile(2) on plain connections. The pieces
+        of a streamed body are produced in the executor, as they may need
+        blocking work, and sent in chunks.
+
+        :param request: the handled AsyncLocalBoxRequest
+        :param keep_alive: whether the connection stays open afterwards
+        :param writer: asyncio StreamWriter of the connection
+        """
+        writer.write(request.render_head(keep_alive))
+        if isinstance(request.body, FileBody):
+            try:
+                await writer.drain()
+                if request.body.length > 0:
+                    await self.loop.sendfile(writer.transport, request.body.fileobj, request.body.offset,
+                                             request.body.length)
+            finally:
+                request.body.close()
+        elif is_body_stream(request.body):
+            chunked = request.request_version != 'HTTP/1.0'
+            while True:
+                piece = await self.loop.run_in_executor(self.executor, next, request.body, None)
+                if piece is None:
+                    break
+                data = encode_body(piece)
+                if data:
+                    writer.write(encode_chunk(data) if chunked else data)
+                    await writer.drain()
+            if chunked:
+                writer.write(encode_chunk(b''))
+        else:
+            writer.write(request.body)
+        await writer.drain()
@@ -2,24 +2,15 @@
 LocalBox API Implementation module. This module holds the implementation of the
 API call handlers as well as directly related support functions
 """
-from base64 import b64decode
 from json import dumps
 from json import loads
 from logging import getLogger
-from os import makedirs
 from os import remove
-from os import walk
 from os.path import basename
 from os.path import exists
 from os.path import isdir
-from os.path import isfile
 from os.path import islink
 from os.path import join
-from os.path import lexists
-from re import compile as regex_compile
-from shutil import copyfile
-from shutil import move
-from shutil import rmtree
 
 import localbox.utils
 from localbox import defaults
@@ -27,10 +18,14 @@ from localbox.utils import get_bindpoint
 
 try:
     from urllib import unquote_plus  # pylint: disable=F0401,E0611
+    from urlparse import parse_qs  # pylint: disable=F0401,E0611
+    from urlparse import urlsplit  # pylint: disable=F0401,E0611
     from Cookie import SimpleCookie  # pylint: disable=F0401,E0611
 except ImportError:
     from http.cookies import SimpleCookie  # pylint: disable=F0401,E0611
     from urllib.parse import unquote_plus  # pylint: disable=F0401,E0611
+    from urllib.parse import parse_qs  # pylint: disable=F0401,E0611
+    from urllib.parse import urlsplit  # pylint: disable=F0401,E0611
 
 try:
     from os import symlink
@@ -53,18 +48,41 @@ except ImportError:
             if csl(link_name, source, flags) == 0:
                 raise ctypes.WinError()
 
+from localbox.changes import CHANGES_LIMIT
+from localbox.changes import get_changes
+from localbox.changes import get_latest_cursor
+from localbox.changes import get_viewers
+from localbox.changes import record_change
 from localbox.database import get_key_and_iv
 from .database import database_execute
+from localbox.dedup import deduplicate
+from localbox.dedup import deduplication_enabled
 from localbox.files import get_filesystem_path
-from localbox.files import get_key_path
+from localbox.files import get_localbox_path
+from .files import invalidate_metadata
+from .files import list_directory
+from .files import LISTING_ORDERS
 from .files import stat_reader
+from .files import walk_metadata
 from .files import SymlinkCache
+from .operations import MAX_BATCH_OPERATIONS
+from .operations import run_batch
+from .operations import run_operation
+from .router import GET_POST
+from .router import POST
+from .router import Router
 from .shares import Share, ShareItem, Invitation
 from .shares import list_share_items
 from .shares import get_share_by_id
 from .shares import get_database_invitations
 from .encoding import localbox_path_decoder
 from .shares import toggle_invite_state
+from .transfer import body_etag
+from .transfer import check_not_modified
+from .transfer import encode_ndjson
+from .transfer import receive_upload
+from .transfer import send_file
+from .transfer import UploadSession
 from loxcommon.config import ConfigSingleton
 
 
@@ -100,6 +118,74 @@ def prepare_string(string, encoding="UTF-8"):
         return string
 
 
+def streams_body(func):
+    """
+    Decorator marking an API handler which reads the request body itself
+    (from request_handler.rfile) instead of having it read into
+    request_handler.old_body before it is called.
+
+    :param func: the handler function
+    :returns: the same function
+    """
+    func.streams_body = True
+    return func
+
+
+def get_query_parameters(request_handler):
+    """
+    Parses the query string of the requested url.
+
+    :param request_handler: the object with the url in its path
+    :returns: dictionary mapping parameter names to the last value given
+    """
+    return dict((key, values[-1]) for key, values in parse_qs(urlsplit(request_handler.path).query).items())
+
+
+def get_listing_parameters(request_handler):
+    """
+    Reads the paging and sorting parameters of a directory listing from the
+    query string: offset, limit, sort (one of LISTING_ORDERS) and order
+    ('asc' or 'desc').
+
+    :param request_handler: the object with the url in its path
+    :returns: dictionary of keyword arguments for list_directory
+    :raises ValueError: when a parameter has an invalid value
+    """
+    parameters = get_query_parameters(request_handler)
+    listing = {
+        'offset': int(parameters.get('offset', 0)),
+        'limit': int(parameters['limit']) if 'limit' in parameters else None,
+        'order': parameters.get('sort', 'type'),
+        'reverse': parameters.get('order', 'asc') == 'desc',
+    }
+    if listing['offset'] < 0 or (listing['limit'] is not None and listing['limit'] < 0) or \
+            listing['order'] not in LISTING_ORDERS or parameters.get('order', 'asc') not in ('asc', 'desc'):
+        raise ValueError("invalid listing parameters")
+    return listing
+
+
+def get_tree_parameters(request_handler):
+    """
+    Reads the parameters of a recursive metadata listing from the query
+    string: depth (number of levels below each path to include) or
+    recursive=1 (all levels).
+
+    :param request_handler: the object with the url in its path
+    :returns: tuple of whether a recursive listing was asked for, and the
+              depth (None for all levels)
+    :raises ValueError: when a parameter has an invalid value
+    """
+    parameters = get_query_parameters(request_handler)
+    if parameters.get('recursive') in ('1', 'true'):
+        return True, None
+    if 'depth' in parameters:
+        depth = int(parameters['depth'])
+        if depth < 0:
+            raise ValueError("invalid depth")
+        return True, depth
+    return False, 1
+
+
 def get_body_json(request_handler):
     """
     Reads the request handlers bode and parses it as a JSON object.
@@ -118,13 +204,15 @@ def exec_leave_share(request_handler):
 
     :param request_handler: object holding the path of the share to leave
     """
-    pathstart = request_handler.path.replace('/lox_api/shares/', '', 1)
-    path = pathstart.replace('/leave', '', 1)
+    path = request_handler.route_params['path']
 
     bindpoint = get_bindpoint()
     linkpath = join(bindpoint, request_handler.user, path)
     if islink(linkpath):
+        viewers = get_viewers(linkpath)
         remove(linkpath)
+        SymlinkCache().remove(linkpath)
+        record_change('unshare', linkpath, viewers=viewers)
         request_handler.status = 200
     else:
         request_handler.status = 404
@@ -138,18 +226,14 @@ def exec_remove_shares(request_handler):
 
     :param request_handler: the object which contains the path to remove
     """
-    share_start = request_handler.path.replace(
-        '/lox_api/shares/', '', 1)
-    shareid = int(share_start.replace('/revoke', '', 1))
+    shareid = int(request_handler.route_params['share_id'])
     sql = 'remove from shares where id = ?'
     database_execute(sql, (shareid))
     request_handler.status = 200
 
 
 def exec_shares_delete(request_handler):
-    share_start = request_handler.path.replace(
-        '/lox_api/shares/', '', 1)
-    shareid = int(share_start.replace('/delete', '', 1))
+    shareid = int(request_handler.route_params['share_id'])
     sql = 'delete from shares where id = ?'
     database_execute(sql, (shareid,))
     request_handler.status = 200
@@ -164,14 +248,13 @@ def exec_edit_shares(request_handler):
     :param request_handler: the object which contains the share id in its path
                            and list of users json-encoded in its body.
     """
-    share_start = request_handler.path.replace(
-        '/lox_api/shares/', '', 1)
-    shareid = share_start.replace('/edit', '', 1)
+    shareid = request_handler.route_params['share_id']
     share = get_share_by_id(shareid)
     json = get_body_json(request_handler)
     symlinks = SymlinkCache()
     path = share.item.path
     links = symlinks.get(path)
+    viewers = get_viewers(path)
 
     bindpoint = get_bindpoint()
     newlinks = []
@@ -179,10 +262,12 @@ def exec_edit_shares(request_handler):
         to_file = join(bindpoint, entry.title, basename(entry.path))
         newlinks.append(to_file)
         symlink(path, to_file)
+        symlinks.add(path, to_file)
     for link in links:
         if link not in newlinks:
             remove(link)
             symlinks.remove(link)
+    record_change('share', path, viewers=viewers | get_viewers(path))
 
 
 def exec_shares(request_handler):
@@ -192,7 +277,7 @@ def exec_shares(request_handler):
 
     :param request_handler: the object with the path encoded in its path
     """
-    path2 = request_handler.path.replace('/lox_api/shares/', '', 1)
+    path2 = request_handler.route_params['path']
     data = list_share_items(path2)
     request_handler.body = data
     request_handler.status = 200
@@ -202,7 +287,7 @@ def exec_shares(request_handler):
 
 
 def exec_shares_list(request_handler):
-    user = unquote_plus(request_handler.path.replace('/lox_api/shares/user/', '', 1))
+    user = unquote_plus(request_handler.route_params['user'])
     data = list_share_items(user=user)
     request_handler.body = data
     request_handler.status = 200
@@ -249,73 +334,192 @@ def exec_invite_reject(request_handler):
         request_handler.status = 404
 
 
+@streams_body
 def exec_files_path(request_handler):
     """
     Allows for the up- and downloading of (encrypted) files to and from the
-    localbox server. called from the routing list
+    localbox server. Uploads are streamed to disk instead of being read into
+    memory. called from the routing list
 
     :param request_handler: the object which contains the files path in its path
     """
-    path = request_handler.path.replace('/lox_api/files/', '', 1)
+    path = request_handler.route_params['path']
     if path != '':
         path = localbox_path_decoder(path)
     try:
         filepath = get_filesystem_path(path, request_handler.user)
     except ValueError as e:
         request_handler.status = 404
-        request_handler.body = e.message
+        request_handler.body = str(e)
         return
 
     # getLogger(__name__).debug('body %s' % (request_handler.old_body),
     #                          extra=logging_utils.get_logging_extra(request_handler))
 
-    contents = None
-    if request_handler.old_body is not None:
-        try:
-            json_body = loads(request_handler.old_body)
-            path = unquote_plus(json_body['path'])
-            filepath = get_filesystem_path(path, request_handler.user)
-            if json_body.has_key('contents'):
-                contents = b64decode(json_body['contents'])
-        except ValueError:
-            contents = request_handler.old_body
-
-    if request_handler.command == "POST" and contents is not None:
+    stored = False
+    if request_handler.command == "POST":
         request_handler.status = 200
         try:
-            filedescriptor = open(filepath, 'wb')
-            filedescriptor.write(contents)
-        except IOError:
+            filepath, stored, digest, statstruct = receive_upload(
+                request_handler, filepath,
+                lambda json_path: get_filesystem_path(unquote_plus(json_path), request_handler.user),
+                deduplication_enabled())
+        except ValueError as e:
+            request_handler.status = 404
+            request_handler.body = str(e)
+            return
+        except (IOError, OSError):
             getLogger('api').error('Could not write to file %s' % path,
                                    extra=localbox.utils.get_logging_extra(request_handler))
             request_handler.status = 500
+            return
+        if stored:
+            deduplicate(filepath, digest, statstruct)
+            record_change('write', filepath)
+        invalidate_metadata(filepath)
+    else:
+        request_handler.read_request_body()
+        if request_handler.old_body:
+            try:
+                json_body = loads(request_handler.old_body)
+                path = unquote_plus(json_body['path'])
+                filepath = get_filesystem_path(path, request_handler.user)
+            except ValueError:
+                pass
 
-    if request_handler.command == "GET" or (request_handler.command == "POST" and contents is None):
+    if not stored:
         if isdir(filepath):
-            # Not really looping but we need the first set of values
-            for path, directories, files in walk(filepath):
-                if files is None or directories is None:
-                    getLogger(__name__).info("filesystem related problems",
-                                             extra=localbox.utils.get_logging_extra(request_handler))
-                    return
-                # path, directories, files = walk(filepath).next()
-                dirdict = stat_reader(path, request_handler.user)
-                dirdict['children'] = []
-                for child in directories + files:
-                    user = request_handler.user
-                    childpath = join(filepath, child)
-                    dirdict['children'].append(
-                        stat_reader(childpath, user))
-                request_handler.body = dumps(dirdict)
-                break
-        elif exists(filepath):
-            filedescriptor = open(filepath, 'rb')
-            request_handler.body = filedescriptor.read()
+            try:
+                listing = get_listing_parameters(request_handler)
+            except ValueError:
+                request_handler.status = 400
+                request_handler.body = "Error: invalid offset, limit, sort or order"
+                return
+            dirdict = list_directory(filepath, request_handler.user, **listing)
+            if dirdict is None:
+                getLogger(__name__).info("filesystem related problems",
+                                         extra=localbox.utils.get_logging_extra(request_handler))
+                return
             request_handler.status = 200
+            request_handler.body = dumps(dirdict)
+            check_not_modified(request_handler, body_etag(request_handler.body))
+        elif exists(filepath):
+            send_file(request_handler, filepath)
         else:
             request_handler.status = 404
 
 
+def get_upload_session(request_handler):
+    """
+    Returns the upload session identified in the path of the request.
+
+    :param request_handler: object with the upload session id in its path
+    :returns: the UploadSession, or None (and a 404 response) when it does not
+              exist
+    """
+    identifier = request_handler.route_params['session_id']
+    session = UploadSession(request_handler.user, identifier)
+    if not session.exists():
+        request_handler.status = 404
+        request_handler.body = "Error: Unknown upload session"
+        return None
+    return session
+
+
+def exec_upload_create(request_handler):
+    """
+    Starts a resumable upload for the path given in the json-encoded body.
+    Returns the upload session (id, path and offset). Called from the routing
+    list
+
+    :param request_handler: object with the path json-encoded in its body
+    """
+    path = unquote_plus(get_body_json(request_handler)['path'])
+    try:
+        get_filesystem_path(path, request_handler.user)
+    except ValueError as e:
+        request_handler.status = 404
+        request_handler.body = str(e)
+        return
+    session = UploadSession.create(request_handler.user, path)
+    request_handler.status = 200
+    request_handler.body = dumps(session.to_json())
+
+
+@streams_body
+def exec_upload_session(request_handler):
+    """
+    Returns the state of an upload session (GET), or appends the body to it
+    (POST). The position of the appended piece is given by the 'offset' query
+    parameter; when that is not the number of bytes received so far, the
+    response is a 409 with the state of the session, so the client knows
+    where to resume. Called from the routing list
+
+    :param request_handler: object with the session id in its path and the
+                            next piece of the file in its body
+    """
+    session = get_upload_session(request_handler)
+    if session is None:
+        return
+    if request_handler.command == "POST":
+        try:
+            offset = int(get_query_parameters(request_handler)['offset'])
+        except (KeyError, ValueError):
+            request_handler.status = 400
+            request_handler.body = "Error: No valid offset given"
+            return
+        if not session.append(request_handler, offset):
+            request_handler.status = 409
+            request_handler.body = dumps(session.to_json())
+            return
+    request_handler.status = 200
+    request_handler.body = dumps(session.to_json())
+
+
+def exec_upload_commit(request_handler):
+    """
+    Finishes an upload session by moving the uploaded file to its path.
+    Returns the metadata of the file. Called from the routing list
+
+    :param request_handler: object with the session id in its path
+    """
+    session = get_upload_session(request_handler)
+    if session is None:
+        return
+    filepath = get_filesystem_path(session.get_path(), request_handler.user)
+    statstruct = session.commit(filepath)
+    deduplicate(filepath, statstruct=statstruct)
+    invalidate_metadata(filepath)
+    record_change('write', filepath)
+    request_handler.status = 200
+    request_handler.body = dumps(stat_reader(filepath, request_handler.user))
+
+
+def exec_upload_cancel(request_handler):
+    """
+    Abandons an upload session. Called from the routing list
+
+    :param request_handler: object with the session id in its path
+    """
+    session = get_upload_session(request_handler)
+    if session is None:
+        return
+    session.cancel()
+    request_handler.status = 200
+
+
+def set_operation_response(request_handler, status, result):
+    """
+    Set the response to the status and result of an operation.
+
+    :param request_handler: object to set the response on
+    :param status: the status of the operation
+    :param result: the metadata of the affected file, or an error message
+    """
+    request_handler.status = status
+    request_handler.body = dumps(result) if isinstance(result, dict) else result
+
+
 def exec_operations_create_folder(request_handler):
     """
     Creates a new folder in the localbox directory structure. Called from the
@@ -324,21 +528,9 @@ def exec_operations_create_folder(request_handler):
     :param request_handler: the object which has the path url-encoded in its
                            body
     """
-    request_handler.status = 200
     path = unquote_plus(request_handler.old_body).replace("path=/", "", 1)
-    getLogger(__name__).info("creating folder %s" % path, extra=localbox.utils.get_logging_extra(request_handler))
-    bindpoint = get_bindpoint()
-    filepath = join(bindpoint, request_handler.user, path)
-    if lexists(filepath):
-        getLogger(__name__).error("%s already exists" % path, extra=localbox.utils.get_logging_extra(request_handler))
-        request_handler.status = 409  # Http conflict
-        request_handler.body = "Error: Something already exits at path"
-        return
-    makedirs(filepath)
-    getLogger('api').info("created directory " + filepath,
-                          extra=request_handler.get_log_dict())
-    request_handler.body = dumps(
-        stat_reader(filepath, request_handler.user))
+    set_operation_response(request_handler, *run_operation(
+        request_handler.user, {'op': 'create_folder', 'path': path}, request_handler.get_log_dict()))
 
 
 def exec_operations_delete(request_handler):
@@ -346,36 +538,12 @@ def exec_operations_delete(request_handler):
     Removes a file or folder from the localbox directory structure. called from
     the routing list
 
-    :param request_handler: the object which has the file path json-encoded in
+    :param request_handler: the object which has the file path url-encoded in
                            its body
     """
-    request_handler.status = 200
-    user = request_handler.user
-    pathstring = unquote_plus(
-        request_handler.old_body).replace("path=/", "", 1)
-    bindpoint = get_bindpoint()
-    filepath = join(bindpoint, user, pathstring)
-
-    getLogger(__name__).debug('deleting %s' % filepath,
-                              extra=request_handler.get_log_dict())
-
-    if not exists(filepath):
-        request_handler.status = 404
-        request_handler.body = "Error: No file exits at path"
-        getLogger('api').error("failed to delete %s" % filepath,
-                               extra=request_handler.get_log_dict())
-
-        return
-    if isdir(filepath):
-        rmtree(filepath)
-    else:
-        remove(filepath)
-
-    # remove keys
-    sql = 'delete from keys where user = ? and path = ?'
-    database_execute(sql, (user, get_key_path(user, localbox_path=pathstring)))
-
-    SymlinkCache().remove(filepath)
+    path = unquote_plus(request_handler.old_body).replace("path=/", "", 1)
+    set_operation_response(request_handler, *run_operation(
+        request_handler.user, {'op': 'delete', 'path': path}, request_handler.get_log_dict()))
 
 
 def exec_operations_move(request_handler):
@@ -386,21 +554,10 @@ def exec_operations_move(request_handler):
     :param request_handler: the object which has the to_path and from_path
                            json-encoded in its body
     """
-    json_object = loads(request_handler.old_body)
-    bindpoint = get_bindpoint()
-    move_from = join(
-        bindpoint, request_handler.user, json_object['from_path'])
-    move_to = join(
-        bindpoint, request_handler.user, json_object['to_path'])
-    if not isfile(move_from):
-        request_handler.status = 404
-        request_handler.body = "Error: No file exits at from_path"
-        return
-    if lexists(move_to):
-        request_handler.status = 404
-        request_handler.body = "Error: A file already exists at to_path"
-        return
-    move(move_from, move_to)
+    operation = loads(request_handler.old_body)
+    operation['op'] = 'move'
+    set_operation_response(request_handler, *run_operation(
+        request_handler.user, operation, request_handler.get_log_dict()))
 
 
 def exec_operations_copy(request_handler):
@@ -410,23 +567,38 @@ def exec_operations_copy(request_handler):
     :param request_handler: object with to_path and from_path json-encoded in
                            its body
     """
-    json_object = loads(request_handler.old_body)
-    bindpoint = get_bindpoint()
-    copy_from = join(
-        bindpoint, request_handler.user, json_object['from_path'])
-    copy_to = join(
-        bindpoint, request_handler.user, json_object['to_path'])
-    if not exists(copy_from):
-        request_handler.status = 404
-        request_handler.body = "Error: No file exits at from_path"
-        return
-    if lexists(copy_to):
-        request_handler.status = 404
-        request_handler.body = "Error: A file already exists at to_path"
-        return
-    copyfile(copy_from, copy_to)
+    operation = loads(request_handler.old_body)
+    operation['op'] = 'copy'
+    set_operation_response(request_handler, *run_operation(
+        request_handler.user, operation, request_handler.get_log_dict()))
 
+
+def exec_operations_batch(request_handler):
+    """
+    Does a list of operations in order, see run_batch. The
+    json-encoded body holds the 'operations', each an object with the name of
+    the operation in 'op' ('create_folder', 'delete', 'move' or 'copy') and
+    its parameters ('path', or 'from_path' and 'to_path'), and optionally
+    'stop_on_error' to skip the operations after one which failed. Returns
+    the 'results' of the operations done, each with its 'status' and
+    'result'. Called from the routing list
+
+    :param request_handler: object with the operations json-encoded in its
+                           body
+    """
+    try:
+        json_object = loads(request_handler.old_body)
+        operations = json_object['operations']
+        stop_on_error = bool(json_object.get('stop_on_error', False))
+    except (ValueError, KeyError, TypeError, AttributeError):
+        operations = None
+    if not isinstance(operations, list) or len(operations) > MAX_BATCH_OPERATIONS:
+        request_handler.status = 400
+        request_handler.body = "Error: Expected a list of at most %d operations" % MAX_BATCH_OPERATIONS
+        return
+    results = run_batch(request_handler.user, operations, stop_on_error, request_handler.get_log_dict())
     request_handler.status = 200
+    request_handler.body = dumps({'results': [{'status': status, 'result': result} for status, result in results]})
 
 
 def exec_user(request_handler):
@@ -450,9 +622,10 @@ def exec_user(request_handler):
         json_object = loads(request_handler.old_body)
         privkey = json_object['private_key']
         pubkey = json_object['public_key']
-        sql = 'insert into users (public_key, private_key, name) values (?, ?, ?)'
-        result = database_execute(
-            sql, (pubkey, privkey, request_handler.user,))
+        # the first key pair of a user is kept (users are keyed by name)
+        if not database_execute('select 1 from users where name = ?', (request_handler.user,)):
+            sql = 'insert into users (public_key, private_key, name) values (?, ?, ?)'
+            database_execute(sql, (pubkey, privkey, request_handler.user,))
         request_handler.body = dumps(
             {'name': request_handler.user, 'publib_key': pubkey, 'private_key': privkey})
     request_handler.status = 200
@@ -465,7 +638,7 @@ def exec_user_username(request_handler):
 
     :param request_handler: object containing the user for which to return data
     """
-    username = request_handler.path.replace('/lox_api/user/', '', 1)
+    username = request_handler.route_params['username']
     if username == request_handler.user:
         sql = 'select public_key, private_key from users where name = ?;'
     else:
@@ -479,9 +652,9 @@ def exec_user_username(request_handler):
     else:
         request_handler.status = 200
 
-    info = {'name': username, 'public_key': result[0]}
+    info = {'name': username, 'public_key': result[0][0]}
     if username == request_handler.user:
-        info['private_key'] = result[1]
+        info['private_key'] = result[0][1]
     request_handler.body = dumps(info)
 
 
@@ -495,7 +668,7 @@ def exec_create_share(request_handler):
     body = request_handler.old_body
     json_list = loads(body)
     getLogger(__name__).debug('request data: %s' % json_list, extra=request_handler.get_log_dict())
-    path2 = unquote_plus(request_handler.path.replace('/lox_api/share_create/', '', 1))
+    path2 = unquote_plus(request_handler.route_params['path'])
     bindpoint = get_bindpoint()
     sender = request_handler.user
     from_file = join(bindpoint, sender, path2)
@@ -521,6 +694,7 @@ def exec_create_share(request_handler):
             try:
                 symlink(from_file, to_file)
                 SymlinkCache().add(from_file, to_file)
+                record_change('share', to_file)
             except OSError:
                 getLogger('api').error("Error making symlink from " + from_file +
                                        " to " + to_file, extra=request_handler.get_log_dict())
@@ -537,7 +711,7 @@ def exec_key(request_handler):
 
     :param request_handler: object containing the file path encoded in its path
     """
-    localbox_path = unquote_plus(request_handler.path.replace('/lox_api/key/', '', 1))
+    localbox_path = unquote_plus(request_handler.route_params['path'])
     while localbox_path.startswith('/'):
         localbox_path = localbox_path[1:]
 
@@ -553,9 +727,13 @@ def exec_key(request_handler):
         data = request_handler.old_body
         # TODO: not crash on bull
         json_object = loads(data)
-        sql = "insert into keys (path, user, key, iv) VALUES (?, ?, ?, ?)"
-        database_execute(sql, (localbox_path, json_object['user'], json_object['key'],
-                               json_object['iv']))
+        # the first key of a user for a path is kept (keys are keyed by both)
+        if get_key_and_iv(localbox_path, json_object['user']) is None:
+            sql = "insert into keys (path, user, key, iv) VALUES (?, ?, ?, ?)"
+            database_execute(sql, (localbox_path, json_object['user'], json_object['key'],
+                                   json_object['iv']))
+        # has_keys changes for everything below the key path
+        invalidate_metadata(get_filesystem_path(localbox_path, json_object['user']), recursive=True)
         request_handler.status = 200
         # TODO: recrypt encryped data
 
@@ -569,7 +747,7 @@ def exec_key_revoke(request_handler):
                            and json encoded name of the user whoes key to
                            revoke
     """
-    path = request_handler.path.replace('/lox_api/key_revoke/', '', 1)
+    path = request_handler.route_params['path']
     lengthstring = request_handler.headers.get('content-length')
     if lengthstring is None:
         user = request_handler.user
@@ -582,6 +760,41 @@ def exec_key_revoke(request_handler):
             request_handler.status = 403
     sql = 'remove from keys where user = ? and path = ?;'
     database_execute(sql, (user, path))
+    invalidate_metadata(get_filesystem_path(path, user), recursive=True)
+
+
+def exec_changes(request_handler):
+    """
+    Returns the changes to the files of the user after the cursor given in
+    the query string, at most 'limit' of them. Without cursor, only the
+    cursor of the current state is returned, to continue from after listing
+    the files. When the changes after the cursor have expired, the response
+    is a 410 and the client has to list the files again. Called from the
+    routing list
+
+    :param request_handler: object with the cursor and limit in its query
+                            string
+    """
+    parameters = get_query_parameters(request_handler)
+    try:
+        limit = int(parameters.get('limit', CHANGES_LIMIT))
+        cursor = int(parameters['cursor']) if 'cursor' in parameters else None
+    except ValueError:
+        limit = cursor = -1
+    if not 0 < limit <= CHANGES_LIMIT or (cursor is not None and cursor < 0):
+        request_handler.status = 400
+        request_handler.body = "Error: invalid cursor or limit"
+        return
+    if cursor is None:
+        result = {'changes': [], 'cursor': get_latest_cursor(request_handler.user), 'has_more': False}
+    else:
+        result = get_changes(request_handler.user, cursor, limit)
+    if result is None:
+        request_handler.status = 410
+        request_handler.body = "Error: changes after the cursor have expired"
+        return
+    request_handler.status = 200
+    request_handler.body = dumps(result)
 
 
 def exec_meta(request_handler):
@@ -590,48 +803,93 @@ def exec_meta(request_handler):
 
     :param request_handler: object with path encoded in its path
     """
-    if (request_handler.path == '/lox_api/meta') or (request_handler.path == '/lox_api/meta/'):
-        path = ''
-    else:
-        path = unquote_plus(
-            request_handler.path.replace('/lox_api/meta/', '', 1))
+    path = unquote_plus(request_handler.route_params['path'])
+    try:
+        listing = get_listing_parameters(request_handler)
+        tree, depth = get_tree_parameters(request_handler)
+    except ValueError:
+        request_handler.status = 400
+        request_handler.body = "Error: invalid offset, limit, sort, order, depth or recursive"
+        return
 
     getLogger(__name__).debug('body %s' % request_handler.old_body,
                               extra=localbox.utils.get_logging_extra(request_handler))
+    paths = None
     if request_handler.old_body:
-        path = unquote_plus(loads(request_handler.old_body)['path'])
-        if path == '/':
-            path = '.'
+        json_body = loads(request_handler.old_body)
+        if 'paths' in json_body:
+            paths = [unquote_plus(item) for item in json_body['paths']]
+        else:
+            path = unquote_plus(json_body['path'])
+            if path == '/':
+                path = '.'
+
+    if tree or paths is not None:
+        send_meta_tree(request_handler, [path] if paths is None else paths, depth,
+                       listing['order'], listing['reverse'])
+        return
 
     try:
         try:
             filepath = get_filesystem_path(path, request_handler.user)
         except ValueError as e:
             request_handler.status = 404
-            request_handler.body = e.message
-            getLogger(__name__).error(e.message,
+            request_handler.body = str(e)
+            getLogger(__name__).error(str(e),
                                       extra=localbox.utils.get_logging_extra(request_handler))
             return
-        result = stat_reader(filepath, request_handler.user)
+        result = list_directory(filepath, request_handler.user, **listing)
         getLogger(__name__).debug('meta for filepath %s: %s' % (filepath, result),
                                   extra=localbox.utils.get_logging_extra(request_handler))
         if result is None:
             request_handler.status = 404
             request_handler.body = 'no meta found for %s. maybe the file does not exist' % filepath
             return
-        result['children'] = []
-        for path, directories, files in walk(filepath):
-            for child in directories + files:
-                user = request_handler.user
-                childpath = join(filepath, child)
-                result['children'].append(stat_reader(childpath, user))
-            break
     except OSError as err:
         request_handler.status = 404
         getLogger(__name__).exception(err,
                                       extra=localbox.utils.get_logging_extra(request_handler))
     request_handler.body = dumps(result)
     request_handler.status = 200
+    check_not_modified(request_handler, body_etag(request_handler.body))
+
+
+def send_meta_tree(request_handler, paths, depth, order, reverse):
+    """
+    Respond with the metadata of paths and of everything below them, up to
+    depth levels, as newline delimited JSON: one object per file or
+    directory, generated (see walk_metadata) while the response is sent.
+    For a path which does not exist, the object holds its path and an
+    'error'.
+
+    :param request_handler: object to set the response on
+    :param paths: localbox paths to list
+    :param depth: number of levels below each path to include, None for all
+    :param order: key of LISTING_ORDERS to sort the children by
+    :param reverse: whether to sort in descending order
+    """
+    user = request_handler.user
+    filepaths = []
+    for path in paths:
+        try:
+            filepaths.append(get_filesystem_path(path, user))
+        except ValueError as e:
+            request_handler.status = 404
+            request_handler.body = str(e)
+            return
+
+    def generate():
+        for filepath in filepaths:
+            found = False
+            for statdict in walk_metadata(filepath, user, depth, order, reverse):
+                found = True
+                yield statdict
+            if not found:
+                yield {'path': get_localbox_path(filepath, user), 'error': 'not found'}
+
+    request_handler.status = 200
+    request_handler.new_headers['Content-Type'] = 'application/x-ndjson'
+    request_handler.body = encode_ndjson(generate())
 
 
 def fake_register_app(request_handler):
@@ -729,30 +987,38 @@ def fake_set_cookies(request_handler):
 # requested. When the regex matches, the function is called with the
 # request_handler as argument.
 ROUTING_LIST = [
-    (regex_compile(r"\/lox_api\/files.*"), exec_files_path),
-    (regex_compile(r"\/lox_api\/invitations"), exec_invitations),
-    (regex_compile(r"\/lox_api\/invite/[0-9]+/accept"), exec_invite_accept),
-    (regex_compile(r"\/lox_api\/invite/[0-9]+/revoke"), exec_invite_reject),
-    (regex_compile(r"\/lox_api\/operations\/copy"), exec_operations_copy),
-    (regex_compile(r"\/lox_api\/operations\/move"), exec_operations_move),
-    (regex_compile(r"\/lox_api\/operations\/delete"), exec_operations_delete),
-    (regex_compile(r"\/lox_api\/operations\/create_folder"),
-     exec_operations_create_folder),
-    (regex_compile(r"\/lox_api\/share_create\/.*"), exec_create_share),
-    (regex_compile(r"\/lox_api\/shares\/.*\/edit"), exec_edit_shares),
-    (regex_compile(r"\/lox_api\/shares\/.*\/revoke"), exec_remove_shares),
-    (regex_compile(r"\/lox_api\/shares\/.*\/delete"), exec_shares_delete),
-    (regex_compile(r"\/lox_api\/shares\/.*\/leave"), exec_leave_share),
-    (regex_compile(r"\/lox_api\/shares\/user/.*"), exec_shares_list),
-    (regex_compile(r"\/lox_api\/shares\/.*"), exec_shares),
-    (regex_compile(r"\/lox_api\/user\/.*"), exec_user_username),
-    (regex_compile(r"\/lox_api\/user"), exec_user),
-    (regex_compile(r"\/lox_api\/key\/.*"), exec_key),
-    (regex_compile(r"\/lox_api\/key_revoke\/.*"), exec_key_revoke),
-    (regex_compile(r"\/lox_api\/meta.*"), exec_meta),
-    (regex_compile(r"\/lox_api\/identities"), exec_identities),
-
-    (regex_compile(r"\/register_app"), fake_register_app),
-    (regex_compile(r"\/oauth.*"), fake_oauth),
-    (regex_compile(r"\/.*"), fake_set_cookies),
+    (r"\/lox_api\/files\/?(?P<path>.*)", GET_POST, exec_files_path),
+    (r"\/lox_api\/uploads\/(?P<session_id>[0-9a-f]+)\/commit", POST, exec_upload_commit),
+    (r"\/lox_api\/uploads\/(?P<session_id>[0-9a-f]+)\/cancel", POST, exec_upload_cancel),
+    (r"\/lox_api\/uploads\/(?P<session_id>[0-9a-f]+)$", GET_POST, exec_upload_session),
+    (r"\/lox_api\/uploads\/?$", POST, exec_upload_create),
+    (r"\/lox_api\/invitations", GET_POST, exec_invitations),
+    (r"\/lox_api\/invite/(?P<invite_id>[0-9]+)/accept", GET_POST, exec_invite_accept),
+    (r"\/lox_api\/invite/(?P<invite_id>[0-9]+)/revoke", GET_POST, exec_invite_reject),
+    (r"\/lox_api\/operations\/copy", POST, exec_operations_copy),
+    (r"\/lox_api\/operations\/move", POST, exec_operations_move),
+    (r"\/lox_api\/operations\/delete", POST, exec_operations_delete),
+    (r"\/lox_api\/operations\/create_folder", POST, exec_operations_create_folder),
+    (r"\/lox_api\/operations\/batch", POST, exec_operations_batch),
+    (r"\/lox_api\/share_create\/(?P<path>.*)", POST, exec_create_share),
+    (r"\/lox_api\/shares\/(?P<share_id>.*)\/edit", POST, exec_edit_shares),
+    (r"\/lox_api\/shares\/(?P<share_id>.*)\/revoke", GET_POST, exec_remove_shares),
+    (r"\/lox_api\/shares\/(?P<share_id>.*)\/delete", GET_POST, exec_shares_delete),
+    (r"\/lox_api\/shares\/(?P<path>.*)\/leave", GET_POST, exec_leave_share),
+    (r"\/lox_api\/shares\/user/(?P<user>.*)", GET_POST, exec_shares_list),
+    (r"\/lox_api\/shares\/(?P<path>.*)", GET_POST, exec_shares),
+    (r"\/lox_api\/user\/(?P<username>.*)", GET_POST, exec_user_username),
+    (r"\/lox_api\/user", GET_POST, exec_user),
+    (r"\/lox_api\/key\/(?P<path>.*)", GET_POST, exec_key),
+    (r"\/lox_api\/key_revoke\/(?P<path>.*)", GET_POST, exec_key_revoke),
+    (r"\/lox_api\/meta\/?(?P<path>.*)", GET_POST, exec_meta),
+    (r"\/lox_api\/changes\/?$", GET_POST, exec_changes),
+    (r"\/lox_api\/identities", GET_POST, exec_identities),
+
+    (r"\/register_app", GET_POST, fake_register_app),
+    (r"\/oauth.*", GET_POST, fake_oauth),
+    (r"\/.*", GET_POST, fake_set_cookies),
 ]
+
+#: dispatches requests to the handlers of ROUTING_LIST
+ROUTER = Router(ROUTING_LIST)
@@ -1,21 +1,33 @@
+from email.utils import mktime_tz
+from email.utils import parsedate_tz
+from re import compile as regex_compile
 from ssl import SSLContext
 from ssl import PROTOCOL_TLSv1_2 as SSL_PROTOCOL
 from logging import getLogger
+from socket import error as socket_error
+from threading import Event
+from threading import Lock
+from time import time
 
 from localbox import config
 from localbox import defaults
 from localbox.cache import TimedCache
 
 try:
-    from urllib2 import HTTPError
+    from httplib import HTTPConnection  # pylint: disable=F0401
+    from httplib import HTTPException  # pylint: disable=F0401
+    from httplib import HTTPSConnection  # pylint: disable=F0401
     from urllib import urlencode  # pylint: disable=E0611
-    from urllib2 import Request
-    from urllib2 import urlopen
+    from urlparse import urlsplit  # pylint: disable=F0401
 except ImportError:
-    from urllib.error import HTTPError  # pylint: disable=E0611,F0401
+    from http.client import HTTPConnection  # pylint: disable=E0611,F0401
+    from http.client import HTTPException  # pylint: disable=E0611,F0401
+    from http.client import HTTPSConnection  # pylint: disable=E0611,F0401
     from urllib.parse import urlencode  # pylint: disable=E0611,F0401
-    from urllib.request import Request  # pylint: disable=E0611,F0401
-    from urllib.request import urlopen  # pylint: disable=E0611,F0401
+    from urllib.parse import urlsplit  # pylint: disable=E0611,F0401
+
+#: max-age directive of a Cache-Control header
+MAX_AGE = regex_compile(r'max-age\s*=\s*([0-9]+)')
 
 
 def authorize(func):
@@ -55,36 +67,200 @@ def authorize(func):
     return check
 
 
+def get_auth_cache():
+    """
+    Returns the cache of verified authorization headers, configured with the
+    'timeout' and 'size' settings of the cache section.
+
+    :returns: the TimedCache singleton
+    """
+    return TimedCache(timeout=int(config.get('cache', 'timeout', default=defaults.CACHE_TIMEOUT)),
+                      max_size=int(config.get('cache', 'size', default=defaults.CACHE_SIZE)))
+
+
+def get_verifier_timeout(headers):
+    """
+    Determines how long the verifier allows its answer to be cached, from the
+    Cache-Control (max-age, no-cache, no-store) or Expires response headers.
+
+    :param headers: headers of the verify response
+    :returns: number of seconds, or None when the verifier does not say
+    """
+    cache_control = (headers.get('Cache-Control') or '').lower()
+    match = MAX_AGE.search(cache_control)
+    if match is not None:
+        return int(match.group(1))
+    if 'no-cache' in cache_control or 'no-store' in cache_control:
+        return 0
+    expires = headers.get('Expires')
+    if expires is not None:
+        parsed = parsedate_tz(expires)
+        if parsed is not None:
+            return max(int(mktime_tz(parsed) - time()), 0)
+    return None
+
+
+class PendingVerification(object):
+    """
+    A verify request in progress, which other requests with the same
+    authorization header can wait for.
+    """
+
+    def __init__(self):
+        self.done = Event()
+        self.result = None
+        self.error = None
+
+
+class VerifyClient(object):
+    """
+    Singleton HTTP client for the verify endpoint of the OAuth server. It
+    keeps a pool of persistent (keep-alive) connections sharing one SSL
+    context, so a verification does not pay a TCP and TLS handshake, and
+    coalesces concurrent verifications of the same authorization header into
+    one request.
+    """
+    _instance = None
+
+    def __new__(cls, *args, **kwargs):
+        if not cls._instance:
+            cls._instance = super(VerifyClient, cls).__new__(cls)
+        return cls._instance
+
+    def __init__(self, url):
+        if getattr(self, 'url', None) == url:
+            return
+        self.url = url
+        self.lock = Lock()
+        self.connections = []
+        self.pending = {}
+        self.ssl_context = SSLContext(SSL_PROTOCOL)
+        self.timeout = float(config.get('oauth', 'verify_timeout', default=defaults.VERIFY_TIMEOUT))
+        self.pool_size = int(config.get('oauth', 'verify_pool_size', default=defaults.VERIFY_POOL_SIZE))
+
+    def verify(self, auth_header):
+        """
+        Ask the verify endpoint about an authorization header. When the same
+        header is being verified already, wait for that answer instead.
+
+        :param auth_header: value of the Authorization header to verify
+        :returns: tuple of the HTTP status, body and headers of the response
+        """
+        with self.lock:
+            pending = self.pending.get(auth_header)
+            waiting = pending is not None
+            if not waiting:
+                pending = PendingVerification()
+                self.pending[auth_header] = pending
+        if waiting:
+            pending.done.wait()
+            if pending.error is not None:
+                raise pending.error
+            return pending.result
+        try:
+            pending.result = self.request(auth_header)
+            return pending.result
+        except Exception as error:
+            pending.error = error
+            raise
+        finally:
+            with self.lock:
+                del self.pending[auth_header]
+            pending.done.set()
+
+    def request(self, auth_header):
+        """
+        Send a verify request over a pooled connection. A connection the
+        server closed while it was idle is replaced and the request retried
+        once.
+
+        :param auth_header: value of the Authorization header to verify
+        :returns: tuple of the HTTP status, body and headers of the response
+        """
+        parts = urlsplit(self.url)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        for attempt in range(2):
+            connection = self.get_connection(parts)
+            try:
+                connection.request('GET', path, headers={'Authorization': auth_header})
+                response = connection.getresponse()
+                body = response.read()
+            except (HTTPException, socket_error):
+                connection.close()
+                if attempt > 0:
+                    raise
+                continue
+            if response.will_close:
+                connection.close()
+            else:
+                self.release_connection(connection)
+            return response.status, body, response.msg
+
+    def get_connection(self, parts):
+        """
+        :param parts: the split verify url
+        :returns: an idle pooled connection, or a new one
+        """
+        with self.lock:
+            if self.connections:
+                return self.connections.pop()
+        if parts.scheme == 'https':
+            return HTTPSConnection(parts.hostname, parts.port, timeout=self.timeout, context=self.ssl_context)
+        return HTTPConnection(parts.hostname, parts.port, timeout=self.timeout)
+
+    def release_connection(self, connection):
+        """
+        Return a connection to the pool, or close it when the pool is full.
+
+        :param connection: connection with no request in progress
+        """
+        with self.lock:
+            if len(self.connections) < self.pool_size:
+                self.connections.append(connection)
+                return
+        connection.close()
+
+
 def check_authorization(request_handler):
     """
     Assert whether the authorization header is valid by checking it against
     the cache first and if unsuccessful, the oauth server. Sets the 'user'
-    field of the request_handler object.
+    field of the request_handler object. Verified headers are cached for the
+    configured timeout or the (shorter) time the verifier allows; rejected
+    (403) headers are cached for the 'negative_timeout' of the cache section.
 
     :return: When successful returns user's name. Returns None on failure.
     """
-    auth_header = request_handler.headers.getheader('Authorization')
+    auth_header = request_handler.headers.get('Authorization')
     if auth_header is None:
         getLogger('auth').debug("authentication failed: no Authorization header available",
                                 extra=request_handler.get_log_dict())
         return None
     auth_url = config.get('oauth', 'verify_url', default=defaults.VERIFY_URL)
     getLogger('auth').debug("verify_url: %s" % auth_url, extra=request_handler.get_log_dict())
-    cache = TimedCache(timeout=0)  # FIXME: Cache is broken
+    cache = get_auth_cache()
     name = cache.get(auth_header)
     if name is not None:
-        return name
-    auth_request = Request(auth_url, None, {'Authorization': auth_header})
-    try:
-        ctx = SSLContext(SSL_PROTOCOL)
-        response = urlopen(auth_request, context=ctx)
-        name = response.read()
-    except HTTPError as error:
-        if error.code == 403:
+        # an empty name is a cached rejection
+        return name or None
+    timeout = None
+    status, name, headers = VerifyClient(auth_url).verify(auth_header)
+    if 200 <= status < 300:
+        if not isinstance(name, str):
+            name = name.decode('UTF-8')
+        verifier_timeout = get_verifier_timeout(headers)
+        if verifier_timeout is not None:
+            timeout = min(verifier_timeout, cache.timeout)
+    else:
+        if status == 403:
             getLogger('auth').debug("authentication failed: Wrong/expired code",
                                     extra=request_handler.get_log_dict())
+            cache.add(auth_header, '', int(config.get('cache', 'negative_timeout',
+                                                      default=defaults.CACHE_NEGATIVE_TIMEOUT)))
         else:
-            getLogger('auth').debug("authentication failed: HttpError %s" % error,
+            getLogger('auth').debug("authentication failed: HttpError %s" % status,
                                     extra=request_handler.get_log_dict())
         name = ''
     if name == '':
@@ -94,5 +270,5 @@ def check_authorization(request_handler):
     else:
         getLogger('auth').debug('Authenticated user: ' + name,
                                 extra=request_handler.get_log_dict())
-        cache.add(auth_header, name)
+        cache.add(auth_header, name, timeout)
     return name
@@ -1,6 +1,9 @@
 """
-Caching framework for authentication caching.
+Caching framework for authentication and metadata caching.
 """
+from collections import OrderedDict
+from os import sep
+from threading import Lock
 from time import time
 
 
@@ -10,19 +13,23 @@ class TimedCache(object):
     TimedCache is a dictionary with a timeout. The class is initalised with a
     timeout, and data will be invalid after the timeout has expired. Invalid
     data will only be removed from the cache after it is referenced by get()
-    or the clean() function is called.
+    or the clean() function is called. When max_size is given, the least
+    recently used entries are removed to keep the cache at that size.
     """
     _instance = None
 
     def __new__(cls, *args, **kwargs):
         if not cls._instance:
-            cls._instance = super(TimedCache, cls).__new__(
-                cls, *args, **kwargs)
+            cls._instance = super(TimedCache, cls).__new__(cls)
         return cls._instance
 
-    def __init__(self, timeout=600):
-        self.cache = {}
+    def __init__(self, timeout=600, max_size=None):
+        # TimedCache is a singleton, so keep the entries of earlier instances
+        if not hasattr(self, 'cache'):
+            self.cache = OrderedDict()
+            self.lock = Lock()
         self.timeout = timeout
+        self.max_size = max_size
 
     def invalidate(self, key):
         """
@@ -30,7 +37,8 @@ class TimedCache(object):
 
         :param key: entry to invalidate from the cache
         """
-        del self.cache[key]
+        with self.lock:
+            self.cache.pop(key, None)
 
     def add(self, key, value, timeout=None):
         """
@@ -43,7 +51,11 @@ class TimedCache(object):
         if timeout is None:
             timeout = self.timeout
         store = (value, time() + int(timeout))
-        self.cache[key] = store
+        with self.lock:
+            self.cache.pop(key, None)
+            self.cache[key] = store
+            while self.max_size is not None and len(self.cache) > self.max_size:
+                self.cache.popitem(last=False)
 
     def get(self, key):
         """
@@ -53,11 +65,13 @@ class TimedCache(object):
 
         :param key: the key to find the value for
         """
-        if key in self.cache:
-            (value, date) = self.cache[key]
-            if date > time():
-                return value
-            del self.cache[key]
+        with self.lock:
+            if key in self.cache:
+                (value, date) = self.cache.pop(key)
+                if date > time():
+                    # reinsert to mark the entry as most recently used
+                    self.cache[key] = (value, date)
+                    return value
         return None
 
     def clean(self):
@@ -65,7 +79,118 @@ class TimedCache(object):
         Check every key-value pair in the database and remove expired pairs.
         Removes stale entries in the cache
         """
-        for key, store in self.cache:
-            date = store[1]
-            if date < time():
-                del self.cache[key]
+        now = time()
+        with self.lock:
+            for key, store in list(self.cache.items()):
+                date = store[1]
+                if date < now:
+                    del self.cache[key]
+
+    def __len__(self):
+        return len(self.cache)
+
+
+class MetadataCache(object):
+
+    """
+    MetadataCache holds file and directory metadata in memory, so directories
+    polled over and over by clients are not read from disk and database every
+    time. Every entry is stored with a validator (see path_validator in files)
+    which has to match the current one of the path, the real path it
+    describes so writes can invalidate it, and a timeout bounding how long
+    changes the validator does not show (e.g. keys added by another process)
+    can go unnoticed. The least recently used entries are removed to keep the
+    cache at max_size.
+    """
+    _instance = None
+
+    def __new__(cls, *args, **kwargs):
+        if not cls._instance:
+            cls._instance = super(MetadataCache, cls).__new__(cls)
+        return cls._instance
+
+    def __init__(self, timeout=30, max_size=10000):
+        # MetadataCache is a singleton, so keep the entries of earlier instances
+        if not hasattr(self, 'cache'):
+            self.cache = OrderedDict()
+            # real path => keys of the entries describing it
+            self.paths = {}
+            self.lock = Lock()
+        self.timeout = timeout
+        self.max_size = max_size
+
+    def _discard(self, key, store):
+        """
+        Forget the real path of a removed entry; the caller holds the lock.
+        """
+        keys = self.paths.get(store[2])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self.paths[store[2]]
+
+    def add(self, key, validator, realpath, value):
+        """
+        Adds metadata to the cache.
+
+        :param key: key for the entry
+        :param validator: validator of the path at the time value was read
+        :param realpath: real path of the file or directory value describes
+        :param value: the metadata
+        """
+        store = (value, validator, realpath, time() + self.timeout)
+        with self.lock:
+            old = self.cache.pop(key, None)
+            if old is not None:
+                self._discard(key, old)
+            self.cache[key] = store
+            self.paths.setdefault(realpath, set()).add(key)
+            while len(self.cache) > self.max_size:
+                self._discard(*self.cache.popitem(last=False))
+
+    def get(self, key, validator):
+        """
+        Returns the metadata stored for key, or None when there is none, the
+        timeout has expired or it was stored with another validator.
+
+        :param key: the key to find the metadata for
+        :param validator: the current validator of the path
+        """
+        with self.lock:
+            store = self.cache.pop(key, None)
+            if store is None:
+                return None
+            if store[1] == validator and store[3] > time():
+                # reinsert to mark the entry as most recently used
+                self.cache[key] = store
+                return store[0]
+            self._discard(key, store)
+        return None
+
+    def invalidate(self, realpaths, below=None):
+        """
+        Removes the entries describing the given paths.
+
+        :param realpaths: real paths of which to remove the entries
+        :param below: real path of a directory of which all entries below it
+                      are removed as well, e.g. a removed or moved directory
+        """
+        realpaths = set(realpaths)
+        with self.lock:
+            if below is not None:
+                prefix = below.rstrip(sep) + sep
+                realpaths.update(path for path in self.paths if path.startswith(prefix))
+            for realpath in realpaths:
+                for key in self.paths.pop(realpath, ()):
+                    del self.cache[key]
+
+    def clear(self):
+        """
+        Removes all entries.
+        """
+        with self.lock:
+            self.cache.clear()
+            self.paths.clear()
+
+    def __len__(self):
+        return len(self.cache)
@@ -0,0 +1,205 @@
+"""
+Journal of the changes made through the server, so sync clients can ask what
+changed since their last sync instead of listing every directory. Every
+change is recorded for each user who sees the changed path: its owner and
+the users it is shared with (through a share of a directory it is in), at
+the path they see it at. Entries are numbered; a client keeps the number of
+the last entry of its user it has seen as its cursor.
+
+On SQLite, writes are serialized, so entries are committed in the order of
+their numbers. On MySQL, a transaction can take a number and commit after a
+transaction that took a higher one, so a client could move its cursor past
+an entry that is not visible yet. Entries newer than the 'changes_settle_time'
+setting are therefore held back there, together with all entries after them,
+until the transactions that could have taken lower numbers have committed.
+This assumes recording a change takes less than the settle time, and that
+the clocks of the servers sharing the database agree.
+"""
+from os import sep
+from os.path import abspath
+from os.path import dirname
+from os.path import isdir
+from os.path import join
+from os.path import realpath
+from os.path import relpath
+from time import time
+
+from localbox import config
+from localbox import defaults
+from localbox.database import database_execute
+from localbox.database import database_transaction
+from localbox.files import get_localbox_path
+from localbox.files import SymlinkCache
+from localbox.files import SERVER_DIRECTORY
+from localbox.utils import get_bindpoint
+
+#: types of changes in the journal
+CHANGE_TYPES = ('create', 'write', 'delete', 'move', 'share', 'unshare')
+#: seconds between removals of expired journal entries by a process
+EXPIRY_INTERVAL = 3600
+#: maximum (and default) number of changes returned at once
+CHANGES_LIMIT = 1000
+
+# time of the last removal of expired entries by this process
+_EXPIRED_AT = [0]
+
+
+def get_viewers(filesystem_path, recursive=False):
+    """
+    Find the users who see a path, and the localbox path they see it at.
+
+    :param filesystem_path: path of a file or directory below the bindpoint;
+                            it does not have to exist (anymore)
+    :param recursive: whether to include the users who see the path only
+                      through a share of something below it, e.g. for a
+                      directory about to be removed
+    :returns: set of (user, localbox path) tuples
+    """
+    bindpoint = abspath(get_bindpoint())
+    # the path as found below the bindpoint, with symlinks resolved
+    path = join(bindpoint, relpath(realpath(filesystem_path), realpath(bindpoint)))
+    parts = relpath(path, bindpoint).split(sep)
+    if parts[0] in ('.', '..', SERVER_DIRECTORY):
+        return set()
+    viewers = set([(parts[0], get_localbox_path(path, parts[0]))])
+    symlinks = SymlinkCache()
+    ancestor = path
+    while len(ancestor) > len(bindpoint):
+        if symlinks.exists(ancestor):
+            below = path[len(ancestor):].replace(sep, '/')
+            for link in symlinks.get(ancestor):
+                user = relpath(link, bindpoint).split(sep)[0]
+                viewers.add((user, get_localbox_path(link, user) + below))
+        ancestor = dirname(ancestor)
+    if recursive:
+        for destination in symlinks.get_destinations_below(path):
+            if destination != path:
+                for link in symlinks.get(destination):
+                    user = relpath(link, bindpoint).split(sep)[0]
+                    viewers.add((user, get_localbox_path(link, user)))
+    return viewers
+
+
+def record_change(change_type, filesystem_path, destination=None, viewers=None):
+    """
+    Add a change to the journal of every user who sees the changed path.
+    For a move, users who only see one side of it get a 'delete' or a
+    'create' (directories) or 'write' (files) instead.
+
+    :param change_type: one of CHANGE_TYPES
+    :param filesystem_path: the changed path
+    :param destination: the new path, for a move
+    :param viewers: the result of get_viewers for the path, when it had to be
+                    determined before the change (e.g. before removing
+                    shares); determined now otherwise
+    """
+    if viewers is None:
+        viewers = get_viewers(filesystem_path)
+    if destination is None:
+        rows = [(user, change_type, path, None) for user, path in viewers]
+    else:
+        targets = dict(get_viewers(destination))
+        rows = []
+        for user, path in viewers:
+            if user in targets:
+                to_path = targets.pop(user)
+                if to_path != path:
+                    rows.append((user, change_type, path, to_path))
+            else:
+                rows.append((user, 'delete', path, None))
+        appeared = 'create' if isdir(destination) else 'write'
+        rows.extend((user, appeared, path, None) for user, path in targets.items())
+    now = time()
+    with database_transaction():
+        for user, kind, path, to_path in rows:
+            database_execute('insert into changes (user, type, path, to_path, changed_at) values (?, ?, ?, ?, ?)',
+                             (user, kind, path, to_path, now))
+    if now - _EXPIRED_AT[0] > EXPIRY_INTERVAL:
+        _EXPIRED_AT[0] = now
+        expire_changes()
+
+
+def expire_changes():
+    """
+    Remove the journal entries older than the 'changes_retention' setting
+    (in seconds) of the database section. The number of the last removed
+    entry of every user is kept in the changes_expired table: cursors before
+    it can no longer be used.
+    """
+    limit = time() - int(config.get('database', 'changes_retention', default=defaults.CHANGES_RETENTION))
+    with database_transaction():
+        expired = database_execute('select user, max(id) from changes where changed_at < ? group by user',
+                                   (limit,)) or []
+        for user, identifier in expired:
+            database_execute('replace into changes_expired (user, id) values (?, ?)',
+                             (user, max(identifier, get_expired_cursor(user))))
+        database_execute('delete from changes where changed_at < ?', (limit,))
+
+
+def get_expired_cursor(user):
+    """
+    :param user: the user to whose journal the cursor belongs
+    :returns: number of the last expired journal entry of the user, 0 when
+              none expired
+    """
+    result = database_execute('select id from changes_expired where user = ?', (user,))
+    return result[0][0] if result else 0
+
+
+def get_settle_time():
+    """
+    :returns: number of seconds new journal entries are held back, 0 when
+              entries are committed in the order of their numbers (SQLite)
+    """
+    if config.get('database', 'type') != 'mysql':
+        return 0
+    return float(config.get('database', 'changes_settle_time', default=defaults.CHANGES_SETTLE_TIME))
+
+
+def get_latest_cursor(user):
+    """
+    :param user: the user to whose journal the cursor belongs
+    :returns: the cursor of the newest journal entry of the user that is not
+              held back (see get_settle_time)
+    """
+    settled = time() - get_settle_time()
+    result = database_execute('select min(id) from changes where user = ? and changed_at > ?', (user, settled))
+    if result and result[0][0] is not None:
+        result = database_execute('select max(id) from changes where user = ? and id < ?', (user, result[0][0]))
+    else:
+        result = database_execute('select max(id) from changes where user = ?', (user,))
+    latest = result[0][0] if result and result[0][0] is not None else 0
+    return max(latest, get_expired_cursor(user))
+
+
+def get_changes(user, cursor, limit):
+    """
+    Read the journal of a user after a cursor.
+
+    :param user: the user to read the journal of
+    :param cursor: number of the last entry the client has seen
+    :param limit: maximum number of entries to return
+    :returns: dictionary with the 'changes' (type, path, to_path for moves
+              and changed_at), the 'cursor' to continue from and whether
+              there are more changes ('has_more'), or None when entries after
+              the cursor have expired. Entries held back (see
+              get_settle_time) are returned by a later call.
+    """
+    settled = time() - get_settle_time()
+    result = database_execute('select id, type, path, to_path, changed_at from changes '
+                              'where user = ? and id > ? order by id limit ?', (user, cursor, limit + 1)) or []
+    # checked after reading, so entries expiring meanwhile are not missed
+    if cursor < get_expired_cursor(user):
+        return None
+    changes = []
+    has_more = len(result) > limit
+    for identifier, change_type, path, to_path, changed_at in result[:limit]:
+        if changed_at > settled:
+            has_more = False
+            break
+        change = {'type': change_type, 'path': path, 'changed_at': changed_at}
+        if to_path is not None:
+            change['to_path'] = to_path
+        changes.append(change)
+        cursor = identifier
+    return {'changes': changes, 'cursor': cursor, 'has_more': has_more}
@@ -1,8 +1,14 @@
 """
-Database implementation class
+Database implementation class. Connections are reused: every thread keeps
+its own SQLite connection and MySQL connections are kept in a pool, so a
+statement does not have to open (and close) a connection of its own.
 """
+from contextlib import contextmanager
 from logging import getLogger
-from os.path import exists
+from os import getpid
+from sqlite3 import ProgrammingError as SQLiteProgrammingError
+from threading import local
+from threading import Lock
 
 try:
     from ConfigParser import NoSectionError
@@ -12,12 +18,31 @@ except ImportError:
 try:
     from MySQLdb import connect as mysql_connect
     from MySQLdb import Error as MySQLError
+    from MySQLdb import OperationalError as MySQLOperationalError
 except ImportError:
     mysql_connect = None
 
+    class MySQLError(Exception):
+        """
+        Stand-in for MySQLdb.Error when python-MySQL is not installed
+        """
+
+    MySQLOperationalError = MySQLError
+
 from sqlite3 import connect as sqlite_connect
 
 from localbox import config
+from localbox import defaults
+from localbox.migrations import migrate
+
+#: connection pool of this process, created by get_connection_pool
+_POOL = None
+_POOL_LOCK = Lock()
+#: whether the schema has been brought up to date by this (or the parent)
+#: process
+_MIGRATED = False
+#: connection of the transaction (if any) running in the current thread
+_TRANSACTION = local()
 
 
 def get_sql_log_dict():
@@ -29,6 +54,159 @@ def get_sql_log_dict():
     return {'ip': ip, 'user': '', 'path': 'database/'}
 
 
+class SQLiteConnections(object):
+    """
+    Keeps one SQLite connection per thread. SQLite connections cannot be
+    shared between threads, but a thread may keep using its own.
+    """
+    #: errors after which a connection is not used again
+    reconnect_errors = (SQLiteProgrammingError,)
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.local = local()
+
+    def acquire(self):
+        """
+        :returns: the connection of the current thread
+        """
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            connection = self.connect()
+            self.local.connection = connection
+        return connection
+
+    def release(self, connection, broken=False):
+        """
+        Give back a connection obtained by acquire.
+
+        :param connection: the connection
+        :param broken: when True the connection is closed and replaced on
+                       the next acquire
+        """
+        if broken:
+            self.local.connection = None
+            try:
+                connection.close()
+            except SQLiteProgrammingError:
+                pass
+
+    def connect(self):
+        """
+        :returns: a new sqlite3 connection
+        """
+        return sqlite_connect(self.filename)
+
+
+class MySQLConnections(object):
+    """
+    Pool of MySQL connections. Idle connections are checked with ping()
+    before they are handed out again, so a connection the server dropped is
+    replaced by a new one. At most pool_size idle connections are kept.
+    """
+    #: errors after which a connection is not used again
+    reconnect_errors = (MySQLOperationalError,)
+
+    def __init__(self, pool_size):
+        self.pool_size = pool_size
+        self.idle = []
+        self.lock = Lock()
+
+    def acquire(self):
+        """
+        :returns: a healthy idle connection, or a new one
+        """
+        while True:
+            with self.lock:
+                if not self.idle:
+                    break
+                connection = self.idle.pop()
+            try:
+                connection.ping()
+                return connection
+            except MySQLError:
+                self.close(connection)
+        return self.connect()
+
+    def release(self, connection, broken=False):
+        """
+        Give back a connection obtained by acquire.
+
+        :param connection: the connection
+        :param broken: when True the connection is closed instead of reused
+        """
+        if not broken:
+            with self.lock:
+                if len(self.idle) < self.pool_size:
+                    self.idle.append(connection)
+                    return
+        self.close(connection)
+
+    @staticmethod
+    def close(connection):
+        """
+        Close a connection, ignoring the errors of a connection that is gone
+        already.
+
+        :param connection: the connection to close
+        """
+        try:
+            connection.close()
+        except MySQLError:
+            pass
+
+    @staticmethod
+    def connect():
+        """
+        :returns: a new connection to the configured MySQL database
+        """
+        host = config.get('database', 'hostname')
+        user = config.get('database', 'username')
+        pawd = config.get('database', 'password')
+        dbse = config.get('database', 'database')
+        port = config.getint('database', 'port')
+        return mysql_connect(host=host, port=port, user=user,
+                             passwd=pawd, db=dbse)
+
+
+def get_connection_pool():
+    """
+    Returns the connection pool of this process for the configured database
+    type. A forked worker process creates its own pool instead of using the
+    connections of its parent. The first pool applies the pending schema
+    migrations.
+
+    :returns: SQLiteConnections or MySQLConnections instance
+    """
+    global _POOL, _MIGRATED  # pylint: disable=W0603
+    pool = _POOL
+    if pool is not None and pool.pid == getpid():
+        return pool
+    with _POOL_LOCK:
+        if _POOL is None or _POOL.pid != getpid():
+            dbtype = config.get('database', 'type')
+            if dbtype == "mysql":
+                if mysql_connect is None:
+                    exit(
+                        "Trying to use a MySQL database without python-MySQL module.")
+                _POOL = MySQLConnections(int(config.get('database', 'pool_size',
+                                                        default=defaults.DATABASE_POOL_SIZE)))
+            elif (dbtype == "sqlite3") or (dbtype == "sqlite"):
+                _POOL = SQLiteConnections(config.get('database', 'filename'))
+            else:
+                print("Unknown database type, cannot continue")
+                return None
+            _POOL.pid = getpid()
+            if not _MIGRATED:
+                connection = _POOL.acquire()
+                try:
+                    migrate(connection, 'mysql' if dbtype == 'mysql' else 'sqlite', get_sql_log_dict())
+                finally:
+                    _POOL.release(connection)
+                _MIGRATED = True
+        return _POOL
+
+
 def database_execute(command, params=None):
     """
     Function to execute a sql statement on the database. Executes the right
@@ -44,9 +222,6 @@ def database_execute(command, params=None):
     dbtype = config.get('database', 'type')
 
     if dbtype == "mysql":
-        if mysql_execute is None:
-            exit(
-                "Trying to use a MySQL database without python-MySQL module.")
         command = command.replace('?', '%s')
         return mysql_execute(command, params)
 
@@ -56,9 +231,82 @@ def database_execute(command, params=None):
         print("Unknown database type, cannot continue")
 
 
+def execute_statement(cursor, command, params=None):
+    """
+    :param cursor: cursor of the connection to execute the command on
+    :param command: the sql command to execute
+    :param params: a list of tuple of values to substitute in command
+    :returns: a list of dictionaries representing the sql result
+    """
+    if params:
+        cursor.execute(command, params)
+    else:
+        cursor.execute(command)
+    return cursor.fetchall()
+
+
+def pooled_execute(pool, command, params=None):
+    """
+    Execute a statement on a pooled connection and commit it, or, inside
+    database_transaction, on the connection of the transaction. A statement
+    that fails because the connection broke is retried once on a new
+    connection.
+
+    :param pool: the connection pool of the database
+    :param command: the sql command to execute
+    :param params: a list of tuple of values to substitute in command
+    :returns: a list of dictionaries representing the sql result
+    """
+    connection = getattr(_TRANSACTION, 'connection', None)
+    if connection is not None:
+        return execute_statement(connection.cursor(), command, params)
+    for attempt in range(2):
+        connection = pool.acquire()
+        try:
+            result = execute_statement(connection.cursor(), command, params)
+            connection.commit()
+        except pool.reconnect_errors:
+            pool.release(connection, broken=True)
+            if attempt > 0:
+                raise
+            getLogger("database").info("reconnecting to the database", extra=get_sql_log_dict())
+            continue
+        except Exception:
+            connection.rollback()
+            pool.release(connection)
+            raise
+        pool.release(connection)
+        return result
+
+
+@contextmanager
+def database_transaction():
+    """
+    Context manager running all database_execute calls of the current thread
+    in its with block on one connection, as one transaction: it is committed
+    when the block finishes and rolled back when the block raises. Nested
+    use joins the outer transaction.
+    """
+    if getattr(_TRANSACTION, 'connection', None) is not None:
+        yield
+        return
+    pool = get_connection_pool()
+    connection = pool.acquire()
+    _TRANSACTION.connection = connection
+    try:
+        yield
+        connection.commit()
+    except Exception:
+        connection.rollback()
+        raise
+    finally:
+        _TRANSACTION.connection = None
+        pool.release(connection)
+
+
 def sqlite_execute(command, params=None):
     """
-    Function to execute a sql statement on the mysql database. This function is
+    Function to execute a sql statement on the sqlite database. This function is
     called by the database_execute function when the sqlite backend is set in
     the configuration file
 
@@ -66,34 +314,10 @@ def sqlite_execute(command, params=None):
     :param params: a list of tuple of values to substitute in command
     :returns: a list of dictionaries representing the sql result
     """
-    # NOTE mostly copypasta'd from mysql_execute, may be a better way
     try:
-        filename = config.get('database', 'filename')
-        init_db = not exists(filename)
-        connection = sqlite_connect(filename)
-        cursor = connection.cursor()
-        if init_db:
-            for sql in open('database.sql').read().split("\n"):
-                if sql != "" and sql is not None:
-                    cursor.execute(sql)
-                    connection.commit()
-        if params:
-            cursor.execute(command, params)
-        else:
-            cursor.execute(command)
-        connection.commit()
-        return cursor.fetchall()
-    except MySQLError as mysqlerror:
-        print("MySQL Error: %d: %s" %
-              (mysqlerror.args[0], mysqlerror.args[1]))
+        return pooled_execute(get_connection_pool(), command, params)
     except NoSectionError:
         print("Please configure the database")
-    finally:
-        try:
-            if connection:
-                connection.close()
-        except UnboundLocalError:
-            pass
 
 
 def mysql_execute(command, params=None):
@@ -109,26 +333,10 @@ def mysql_execute(command, params=None):
     getLogger("database").debug("mysql_execute(" + command + ", " + str(params)
                                 + ")", extra=get_sql_log_dict())
     try:
-        host = config.get('database', 'hostname')
-        user = config.get('database', 'username')
-        pawd = config.get('database', 'password')
-        dbse = config.get('database', 'database')
-        port = config.getint('database', 'port')
-        connection = mysql_connect(host=host, port=port, user=user,
-                                   passwd=pawd, db=dbse)
-        cursor = connection.cursor()
-        cursor.execute(command, params)
-        connection.commit()
-        return cursor.fetchall()
+        return pooled_execute(get_connection_pool(), command, params)
     except MySQLError as mysqlerror:
         print("MySQL Error: %d: %s" %
               (mysqlerror.args[0], mysqlerror.args[1]))
-    finally:
-        try:
-            if connection:
-                connection.close()
-        except UnboundLocalError:
-            pass
 
 
 def get_key_and_iv(localbox_path, user):
@@ -147,3 +355,46 @@ def get_key_and_iv(localbox_path, user):
             "cannot find key", extra={'ip': '', 'user': user, 'path': localbox_path})
         result = None
     return result
+
+
+def move_keys(user, from_path, to_path, keep=False):
+    """
+    Move the keys of a user for a localbox path, and for the paths below it,
+    to another path, after the files have been moved there; with keep, copy
+    them instead. This keeps moved and copied encrypted files decryptable.
+
+    :param user: name of the user whose keys to move
+    :param from_path: (localbox specific) path the files were moved from
+    :param to_path: (localbox specific) path the files were moved to
+    :param keep: whether to keep the keys for from_path (for a copy)
+    """
+    from_path = from_path.strip('/')
+    to_path = to_path.strip('/')
+    # the paths below from_path sort between from_path/ and from_path0
+    sql = "select path, key, iv from keys where user = ? and (path = ? or (path >= ? and path < ?))"
+    rows = database_execute(sql, (user, from_path, from_path + '/', from_path + chr(ord('/') + 1))) or []
+    with database_transaction():
+        # keys left behind at the destination (e.g. of files removed outside
+        # of the server) make way for those of the files moved there
+        for path, _, _ in rows:
+            database_execute("delete from keys where user = ? and path = ?", (user, to_path + path[len(from_path):]))
+        if keep:
+            for path, key, initvector in rows:
+                database_execute("insert into keys (path, user, key, iv) values (?, ?, ?, ?)",
+                                 (to_path + path[len(from_path):], user, key, initvector))
+        else:
+            for path, _, _ in rows:
+                database_execute("update keys set path = ? where user = ? and path = ?",
+                                 (to_path + path[len(from_path):], user, path))
+
+
+def delete_keys(user, localbox_path):
+    """
+    Delete the keys of a user for a localbox path and the paths below it.
+
+    :param user: name of the user whose keys to delete
+    :param localbox_path: (localbox specific) path of the removed files
+    """
+    localbox_path = localbox_path.strip('/')
+    sql = "delete from keys where user = ? and (path = ? or (path >= ? and path < ?))"
+    database_execute(sql, (user, localbox_path, localbox_path + '/', localbox_path + chr(ord('/') + 1)))
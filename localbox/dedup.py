@@ -0,0 +1,507 @@
+"""
+Deduplication of file contents. With the 'deduplicate' option of the
+filesystem section, every stored file refers to a blob in the server
+directory named after the SHA-256 digest of its contents, and the contents
+table records for every such file its digest and its own modification time.
+The number of rows with a digest is the reference count of its blob; blobs
+without references are removed in the background.
+
+How a file refers to its blob depends on the filesystem:
+
+* where it can share data blocks (extents) between files, such as btrfs and
+  XFS, the blob is a clone of the first file with its contents, and the
+  extents of later files with the same contents are shared with the blob
+  (FIDEDUPERANGE). Every file keeps its own inode and modification time.
+* elsewhere, e.g. on ext4, the file is replaced by a hard link to the blob.
+  Files with the same contents then share an inode, so their modification
+  time is read from the contents table (see get_modified_at in files), and
+  so is their ETag. This is safe because the server never writes to a
+  stored file: uploads are renamed over the old one.
+
+The digest of an upload is computed while it is received, so a hard link
+is made before the response is sent. Files whose digest is not known (e.g.
+committed upload sessions), and the comparison of contents that sharing
+extents takes, are handled by a background thread.
+"""
+from errno import EEXIST
+from errno import ENOENT
+from hashlib import sha256
+from logging import getLogger
+from os import close
+from os import fstat
+from os import link
+from os import O_RDONLY
+from os import O_RDWR
+from os import open as os_open
+from os import remove
+from os import rename
+from os import stat
+from os import walk
+from os.path import dirname
+from os.path import exists
+from os.path import islink
+from os.path import join
+from os.path import realpath
+from os.path import sep
+from struct import pack
+from struct import unpack_from
+from threading import Lock
+from threading import Thread
+from time import time
+from uuid import uuid4
+
+try:
+    from Queue import Empty  # pylint: disable=F0401
+    from Queue import Queue  # pylint: disable=F0401
+except ImportError:
+    from queue import Empty  # pylint: disable=F0401
+    from queue import Queue  # pylint: disable=F0401
+
+try:
+    from fcntl import ioctl
+except ImportError:
+    ioctl = None
+
+from localbox import config
+from localbox.database import database_execute
+from localbox.database import database_transaction
+from localbox.files import FICLONE
+from localbox.files import get_server_directory
+from localbox.files import invalidate_metadata
+from localbox.files import path_validator
+from localbox.utils import get_logging_empty_extra
+
+#: directory (below the server directory) holding the blobs
+BLOBS_DIRECTORY = 'blobs'
+#: prefix of the temporary names used while replacing a file by its blob
+TEMPORARY_PREFIX = '.lbdedup-'
+#: ioctl sharing the extents of a range of one file with other files
+FIDEDUPERANGE = 0xC0189436
+#: struct file_dedupe_range with one struct file_dedupe_range_info
+DEDUPE_RANGE_FORMAT = '=QQHHIqQQiI'
+#: maximum number of bytes shared per ioctl (btrfs does not do more)
+DEDUPE_BLOCK_SIZE = 16 * 1024 * 1024
+#: number of bytes read at once when hashing a file
+HASH_BLOCK_SIZE = 1024 * 1024
+#: seconds between removals of unused blobs by a process
+COLLECT_INTERVAL = 3600
+
+
+def deduplication_enabled():
+    """
+    :returns: whether stored files are deduplicated
+    """
+    return config.getboolean('filesystem', 'deduplicate', default=False)
+
+
+def get_blob_path(digest):
+    """
+    :param digest: hexadecimal SHA-256 digest of the contents of a blob
+    :returns: the path of the blob
+    """
+    return join(get_server_directory(BLOBS_DIRECTORY, digest[:2]), digest)
+
+
+def get_contents_path(filesystem_path):
+    """
+    :param filesystem_path: path of a file or directory
+    :returns: the path under which the contents table knows it (and the
+              files below it), or None for a symlink, whose removal or move
+              leaves the files it points to alone
+    """
+    if islink(filesystem_path):
+        return None
+    return realpath(filesystem_path)
+
+
+def forget_contents(contents_path):
+    """
+    Remove the contents table rows of a removed file or directory tree.
+
+    :param contents_path: its path as returned by get_contents_path before
+                          the removal; None does nothing
+    """
+    if contents_path is None:
+        return
+    prefix = contents_path.rstrip(sep) + sep
+    database_execute('delete from contents where path = ? or substr(path, 1, ?) = ?',
+                     (contents_path, len(prefix), prefix))
+
+
+def move_contents(from_path, to_path):
+    """
+    Update the contents table rows of a moved file or directory tree.
+
+    :param from_path: its path as returned by get_contents_path before the
+                      move; None does nothing
+    :param to_path: the path it has been moved to
+    """
+    if from_path is None:
+        return
+    to_path = realpath(to_path)
+    prefix = from_path.rstrip(sep) + sep
+    with database_transaction():
+        rows = database_execute('select path from contents where path = ? or substr(path, 1, ?) = ?',
+                                (from_path, len(prefix), prefix)) or []
+        for path, in rows:
+            database_execute('update contents set path = ? where path = ?',
+                             (to_path + path[len(from_path):], path))
+
+
+def hash_file(fileobj):
+    """
+    :param fileobj: file opened in binary mode
+    :returns: hexadecimal SHA-256 digest of the contents of the file
+    """
+    digest = sha256()
+    block = fileobj.read(HASH_BLOCK_SIZE)
+    while block:
+        digest.update(block)
+        block = fileobj.read(HASH_BLOCK_SIZE)
+    return digest.hexdigest()
+
+
+def share_extents(source, target):
+    """
+    Have target use the extents of source, when both have the same contents.
+    Neither the inode nor the modification time of target change.
+
+    :param source: path of the file whose extents to share
+    :param target: path of the file to deduplicate
+    :returns: whether all extents are shared; False when the contents (or
+              sizes) differ or source does not exist
+    :raises OSError: when the filesystem cannot share extents
+    """
+    try:
+        source_fd = os_open(source, O_RDONLY)
+    except OSError as error:
+        if error.errno == ENOENT:
+            return False
+        raise
+    try:
+        # the kernel requires the target to be writable
+        target_fd = os_open(target, O_RDWR)
+        try:
+            size = fstat(source_fd).st_size
+            if size == 0 or fstat(target_fd).st_size != size:
+                return False
+            offset = 0
+            while offset < size:
+                request = bytearray(pack(DEDUPE_RANGE_FORMAT, offset, min(DEDUPE_BLOCK_SIZE, size - offset),
+                                         1, 0, 0, target_fd, offset, 0, 0, 0))
+                ioctl(source_fd, FIDEDUPERANGE, request, True)
+                shared, status = unpack_from('=Qi', request, 40)
+                if status < 0:
+                    raise OSError(-status, "cannot share the extents of %s" % source)
+                # status 1 means the contents differ
+                if status != 0 or shared == 0:
+                    return False
+                offset += shared
+            return True
+        finally:
+            close(target_fd)
+    finally:
+        close(source_fd)
+
+
+def link_blob(blob, filesystem_path, validator):
+    """
+    Replace a file by a hard link to a blob with the same contents, unless
+    the file has been replaced since it was stored. The file is moved aside
+    first, so a newer file stored meanwhile is never overwritten; for that
+    moment, the path does not exist.
+
+    :param blob: path of the blob
+    :param filesystem_path: path of the file to replace
+    :param validator: path_validator of the file as it was stored
+    :returns: whether the file has been replaced; False when the blob does
+              not exist (anymore) or the file has changed
+    """
+    directory = dirname(filesystem_path)
+    linked = join(directory, TEMPORARY_PREFIX + uuid4().hex)
+    moved = join(directory, TEMPORARY_PREFIX + uuid4().hex)
+    try:
+        link(blob, linked)
+    except OSError as error:
+        if error.errno == ENOENT:
+            return False
+        raise
+    try:
+        try:
+            rename(filesystem_path, moved)
+        except OSError as error:
+            if error.errno == ENOENT:
+                return False
+            raise
+        unchanged = path_validator(stat(moved)) == validator
+        try:
+            # link fails rather than overwrite a file stored meanwhile
+            link(linked if unchanged else moved, filesystem_path)
+        except OSError as error:
+            if error.errno != EEXIST:
+                raise
+            return False
+        return unchanged
+    finally:
+        for path in (linked, moved):
+            if exists(path):
+                remove(path)
+
+
+def deduplicate(filesystem_path, digest=None, statstruct=None):
+    """
+    Have a newly stored file refer to the blob of its contents. When its
+    digest is known and the filesystem cannot share extents, the file is
+    replaced by a hard link to the blob right away; otherwise this is done
+    in the background. The row of the file it replaced is removed from the
+    contents table, also when deduplication is disabled.
+
+    :param filesystem_path: path of the file
+    :param digest: hexadecimal SHA-256 digest of its contents, computed
+                   while it was received; None to compute it in the
+                   background
+    :param statstruct: stat of the file as it was stored, None to stat it now
+    """
+    path = realpath(filesystem_path)
+    database_execute('delete from contents where path = ?', (path,))
+    if not deduplication_enabled():
+        return
+    try:
+        if statstruct is None:
+            statstruct = stat(path)
+        deduplicator = Deduplicator()
+        if digest is not None and not deduplicator.shares_extents():
+            deduplicator.store(path, digest, statstruct)
+        else:
+            deduplicator.add(path, digest, statstruct)
+    except (IOError, OSError) as error:
+        getLogger('files').warning("cannot deduplicate %s: %s" % (filesystem_path, error),
+                                   extra=get_logging_empty_extra())
+
+
+def start_deduplication():
+    """
+    Have the unused blobs left by an earlier run of the server removed in
+    the background. Does nothing unless deduplication is enabled.
+    """
+    if deduplication_enabled():
+        Deduplicator().start()
+
+
+class Deduplicator(object):
+    """
+    Singleton having files refer to the blobs of their contents (see
+    deduplicate), and removing blobs without references every
+    COLLECT_INTERVAL seconds, in a background thread. The thread is started
+    when there is something to deduplicate.
+    """
+    _instance = None
+
+    def __new__(cls, *args, **kwargs):
+        if not cls._instance:
+            cls._instance = super(Deduplicator, cls).__new__(cls)
+        return cls._instance
+
+    def __init__(self):
+        if not hasattr(self, 'queue'):
+            self.queue = Queue()
+            self.lock = Lock()
+            self.thread = None
+            self.extents = None
+            self.collected_at = 0
+
+    def shares_extents(self):
+        """
+        :returns: whether the filesystem of the blobs can share extents
+                  between files; found out by cloning a file once
+        """
+        if self.extents is None:
+            directory = get_server_directory(BLOBS_DIRECTORY)
+            source = join(directory, TEMPORARY_PREFIX + uuid4().hex)
+            target = join(directory, TEMPORARY_PREFIX + uuid4().hex)
+            try:
+                with open(source, 'wb') as fileobj:
+                    fileobj.write(b'localbox')
+                with open(source, 'rb') as infile, open(target, 'wb') as outfile:
+                    ioctl(outfile.fileno(), FICLONE, infile.fileno())
+                self.extents = True
+            except (IOError, OSError, TypeError):
+                # TypeError: no ioctl on this platform
+                self.extents = False
+            finally:
+                for path in (source, target):
+                    if exists(path):
+                        remove(path)
+        return self.extents
+
+    def add(self, filesystem_path, digest, statstruct):
+        """
+        Schedule a file for deduplication.
+
+        :param filesystem_path: real path of the file
+        :param digest: digest of its contents, None when not known yet
+        :param statstruct: stat of the file as it was stored
+        """
+        self.queue.put((filesystem_path, digest, statstruct))
+        self.start()
+
+    def start(self):
+        """
+        Start the thread, unless it runs already.
+        """
+        with self.lock:
+            # the thread of a parent process does not survive a fork
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = Thread(target=self.run, name='deduplicator')
+                self.thread.daemon = True
+                self.thread.start()
+
+    def run(self):
+        """
+        Deduplicate the scheduled files, and remove the unused blobs,
+        forever.
+        """
+        while True:
+            try:
+                item = self.queue.get(timeout=COLLECT_INTERVAL)
+            except Empty:
+                item = None
+            try:
+                if item is not None:
+                    self.store(*item)
+                if time() - self.collected_at > COLLECT_INTERVAL:
+                    self.collected_at = time()
+                    self.collect()
+            except Exception as error:  # pylint: disable=W0703
+                getLogger('files').exception("cannot deduplicate %s: %s" % (item and item[0], error),
+                                             extra=get_logging_empty_extra())
+
+    def store(self, filesystem_path, digest, statstruct):
+        """
+        Have a file refer to the blob of its contents, creating the blob from
+        the file when there is none, and record it in the contents table.
+        Nothing is done when the file has been replaced since it was stored.
+
+        :param filesystem_path: real path of the file
+        :param digest: digest of its contents, None to compute it
+        :param statstruct: stat of the file as it was stored
+        """
+        validator = path_validator(statstruct)
+        if digest is None:
+            try:
+                with open(filesystem_path, 'rb') as fileobj:
+                    if path_validator(fstat(fileobj.fileno())) != validator:
+                        return
+                    digest = hash_file(fileobj)
+            except (IOError, OSError) as error:
+                if error.errno == ENOENT:
+                    return
+                raise
+        # recorded before the blob is used, so it is not collected meanwhile
+        database_execute('replace into contents (path, digest, modified_at) values (?, ?, ?)',
+                         (filesystem_path, digest, statstruct.st_mtime))
+        stored = False
+        try:
+            stored = self.store_blob(filesystem_path, digest, validator)
+        finally:
+            if not stored and not self.is_current(filesystem_path, validator):
+                database_execute('delete from contents where path = ? and digest = ? and modified_at = ?',
+                                 (filesystem_path, digest, statstruct.st_mtime))
+
+    def store_blob(self, filesystem_path, digest, validator):
+        """
+        :param filesystem_path: real path of the file
+        :param digest: digest of its contents
+        :param validator: path_validator of the file as it was stored
+        :returns: whether the file refers to the blob of its contents
+        """
+        blob = get_blob_path(digest)
+        if self.shares_extents():
+            if not exists(blob) and self.clone_blob(filesystem_path, validator, blob):
+                return True
+            return share_extents(blob, filesystem_path)
+        # a blob can be created or collected meanwhile; try again once
+        for _ in range(2):
+            if exists(blob):
+                if stat(blob).st_ino == stat(filesystem_path).st_ino:
+                    return True
+                if link_blob(blob, filesystem_path, validator):
+                    invalidate_metadata(filesystem_path)
+                    return True
+                if not self.is_current(filesystem_path, validator):
+                    return False
+            try:
+                link(filesystem_path, blob)
+            except OSError as error:
+                if error.errno != EEXIST:
+                    raise
+                continue
+            if path_validator(stat(blob)) != validator:
+                # the file was replaced just before; its contents differ
+                remove(blob)
+                return False
+            return True
+        return False
+
+    @staticmethod
+    def clone_blob(filesystem_path, validator, blob):
+        """
+        Create a blob as a clone of a file, which shares its extents.
+
+        :param filesystem_path: real path of the file
+        :param validator: path_validator of the file as it was stored
+        :param blob: path of the blob
+        :returns: whether the blob has been created; False when the file has
+                  changed or the blob has been created meanwhile
+        """
+        cloned = join(dirname(blob), TEMPORARY_PREFIX + uuid4().hex)
+        try:
+            with open(filesystem_path, 'rb') as infile:
+                if path_validator(fstat(infile.fileno())) != validator:
+                    return False
+                with open(cloned, 'wb') as outfile:
+                    ioctl(outfile.fileno(), FICLONE, infile.fileno())
+            link(cloned, blob)
+            return True
+        except OSError as error:
+            if error.errno != EEXIST:
+                raise
+            return False
+        finally:
+            if exists(cloned):
+                remove(cloned)
+
+    @staticmethod
+    def is_current(filesystem_path, validator):
+        """
+        :param filesystem_path: path of a file
+        :param validator: path_validator of the file as it was stored
+        :returns: whether the file is still the one that was stored
+        """
+        try:
+            return path_validator(stat(filesystem_path)) == validator
+        except OSError:
+            return False
+
+    @staticmethod
+    def collect():
+        """
+        Remove the blobs to which no row of the contents table refers.
+        """
+        started = time()
+        removed = 0
+        for directory, _, names in walk(get_server_directory(BLOBS_DIRECTORY)):
+            for name in names:
+                if name.startswith(TEMPORARY_PREFIX):
+                    continue
+                if database_execute('select 1 from contents where digest = ? limit 1', (name,)):
+                    continue
+                try:
+                    remove(join(directory, name))
+                    removed += 1
+                except OSError as error:
+                    if error.errno != ENOENT:
+                        getLogger('files').warning("cannot remove blob %s: %s" % (name, error),
+                                                   extra=get_logging_empty_extra())
+        getLogger('files').info("removed %d unused blobs in %.1f seconds" % (removed, time() - started),
+                                extra=get_logging_empty_extra())
@@ -7,3 +7,29 @@ VERIFY_URL = 'http://%s:%d/verify' % (socket.gethostname(), LOAUTH_PORT)
 #: Loauth URL for validating authorization request
 REDIRECT_URL = 'http://%s:%s/loauth/' % (socket.gethostname(), LOAUTH_PORT)
 DIRECT_BACK_URL = 'http://%s' % socket.gethostname()
+#: number of seconds a verified authorization is cached
+CACHE_TIMEOUT = 600
+#: maximum number of authorizations in the cache
+CACHE_SIZE = 10000
+#: number of seconds a rejected (403) authorization is cached
+CACHE_NEGATIVE_TIMEOUT = 30
+#: number of seconds to wait for the Loauth verify URL
+VERIFY_TIMEOUT = 10
+#: number of idle connections to the Loauth verify URL kept open
+VERIFY_POOL_SIZE = 8
+#: maximum number of idle MySQL connections kept open per process
+DATABASE_POOL_SIZE = 16
+#: number of threads scanning the bindpoint for symlinks
+SCAN_THREADS = 8
+#: number of seconds file and directory metadata is cached
+METADATA_CACHE_TIMEOUT = 30
+#: maximum number of cached files and directory listings
+METADATA_CACHE_SIZE = 10000
+#: number of seconds changes are kept in the journal of changes
+CHANGES_RETENTION = 30 * 24 * 60 * 60
+#: number of seconds new journal entries are held back on MySQL
+CHANGES_SETTLE_TIME = 10
+#: number of threads copying the files of a directory tree
+COPY_THREADS = 8
+#: maximum number of entries removed from the trash per second, 0 for no limit
+DELETE_RATE = 2000
@@ -1,33 +1,86 @@
 """
 Encoding functions specific to localbox
 """
+from bisect import bisect_left
+from bisect import insort
+from errno import EXDEV
 from logging import getLogger
-from os import chdir
-from os import getcwd
+from os import fstat
+from os import listdir
+from os import mkdir
+from os import rename
 from os import stat
-from os import walk
 from os import remove
 from os.path import exists
 from os.path import abspath
+from os.path import dirname
 from os.path import isdir
+from os.path import isfile
 from os.path import islink
 from os.path import join
+from os.path import realpath
 from os.path import relpath
 from os.path import split
+from shutil import copyfileobj
+from shutil import rmtree
+from stat import S_ISREG
 from sys import exit as sysexit
+from time import time
+from multiprocessing.pool import ThreadPool
+from threading import Lock
+from threading import Thread
 
+from localbox import config
+from localbox import defaults
+from localbox.cache import MetadataCache
 from localbox.database import database_execute
+from localbox.database import database_transaction
 from localbox.utils import get_bindpoint
 from localbox.utils import get_logging_empty_extra
 from loxcommon.os_utils import mkdir_p
 
 try:
     from os import readlink
+    from os import symlink
 except ImportError:
     def readlink(var):
         raise NotImplementedError(var)
+
+    def symlink(source, link_name):
+        raise NotImplementedError(link_name)
 from os import sep
 
+try:
+    from os import copy_file_range
+except ImportError:
+    copy_file_range = None
+
+try:
+    from fcntl import ioctl
+except ImportError:
+    ioctl = None
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir  # pylint: disable=F0401
+    except ImportError:
+        scandir = None
+
+#: name of the directory in the bindpoint holding data of the server itself
+SERVER_DIRECTORY = '.localbox'
+#: server_state entries counting the changes of the metadata and of the
+#: symlink index, by which worker processes notice the changes of the others
+METADATA_GENERATION = 'metadata_generation'
+SYMLINKS_GENERATION = 'symlinks_generation'
+
+# the generations the caches of this process are up to date with; empty
+# unless several worker processes serve requests, see share_caches
+_GENERATIONS = {}
+#: ioctl request making a copy-on-write clone of a file (Linux FICLONE)
+FICLONE = 0x40049409
+
 
 def get_filesystem_path(localbox_path, user):
     """
@@ -49,6 +102,22 @@ def get_filesystem_path(localbox_path, user):
     return filepath
 
 
+def get_server_directory(*parts):
+    """
+    Returns the path of a directory for data of the server itself (such as
+    upload sessions) and creates it when needed. It lives under the bindpoint,
+    so its files are on the same filesystem as those of the users and can be
+    renamed into place atomically.
+
+    :param parts: path components below the server directory
+    :returns: the filesystem path of the directory
+    """
+    path = join(get_bindpoint(), SERVER_DIRECTORY, *parts)
+    if not exists(path):
+        mkdir_p(path)
+    return path
+
+
 def get_bindpoint_user(user):
     return abspath(join(get_bindpoint(), user))
 
@@ -69,15 +138,126 @@ def get_key_path(user, localbox_path=None, filesystem_path=None):
     return get_localbox_path(filesystem_path, user)[1:].split('/')[0]
 
 
-def stat_reader(filesystem_path, user):
+#: maximum number of parameters in one 'in' clause (SQLite allows 999)
+KEY_QUERY_BATCH_SIZE = 500
+
+
+def get_paths_with_keys(user, keypaths):
+    """
+    Look up which of the given key paths have keys for a user, with one
+    query per KEY_QUERY_BATCH_SIZE paths instead of one query per path.
+
+    :param user: the user for which to look up the keys
+    :param keypaths: key paths (see get_key_path) to look up
+    :returns: the set of key paths that have keys
+    """
+    keypaths = list(set(keypaths))
+    found = set()
+    for start in range(0, len(keypaths), KEY_QUERY_BATCH_SIZE):
+        batch = keypaths[start:start + KEY_QUERY_BATCH_SIZE]
+        sql = 'select distinct path from keys where user=? and path in (%s);' % ', '.join('?' * len(batch))
+        result = database_execute(sql, tuple([user] + batch))
+        found.update(row[0] for row in result or [])
+    return found
+
+
+def get_metadata_cache():
+    """
+    Returns the metadata cache, configured by the 'metadata_timeout' and
+    'metadata_size' options of the cache section.
+
+    :returns: the MetadataCache singleton
+    """
+    return MetadataCache(timeout=int(config.get('cache', 'metadata_timeout', default=defaults.METADATA_CACHE_TIMEOUT)),
+                         max_size=int(config.get('cache', 'metadata_size', default=defaults.METADATA_CACHE_SIZE)))
+
+
+def path_validator(statstruct):
+    """
+    Derive the validator of cached metadata from the stat of a path. The
+    modification time of a directory changes when entries are added, removed
+    or renamed, which includes files written by (an upload to) the server,
+    as those are renamed into place.
+
+    :param statstruct: result of stat for the path
+    :returns: tuple identifying the version of the path
+    """
+    return (statstruct.st_dev, statstruct.st_ino,
+            getattr(statstruct, 'st_mtime_ns', statstruct.st_mtime), statstruct.st_size)
+
+
+def get_modified_at(filesystem_path, statstruct):
+    """
+    Return the modification time of a file. A deduplicated file which is a
+    hard link to a blob (see dedup) shares its inode with other files, so its
+    own modification time is the one recorded in the contents table.
+
+    :param filesystem_path: path of the file
+    :param statstruct: result of stat for the path
+    :returns: the modification time, in seconds since the epoch
+    """
+    if statstruct.st_nlink > 1 and S_ISREG(statstruct.st_mode):
+        result = database_execute('select modified_at from contents where path = ?', (realpath(filesystem_path),))
+        if result and result[0][0] is not None:
+            return result[0][0]
+    return statstruct.st_mtime
+
+
+def invalidate_metadata(filesystem_path, recursive=False):
+    """
+    Remove the cached metadata of a path and the listings of the directories
+    above it, for every user; called after the path has been written,
+    removed or got (or lost) keys or shares. The listings of all ancestors
+    are removed, as every listing holds the modification times of its
+    subdirectories, which the validators of the listings do not cover; so
+    are those of the directories holding shares of an ancestor.
+
+    :param filesystem_path: the path that changed
+    :param recursive: whether to remove the cached metadata of everything
+                      below the path as well, e.g. for a removed directory
+    """
+    path = realpath(filesystem_path)
+    symlinks = SymlinkCache()
+    stale = set()
+    pending = [path]
+    while pending:
+        ancestor = pending.pop()
+        while ancestor not in stale:
+            stale.add(ancestor)
+            try:
+                pending.extend(realpath(dirname(link)) for link in list(symlinks.get(ancestor)))
+            except KeyError:
+                # not shared
+                pass
+            ancestor = dirname(ancestor)
+    get_metadata_cache().invalidate(stale, below=path if recursive else None)
+    count_change(METADATA_GENERATION)
+
+
+def stat_reader(filesystem_path, user, has_keys=None):
     """
     Return metadata for the given (filesystem) path based on information
-    provided by the stat system call.
+    provided by the stat system call. The result is cached for as long as
+    the path is not changed, see get_metadata_cache.
 
     :param filesystem_path: a path referring to the file to stat
     :param user: the user for which to return the info
+    :param has_keys: whether the path has keys, when already known; looked up
+                     in the database otherwise
     :returns: a dictionary of metadata for the filesystem path given
     """
+    try:
+        statstruct = stat(filesystem_path)
+    except OSError:
+        return None
+    cache = get_metadata_cache() if has_keys is None else None
+    key = ('stat', user, abspath(filesystem_path))
+    validator = path_validator(statstruct)
+    if cache is not None:
+        statdict = cache.get(key, validator)
+        if statdict is not None:
+            return dict(statdict)
+
     getLogger(__name__).debug('read stats for file: %s' % filesystem_path,
                               extra=get_logging_empty_extra())
     bindpath_user = get_bindpoint_user(user)
@@ -88,20 +268,16 @@ def stat_reader(filesystem_path, user):
             item for item in split(filesystem_path) if item != ''][-1]
 
     localboxpath = get_localbox_path(filesystem_path, user)
-    keypath = get_key_path(user, filesystem_path=filesystem_path)
-
-    sql = 'select 1 from keys where path=? and user=?;'
-    result = database_execute(sql, ('%s' % keypath, user))
-    has_keys = True if result and len(result) > 0 else  False
+    if has_keys is None:
+        keypath = get_key_path(user, filesystem_path=filesystem_path)
+        sql = 'select 1 from keys where path=? and user=?;'
+        result = database_execute(sql, ('%s' % keypath, user))
+        has_keys = True if result and len(result) > 0 else  False
 
-    try:
-        statstruct = stat(filesystem_path)
-    except OSError:
-        return None
     statdict = {
         'title': title,
         'is_dir': isdir(filesystem_path),
-        'modified_at': statstruct.st_mtime,
+        'modified_at': get_modified_at(filesystem_path, statstruct),
         'is_share': SymlinkCache().exists(abspath(filesystem_path)),
         'is_shared': islink(abspath(filesystem_path)),
         'has_keys': has_keys,
@@ -113,9 +289,309 @@ def stat_reader(filesystem_path, user):
         statdict['icon'] = 'File'
     # if isdir(filesystem_path):
     #    statdict['hash'] = 'TODO'
+    if cache is not None:
+        cache.add(key, validator, realpath(filesystem_path), statdict)
+        return dict(statdict)
     return statdict
 
 
+class ListdirEntry(object):
+    """
+    Minimal stand-in for os.DirEntry on pythons without scandir.
+    """
+
+    def __init__(self, directory, name):
+        self.name = name
+        self.path = join(directory, name)
+
+    def is_dir(self, follow_symlinks=True):
+        if not follow_symlinks and islink(self.path):
+            return False
+        return isdir(self.path)
+
+    def is_symlink(self):
+        return islink(self.path)
+
+    def stat(self):
+        return stat(self.path)
+
+
+def iterate_directory(filesystem_path):
+    """
+    :param filesystem_path: path of the directory to read
+    :returns: iterable of DirEntry-like objects for the directory entries
+    """
+    if scandir is not None:
+        return scandir(filesystem_path)
+    return [ListdirEntry(filesystem_path, name) for name in listdir(filesystem_path)]
+
+
+def entry_is_dir(entry):
+    """
+    :param entry: a DirEntry
+    :returns: whether the entry is a directory, following symlinks
+    """
+    try:
+        return entry.is_dir()
+    except OSError:
+        return False
+
+
+#: orders in which list_directory can sort the children of a directory
+LISTING_ORDERS = {
+    'type': lambda child: (not child['is_dir'], child['title']),
+    'name': lambda child: child['title'],
+    'modified': lambda child: child['modified_at'],
+}
+
+
+def entry_reader(entry, directory, localbox_directory, has_keys):
+    """
+    Return the metadata of a directory entry, like stat_reader, but reusing
+    the information scandir already obtained.
+
+    :param entry: the DirEntry of the child
+    :param directory: absolute filesystem path of the directory of the entry
+    :param localbox_directory: localbox path of the directory of the entry
+    :param has_keys: whether the entry has keys
+    :returns: a dictionary of metadata for the entry, or None when it cannot
+              be stat'ed (e.g. a dangling symlink)
+    """
+    try:
+        statstruct = entry.stat()
+    except OSError:
+        return None
+    is_dir = entry_is_dir(entry)
+    return {
+        'title': entry.name,
+        'is_dir': is_dir,
+        'modified_at': get_modified_at(join(directory, entry.name), statstruct),
+        'is_share': SymlinkCache().exists(join(directory, entry.name)),
+        'is_shared': entry.is_symlink(),
+        'has_keys': has_keys,
+        'path': localbox_directory.rstrip('/') + '/' + entry.name,
+        'icon': 'Folder' if is_dir else 'File',
+    }
+
+
+def read_children(directory, localbox_directory, user):
+    """
+    Return the metadata of the children of a directory, read in one pass over
+    the directory with scandir. Whether the children have keys is looked up
+    for all of them at once. The result is cached for as long as the
+    directory is not changed, see get_metadata_cache; it must not be
+    modified.
+
+    :param directory: absolute filesystem path of the directory
+    :param localbox_directory: localbox path of the directory
+    :param user: the user for which to return the info
+    :returns: list of dictionaries of metadata of the children, in no
+              particular order
+    """
+    # stat before reading, so changes made meanwhile invalidate the result
+    validator = path_validator(stat(directory))
+    cache = get_metadata_cache()
+    key = ('children', user, directory)
+    children = cache.get(key, validator)
+    if children is not None:
+        return children
+    entries = list(iterate_directory(directory))
+    if localbox_directory == '/':
+        keypaths = [entry.name for entry in entries]
+    else:
+        keypaths = [localbox_directory[1:].split('/')[0]] * len(entries)
+    with_keys = get_paths_with_keys(user, keypaths)
+    children = []
+    for entry, keypath in zip(entries, keypaths):
+        child = entry_reader(entry, directory, localbox_directory, keypath in with_keys)
+        if child is not None:
+            children.append(child)
+    cache.add(key, validator, realpath(directory), children)
+    return children
+
+
+def list_directory(filesystem_path, user, offset=0, limit=None, order='type', reverse=False):
+    """
+    Return the metadata of a directory with the metadata of its children in
+    'children' (see read_children). When offset or limit is given, only that
+    part of the sorted children is returned and 'total_children' holds the
+    number of children.
+
+    :param filesystem_path: a path referring to the directory to list
+    :param user: the user for which to return the info
+    :param offset: number of (sorted) children to skip
+    :param limit: maximum number of children to return, None for all
+    :param order: key of LISTING_ORDERS to sort the children by; 'type'
+                  lists directories before files
+    :param reverse: whether to sort in descending order
+    :returns: a dictionary of metadata for the directory, or None when it
+              cannot be read
+    """
+    dirdict = stat_reader(filesystem_path, user)
+    if dirdict is None:
+        return None
+    dirdict['children'] = []
+    if not dirdict['is_dir']:
+        return dirdict
+    children = sorted(read_children(abspath(filesystem_path), dirdict['path'], user),
+                      key=LISTING_ORDERS[order], reverse=reverse)
+    if offset or limit is not None:
+        dirdict['total_children'] = len(children)
+        children = children[offset:None if limit is None else offset + limit]
+    dirdict['children'] = [dict(child) for child in children]
+    return dirdict
+
+
+def walk_metadata(filesystem_path, user, depth=None, order='type', reverse=False):
+    """
+    Generate the metadata of a path and of everything below it, directory by
+    directory: all children of a directory (see read_children) follow each
+    other, after which its subdirectories are walked in turn. A directory
+    reached more than once (e.g. through shares) is only listed the first
+    time.
+
+    :param filesystem_path: a path referring to the file or directory to walk
+    :param user: the user for which to return the info
+    :param depth: number of levels below the path to include, None for all
+    :param order: key of LISTING_ORDERS to sort the children by
+    :param reverse: whether to sort in descending order
+    :returns: generator of metadata dictionaries (without 'children'); empty
+              when the path does not exist
+    """
+    statdict = stat_reader(filesystem_path, user)
+    if statdict is None:
+        return
+    yield statdict
+    pending = [(abspath(filesystem_path), statdict, 0)]
+    listed = set()
+    while pending:
+        directory, dirdict, level = pending.pop()
+        if not dirdict['is_dir'] or (depth is not None and level >= depth):
+            continue
+        real_directory = realpath(directory)
+        if real_directory in listed:
+            continue
+        listed.add(real_directory)
+        try:
+            children = sorted(read_children(directory, dirdict['path'], user),
+                              key=LISTING_ORDERS[order], reverse=reverse)
+        except OSError:
+            continue
+        for child in children:
+            yield dict(child)
+        pending.extend((join(directory, child['title']), child, level + 1)
+                       for child in reversed(children) if child['is_dir'])
+
+
+def is_below(path, directory):
+    """
+    :param path: a filesystem path
+    :param directory: a filesystem path
+    :returns: whether path is directory or below it, after resolving symlinks
+    """
+    path = realpath(path)
+    directory = realpath(directory)
+    return path == directory or path.startswith(directory.rstrip(sep) + sep)
+
+
+def copy_file(source, target):
+    """
+    Copy the contents of a file to a new file, as cheaply as the filesystem
+    allows: a copy-on-write clone (reflink) where supported, otherwise
+    copy_file_range, which copies within the kernel, and otherwise through
+    userspace.
+
+    :param source: path of the file to copy
+    :param target: path of the copy
+    """
+    with open(source, 'rb') as infile, open(target, 'wb') as outfile:
+        if ioctl is not None:
+            try:
+                ioctl(outfile.fileno(), FICLONE, infile.fileno())
+                return
+            except (IOError, OSError):
+                pass
+        if copy_file_range is not None:
+            remaining = fstat(infile.fileno()).st_size
+            try:
+                while remaining > 0:
+                    copied = copy_file_range(infile.fileno(), outfile.fileno(), remaining)
+                    if copied == 0:
+                        break
+                    remaining -= copied
+            except OSError:
+                # not supported here; the file positions tell where to go on
+                pass
+        copyfileobj(infile, outfile)
+
+
+def copy_tree(source, target):
+    """
+    Copy a file or directory tree. Symlinks are followed, so a copy of a
+    share holds its contents, except those pointing to a directory which is
+    being copied. The directories are created first; the files are then
+    copied by the 'copy_threads' threads of the filesystem section. When
+    copying fails, the partial copy is removed.
+
+    :param source: path of the file or directory to copy
+    :param target: path of the copy, which must not exist
+    """
+    if not isdir(source):
+        copy_file(source, target)
+        return
+    files = []
+    try:
+        mkdir(target)
+        pending = [(source, target, frozenset([realpath(source)]))]
+        while pending:
+            directory, copy, ancestors = pending.pop()
+            for entry in iterate_directory(directory):
+                path = join(directory, entry.name)
+                if entry_is_dir(entry):
+                    real_path = realpath(path)
+                    if real_path not in ancestors:
+                        mkdir(join(copy, entry.name))
+                        pending.append((path, join(copy, entry.name), ancestors | frozenset([real_path])))
+                elif isfile(path):
+                    files.append((path, join(copy, entry.name)))
+        threads = min(len(files), int(config.get('filesystem', 'copy_threads', default=defaults.COPY_THREADS)))
+        if threads > 1:
+            pool = ThreadPool(threads)
+            try:
+                pool.map(lambda pair: copy_file(*pair), files)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            for pair in files:
+                copy_file(*pair)
+    except (IOError, OSError):
+        rmtree(target, ignore_errors=True)
+        raise
+
+
+def move_tree(source, target):
+    """
+    Move a file or directory tree: a rename, unless source and target are on
+    different filesystems, in which case the tree is copied and removed.
+    Symlinks (shares) are kept up to date, see SymlinkCache.move.
+
+    :param source: path of the file or directory to move
+    :param target: path to move it to, which must not exist
+    """
+    try:
+        rename(source, target)
+    except OSError as error:
+        if error.errno != EXDEV:
+            raise
+        copy_tree(source, target)
+        if isdir(source) and not islink(source):
+            rmtree(source)
+        else:
+            remove(source)
+    SymlinkCache().move(source, target)
+
+
 def create_user_home(user):
     """
     Create user home directory (for storing LocalBox files), if necessary.
@@ -128,12 +604,205 @@ def create_user_home(user):
         mkdir_p(user_folder)
 
 
+def get_server_state(name):
+    """
+    :param name: name of a server_state entry
+    :returns: its value, or None when it has not been set
+    """
+    result = database_execute('select value from server_state where name = ?', (name,))
+    return result[0][0] if result else None
+
+
+def set_server_state(name, value):
+    """
+    :param name: name of a server_state entry
+    :param value: the value to store
+    """
+    database_execute('replace into server_state (name, value) values (?, ?)', (name, value))
+
+
+def share_caches():
+    """
+    Keep the caches (metadata and symlink index) of the worker processes
+    consistent: every change is counted in server_state (see count_change)
+    and a process seeing the count of another process change reloads its
+    caches before handling a request (see sync_caches). Called before
+    forking the worker processes.
+    """
+    for name in (METADATA_GENERATION, SYMLINKS_GENERATION):
+        if get_server_state(name) is None:
+            set_server_state(name, '0')
+        _GENERATIONS[name] = get_server_state(name)
+
+
+def count_change(name):
+    """
+    Count a change of the metadata or of the symlink index, after it has been
+    made on the filesystem and in the database, so the other worker
+    processes reload their caches. Does nothing without worker processes.
+
+    :param name: METADATA_GENERATION or SYMLINKS_GENERATION
+    """
+    if not _GENERATIONS:
+        return
+    previous = _GENERATIONS[name]
+    with database_transaction():
+        database_execute('update server_state set value = value + 1 where name = ?', (name,))
+        current = get_server_state(name)
+    # when no other process counted a change meanwhile, the caches of this
+    # one are up to date
+    if int(current) == int(previous) + 1:
+        _GENERATIONS[name] = current
+
+
+def sync_caches():
+    """
+    Reload the caches of this process when another worker process changed
+    the metadata or the symlink index. Called before handling a request.
+    """
+    if not _GENERATIONS:
+        return
+    current = dict(database_execute('select name, value from server_state where name in (?, ?)',
+                                    (METADATA_GENERATION, SYMLINKS_GENERATION)) or [])
+    if current.get(SYMLINKS_GENERATION) != _GENERATIONS[SYMLINKS_GENERATION]:
+        _GENERATIONS[SYMLINKS_GENERATION] = current.get(SYMLINKS_GENERATION)
+        SymlinkCache().reload()
+        # is_share is part of the metadata
+        _GENERATIONS[METADATA_GENERATION] = None
+    if current.get(METADATA_GENERATION) != _GENERATIONS[METADATA_GENERATION]:
+        _GENERATIONS[METADATA_GENERATION] = current.get(METADATA_GENERATION)
+        get_metadata_cache().clear()
+
+
+def get_link_destination(linkpath):
+    """
+    :param linkpath: absolute path of a possible symlink
+    :returns: absolute path the symlink points to, or None when linkpath is
+              not a symlink
+    """
+    try:
+        # relative links are relative to the directory of the link
+        return abspath(join(dirname(linkpath), readlink(linkpath)))
+    except OSError:
+        return None
+
+
+def scan_directory_symlinks(directory):
+    """
+    Find all symlinks in a directory tree, without following symlinks.
+
+    :param directory: absolute path of the directory to scan
+    :returns: list of (link, destination) tuples
+    """
+    found = []
+    pending = [directory]
+    while pending:
+        current = pending.pop()
+        try:
+            entries = list(iterate_directory(current))
+        except OSError as error:
+            getLogger('files').warning("cannot scan %s: %s" % (current, error), extra=get_logging_empty_extra())
+            continue
+        for entry in entries:
+            if entry.is_symlink():
+                linkpath = join(current, entry.name)
+                found.append((linkpath, get_link_destination(linkpath)))
+            elif entry.is_dir(follow_symlinks=False):
+                pending.append(join(current, entry.name))
+    return found
+
+
+def scan_symlinks(bindpoint):
+    """
+    Find all symlinks below the bindpoint. The top-level (user) directories
+    are scanned in parallel by the 'scan_threads' threads of the filesystem
+    section; the server directory is skipped.
+
+    :param bindpoint: directory to scan
+    :returns: dictionary mapping every symlink destination to the list of
+              symlinks pointing to it
+    """
+    started = time()
+    bindpoint = abspath(bindpoint)
+    found = []
+    directories = []
+    for entry in iterate_directory(bindpoint):
+        if entry.is_symlink():
+            linkpath = join(bindpoint, entry.name)
+            found.append((linkpath, get_link_destination(linkpath)))
+        elif entry.is_dir(follow_symlinks=False) and entry.name != SERVER_DIRECTORY:
+            directories.append(join(bindpoint, entry.name))
+    pool = ThreadPool(max(1, min(len(directories),
+                                 int(config.get('filesystem', 'scan_threads', default=defaults.SCAN_THREADS)))))
+    try:
+        for number, links in enumerate(pool.imap_unordered(scan_directory_symlinks, directories), 1):
+            found.extend(links)
+            if number % max(1, len(directories) // 10) == 0:
+                getLogger('files').info("scanned %d of %d directories for symlinks" % (number, len(directories)),
+                                        extra=get_logging_empty_extra())
+    finally:
+        pool.close()
+        pool.join()
+    destinations = {}
+    for linkpath, destpath in found:
+        destinations.setdefault(destpath, []).append(linkpath)
+    getLogger('files').info("found %d symlinks in %d directories in %.1f seconds" %
+                            (len(found), len(directories), time() - started), extra=get_logging_empty_extra())
+    return destinations
+
+
+def get_paths_below(sorted_paths, path):
+    """
+    Find path and the paths below it in a sorted list, in O(log n) plus the
+    number of results.
+
+    :param sorted_paths: sorted list of absolute paths
+    :param path: absolute path without trailing separator
+    :returns: list of the paths in sorted_paths equal to or below path
+    """
+    found = []
+    position = bisect_left(sorted_paths, path)
+    if position < len(sorted_paths) and sorted_paths[position] == path:
+        found.append(path)
+    # all paths starting with path + sep sort between it and path + the
+    # character following sep
+    start = bisect_left(sorted_paths, path + sep)
+    end = bisect_left(sorted_paths, path + chr(ord(sep) + 1))
+    found.extend(sorted_paths[start:end])
+    return found
+
+
+def remove_sorted(sorted_paths, path):
+    """
+    Remove a path from a sorted list of paths, if it is there.
+
+    :param sorted_paths: sorted list of paths
+    :param path: the path to remove
+    """
+    position = bisect_left(sorted_paths, path)
+    if position < len(sorted_paths) and sorted_paths[position] == path:
+        del sorted_paths[position]
+
+
 class SymlinkCache(object):
     """
-    Singleton keeping track of all symlinks (shares)
+    Singleton keeping track of all symlinks (shares). The index is kept in
+    memory and persisted in the symlinks table, so only the first start of
+    the server has to scan the filesystem. The handlers creating and removing
+    shares keep it up to date through add and remove. With the
+    'verify_symlinks' option of the filesystem section, the index is compared
+    with the filesystem in a background thread after startup.
+
+    In memory, 'cache' maps destinations to their links and 'links' maps
+    links to their destination; sorted lists of both make the lookup of
+    everything below a path (a user directory, a deleted folder) a binary
+    search instead of a scan of the whole index.
     """
     _instance = None
 
+    #: server_state entry telling the symlinks table holds the complete index
+    STATE_NAME = 'symlinks_indexed'
+
     def __new__(cls, *args, **kwargs):
         if not cls._instance:
             cls._instance = super(SymlinkCache, cls).__new__(
@@ -142,22 +811,72 @@ class SymlinkCache(object):
 
     def remove(self, absolute_filename):
         """
-        removes links to and from filename (from the cache)
+        Removes absolute_filename, and everything below it, from the cache.
+        Symlinks pointing to a removed destination are deleted from the
+        filesystem; removed symlinks are forgotten.
+
         :param absolute_filename: the file to remove from the cache
         """
-        if absolute_filename.endswith('/'):
-            absolute_filename = absolute_filename[:-1]
+        path = absolute_filename.rstrip(sep)
+        removed = []
+        destinations = []
+        with self.lock:
+            for destination in get_paths_below(self.destinations, path):
+                for link in list(self.cache[destination]):
+                    if islink(link):
+                        remove(link)
+                    self.forget(link)
+                    removed.append(link)
+            for link in get_paths_below(self.link_paths, path):
+                destinations.append(self.links[link])
+                self.forget(link)
+                removed.append(link)
+        # links and destinations are no longer shared
+        for changed in removed + destinations:
+            invalidate_metadata(changed)
+        if removed:
+            with database_transaction():
+                for link in removed:
+                    database_execute('delete from symlinks where link = ?', (link,))
+            count_change(SYMLINKS_GENERATION)
 
-        try:
-            # check if were are removing the parent of some links
-            map(lambda l: remove(l), self.cache[absolute_filename])
-            del self.cache[absolute_filename]
-        except KeyError:
-            # check if were are removing a link
-            for key, value in self.cache.items():
-                if absolute_filename in value:
-                    newvalue = value.remove(absolute_filename)
-                    self.cache[key] = newvalue
+    def move(self, source, target):
+        """
+        Update the cache after source has been moved to target: symlinks
+        below source are moved along, and symlinks pointing to source, or
+        below it, are pointed to the new location.
+
+        :param source: absolute path of the moved file or directory
+        :param target: absolute path it was moved to
+        """
+        source = source.rstrip(sep)
+        target = target.rstrip(sep)
+        with self.lock:
+            moved = []
+            for link in get_paths_below(self.link_paths, source):
+                moved.append((link, target + link[len(source):], self.links[link]))
+                self.forget(link)
+            for link, new_link, destination in moved:
+                self.index(new_link, destination)
+            repointed = []
+            for destination in get_paths_below(self.destinations, source):
+                for link in list(self.cache[destination]):
+                    self.index(link, target + destination[len(source):])
+                    repointed.append(link)
+            changed = dict((link, self.links[link]) for link in [entry[1] for entry in moved] + repointed)
+        for link in repointed:
+            if islink(link):
+                remove(link)
+                symlink(changed[link], link)
+            invalidate_metadata(link)
+        if moved or repointed:
+            with database_transaction():
+                for link, _, _ in moved:
+                    database_execute('delete from symlinks where link = ?', (link,))
+                for link, destination in changed.items():
+                    database_execute('replace into symlinks (link, destination) values (?, ?)',
+                                     (link, destination))
+            count_change(SYMLINKS_GENERATION)
 
     def exists(self, absolute_file_name):
         """
@@ -175,10 +894,12 @@ class SymlinkCache(object):
         :param from_file: absolute file name of the origin file
         :param to_file: absolute file name of the destination file
         """
-        if self.cache.get(from_file):
-            self.cache[from_file].append(to_file)
-        else:
-            self.cache[from_file] = [to_file]
+        with self.lock:
+            self.index(to_file, from_file)
+        database_execute('replace into symlinks (link, destination) values (?, ?)', (to_file, from_file))
+        count_change(SYMLINKS_GENERATION)
+        invalidate_metadata(from_file)
+        invalidate_metadata(to_file)
 
     def get(self, path):
         """
@@ -189,24 +910,128 @@ class SymlinkCache(object):
         """
         return self.cache[path]
 
+    def get_destination(self, link):
+        """
+        :param link: absolute path of a symlink
+        :returns: the destination of the symlink, or None when it is not known
+        """
+        return self.links.get(link)
+
+    def get_destinations_below(self, path):
+        """
+        :param path: absolute path, e.g. a user directory
+        :returns: the symlink destinations equal to or below path
+        """
+        with self.lock:
+            return get_paths_below(self.destinations, path.rstrip(sep))
+
+    def get_links_below(self, path):
+        """
+        :param path: absolute path, e.g. a user directory
+        :returns: the symlinks equal to or below path
+        """
+        with self.lock:
+            return get_paths_below(self.link_paths, path.rstrip(sep))
+
     def __init__(self, path=None):
         if not hasattr(self, 'cache'):
             getLogger().info("initialising SymlinkCache", extra={'user': None, 'ip': None, 'path': None})
-            self.cache = {}
-            self.build_cache(path)
+            self.lock = Lock()
+            self.clear()
+            self.loaded = path is None and bool(get_server_state(self.STATE_NAME))
+            if self.loaded:
+                self.load_index()
+            else:
+                self.build_cache(path)
             getLogger().info("initialised SymlinkCache", extra={'user': None, 'ip': None, 'path': None})
 
     def __iter__(self):
         for entry in set(self.cache.keys()):
             yield entry
 
+    def clear(self):
+        """
+        Empty the in-memory index.
+        """
+        self.cache = {}
+        self.links = {}
+        self.destinations = []
+        self.link_paths = []
+
+    def index(self, link, destination):
+        """
+        Add a symlink to the in-memory index; the caller holds the lock.
+
+        :param link: absolute path of the symlink
+        :param destination: absolute path the symlink points to
+        """
+        if self.links.get(link) == destination:
+            return
+        if link in self.links:
+            self.forget(link)
+        self.links[link] = destination
+        insort(self.link_paths, link)
+        if destination not in self.cache:
+            self.cache[destination] = []
+            insort(self.destinations, destination)
+        self.cache[destination].append(link)
+
+    def forget(self, link):
+        """
+        Remove a symlink from the in-memory index; the caller holds the lock.
+
+        :param link: absolute path of the symlink
+        """
+        destination = self.links.pop(link, None)
+        if destination is None:
+            return
+        remove_sorted(self.link_paths, link)
+        links = self.cache[destination]
+        links.remove(link)
+        if not links:
+            del self.cache[destination]
+            remove_sorted(self.destinations, destination)
+
+    def load_index(self):
+        """
+        Fill the cache from the symlinks table.
+        """
+        links = {}
+        cache = {}
+        for link, destination in database_execute('select link, destination from symlinks') or []:
+            links[link] = destination
+            cache.setdefault(destination, []).append(link)
+        # replace the index at once, so concurrent readers see the old or the
+        # new one
+        self.links = links
+        self.cache = cache
+        self.link_paths = sorted(links)
+        self.destinations = sorted(cache)
+
+    def reload(self):
+        """
+        Replace the in-memory index by the symlinks table, after another
+        worker process changed it.
+        """
+        with self.lock:
+            self.load_index()
+
+    def verify_in_background(self):
+        """
+        Start verify in a background thread when the 'verify_symlinks' option
+        of the filesystem section is set and the index has been loaded from
+        the database rather than built by scanning the filesystem.
+        """
+        if self.loaded and config.getboolean('filesystem', 'verify_symlinks', default=False):
+            Thread(target=self.verify, name='verify-symlinks').start()
+
     def build_cache(self, path=None):
         """
         Build the reverse symlink cache by walking through the filesystem and
         finding all symlinks and put them into a cache dictionary for reference
-        later.
+        later. When the whole bindpoint is scanned, the result is stored in the
+        symlinks table.
         """
-        working_directory = getcwd()
         if path is None:
             bindpoint = get_bindpoint()
             if bindpoint is None:
@@ -216,14 +1041,43 @@ class SymlinkCache(object):
                 sysexit(1)
         else:
             bindpoint = path
-        for dirname, directories, files in walk(bindpoint):
-            for entry in directories + files:
-                linkpath = abspath(join(dirname, entry))
-                if islink(linkpath):
-                    chdir(dirname)
-                    destpath = abspath(readlink(linkpath))
-                    if destpath in self.cache:
-                        self.cache[destpath].append(linkpath)
-                    else:
-                        self.cache[destpath] = [linkpath]
-        chdir(working_directory)
+        self.cache = scan_symlinks(bindpoint)
+        self.links = dict((link, destination) for destination, links in self.cache.items() for link in links)
+        self.link_paths = sorted(self.links)
+        self.destinations = sorted(self.cache)
+        if path is None:
+            with database_transaction():
+                database_execute('delete from symlinks')
+                for link, destination in self.links.items():
+                    database_execute('insert into symlinks (link, destination) values (?, ?)',
+                                     (link, destination))
+                set_server_state(self.STATE_NAME, '1')
+
+    def verify(self):
+        """
+        Compare the index with the symlinks on the filesystem and correct the
+        differences, both in memory and in the symlinks table. Differences
+        caused by shares created or removed during the scan are left alone.
+        """
+        scanned = scan_symlinks(get_bindpoint())
+        found = set((link, destination) for destination, links in scanned.items() for link in links)
+        with self.lock:
+            indexed = set(self.links.items())
+        missing = [entry for entry in found - indexed if get_link_destination(entry[0]) == entry[1]]
+        stale = [entry for entry in indexed - found if get_link_destination(entry[0]) != entry[1]]
+        with self.lock:
+            for link, destination in stale:
+                if self.links.get(link) == destination:
+                    self.forget(link)
+            for link, destination in missing:
+                self.index(link, destination)
+        if missing or stale:
+            with database_transaction():
+                for link, destination in stale:
+                    database_execute('delete from symlinks where link = ?', (link,))
+                for link, destination in missing:
+                    database_execute('replace into symlinks (link, destination) values (?, ?)',
+                                     (link, destination))
+            count_change(SYMLINKS_GENERATION)
+        getLogger('files').info("verified symlink index: %d missing, %d stale entries" % (len(missing), len(stale)),
+                                extra=get_logging_empty_extra())
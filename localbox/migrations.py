@@ -0,0 +1,211 @@
+"""
+Versioned schema migrations for the LocalBox database. The schema_version
+table records the migrations that have been applied; migrate() applies the
+missing ones in order. To change the schema, append a migration to
+MIGRATIONS; never edit one that has been released.
+"""
+from logging import getLogger
+
+#: Every migration is a tuple of its version, a description and the
+#: statements to execute, either one list for all database types or a dict
+#: with a list per database type ('sqlite' or 'mysql').
+MIGRATIONS = [
+    (1, 'initial tables', {
+        'sqlite': [
+            "CREATE TABLE IF NOT EXISTS shareitem (icon char(255), path char(255), has_keys boolean, "
+            "is_share boolean, is_shared boolean, modified_at datetime, title char(255), is_dir boolean)",
+            "CREATE TABLE IF NOT EXISTS shares (id integer primary key autoincrement, user char(255), "
+            "path char(255))",
+            "CREATE TABLE IF NOT EXISTS invitations (id INTEGER PRIMARY KEY AUTOINCREMENT, sender char(255), "
+            "receiver char(255), share_id int, state char(255), FOREIGN KEY (share_id) REFERENCES share(id))",
+            "CREATE TABLE IF NOT EXISTS users (name char(255), public_key char(255), private_key char(255))",
+            "CREATE TABLE IF NOT EXISTS keys (path char(255), user char(255), key char(255), iv char(255))",
+        ],
+        'mysql': [
+            "CREATE TABLE IF NOT EXISTS shareitem (icon char(255), path char(255), has_keys boolean, "
+            "is_share boolean, is_shared boolean, modified_at datetime, title char(255), is_dir boolean)",
+            "CREATE TABLE IF NOT EXISTS shares (id integer primary key auto_increment, user char(255), "
+            "path char(255))",
+            "CREATE TABLE IF NOT EXISTS invitations (id integer primary key auto_increment, sender char(255), "
+            "receiver char(255), share_id int, state char(255))",
+            "CREATE TABLE IF NOT EXISTS users (name char(255), public_key text, private_key text)",
+            "CREATE TABLE IF NOT EXISTS `keys` (path char(255), user char(255), `key` text, iv text)",
+        ],
+    }),
+    (2, 'indexes for the lookups done per request', {
+        'sqlite': [
+            "CREATE INDEX keys_user_path ON keys (user, path)",
+            "CREATE INDEX users_name ON users (name)",
+            "CREATE INDEX invitations_receiver_state ON invitations (receiver, state)",
+            "CREATE INDEX invitations_sender ON invitations (sender)",
+            "CREATE INDEX shares_user_path ON shares (user, path)",
+        ],
+        'mysql': [
+            "CREATE INDEX keys_user_path ON `keys` (user, path)",
+            "CREATE INDEX users_name ON users (name)",
+            "CREATE INDEX invitations_receiver_state ON invitations (receiver, state)",
+            "CREATE INDEX invitations_sender ON invitations (sender)",
+            "CREATE INDEX shares_user_path ON shares (user, path)",
+        ],
+    }),
+    (3, 'persistent symlink (share) index', {
+        'sqlite': [
+            "CREATE TABLE symlinks (link text NOT NULL PRIMARY KEY, destination text NOT NULL)",
+            "CREATE INDEX symlinks_destination ON symlinks (destination)",
+            "CREATE TABLE server_state (name char(64) NOT NULL PRIMARY KEY, value char(255))",
+        ],
+        'mysql': [
+            "CREATE TABLE symlinks (link varchar(700) NOT NULL PRIMARY KEY, destination varchar(700) NOT NULL)",
+            "CREATE INDEX symlinks_destination ON symlinks (destination)",
+            "CREATE TABLE server_state (name varchar(64) NOT NULL PRIMARY KEY, value varchar(255))",
+        ],
+    }),
+    (4, 'journal of changes for sync clients', {
+        'sqlite': [
+            "CREATE TABLE changes (id integer PRIMARY KEY AUTOINCREMENT, user char(255) NOT NULL, "
+            "type char(16) NOT NULL, path text NOT NULL, to_path text, changed_at real NOT NULL)",
+            "CREATE INDEX changes_user_id ON changes (user, id)",
+            "CREATE INDEX changes_changed_at ON changes (changed_at)",
+        ],
+        'mysql': [
+            "CREATE TABLE changes (id bigint PRIMARY KEY AUTO_INCREMENT, user varchar(255) NOT NULL, "
+            "type varchar(16) NOT NULL, path text NOT NULL, to_path text, changed_at double NOT NULL)",
+            "CREATE INDEX changes_user_id ON changes (user, id)",
+            "CREATE INDEX changes_changed_at ON changes (changed_at)",
+        ],
+    }),
+    (5, 'last expired journal entry per user', {
+        'sqlite': [
+            "CREATE TABLE changes_expired (user char(255) NOT NULL PRIMARY KEY, id integer NOT NULL)",
+        ],
+        'mysql': [
+            "CREATE TABLE changes_expired (user varchar(255) NOT NULL PRIMARY KEY, id bigint NOT NULL)",
+        ],
+    }),
+    (6, 'digests of stored file contents for deduplication', {
+        'sqlite': [
+            "CREATE TABLE contents (digest char(64) NOT NULL PRIMARY KEY, path text NOT NULL)",
+        ],
+        'mysql': [
+            "CREATE TABLE contents (digest char(64) NOT NULL PRIMARY KEY, path text NOT NULL)",
+        ],
+    }),
+    (7, 'deduplicated files with their blob and own modification time', {
+        'sqlite': [
+            "DROP TABLE contents",
+            "CREATE TABLE contents (path text NOT NULL PRIMARY KEY, digest char(64) NOT NULL, "
+            "modified_at real NOT NULL)",
+            "CREATE INDEX contents_digest ON contents (digest)",
+        ],
+        'mysql': [
+            "DROP TABLE contents",
+            "CREATE TABLE contents (path varchar(700) NOT NULL PRIMARY KEY, digest char(64) NOT NULL, "
+            "modified_at double NOT NULL)",
+            "CREATE INDEX contents_digest ON contents (digest)",
+        ],
+    }),
+    # Duplicate rows are removed first, keeping the one the server used:
+    # the first of a user's keys for a path, the first key pair of a user and
+    # the first share of a path by a user (invitations of the others are
+    # moved to it). The primary keys replace the indexes of migration 2.
+    # shareitem is not used and gets no key; invitations already have one.
+    (8, 'primary keys and unique constraints', {
+        'sqlite': [
+            "CREATE TABLE keys_unique (path char(255) NOT NULL, user char(255) NOT NULL, key char(255), "
+            "iv char(255), PRIMARY KEY (user, path))",
+            "INSERT INTO keys_unique (path, user, key, iv) SELECT path, user, key, iv FROM keys WHERE rowid IN "
+            "(SELECT min(rowid) FROM keys WHERE user IS NOT NULL AND path IS NOT NULL GROUP BY user, path)",
+            "DROP TABLE keys",
+            "ALTER TABLE keys_unique RENAME TO keys",
+            "CREATE TABLE users_unique (name char(255) NOT NULL PRIMARY KEY, public_key char(255), "
+            "private_key char(255))",
+            "INSERT INTO users_unique (name, public_key, private_key) SELECT name, public_key, private_key "
+            "FROM users WHERE rowid IN (SELECT min(rowid) FROM users WHERE name IS NOT NULL GROUP BY name)",
+            "DROP TABLE users",
+            "ALTER TABLE users_unique RENAME TO users",
+            "UPDATE invitations SET share_id = (SELECT min(first.id) FROM shares first JOIN shares share "
+            "ON first.user = share.user AND first.path = share.path WHERE share.id = invitations.share_id) "
+            "WHERE share_id IN (SELECT id FROM shares WHERE user IS NOT NULL AND path IS NOT NULL)",
+            "DELETE FROM shares WHERE user IS NOT NULL AND path IS NOT NULL AND id NOT IN "
+            "(SELECT min(id) FROM shares WHERE user IS NOT NULL AND path IS NOT NULL GROUP BY user, path)",
+            "DROP INDEX shares_user_path",
+            "CREATE UNIQUE INDEX shares_user_path ON shares (user, path)",
+        ],
+        'mysql': [
+            # numbers the rows in the order they were stored, to keep the first
+            "ALTER TABLE `keys` ADD COLUMN migration_id bigint NOT NULL AUTO_INCREMENT UNIQUE",
+            "DELETE FROM `keys` WHERE user IS NULL OR path IS NULL",
+            "DELETE duplicate FROM `keys` duplicate JOIN `keys` first ON first.user = duplicate.user "
+            "AND first.path = duplicate.path AND first.migration_id < duplicate.migration_id",
+            "ALTER TABLE `keys` DROP COLUMN migration_id, DROP INDEX keys_user_path, "
+            "MODIFY user char(255) NOT NULL, MODIFY path char(255) NOT NULL, ADD PRIMARY KEY (user, path)",
+            "ALTER TABLE users ADD COLUMN migration_id bigint NOT NULL AUTO_INCREMENT UNIQUE",
+            "DELETE FROM users WHERE name IS NULL",
+            "DELETE duplicate FROM users duplicate JOIN users first ON first.name = duplicate.name "
+            "AND first.migration_id < duplicate.migration_id",
+            "ALTER TABLE users DROP COLUMN migration_id, DROP INDEX users_name, "
+            "MODIFY name char(255) NOT NULL, ADD PRIMARY KEY (name)",
+            "UPDATE invitations JOIN shares share ON share.id = invitations.share_id "
+            "JOIN (SELECT user, path, min(id) AS id FROM shares GROUP BY user, path) first "
+            "ON first.user = share.user AND first.path = share.path SET invitations.share_id = first.id",
+            "DELETE duplicate FROM shares duplicate JOIN shares first ON first.user = duplicate.user "
+            "AND first.path = duplicate.path AND first.id < duplicate.id",
+            "DROP INDEX shares_user_path ON shares",
+            "CREATE UNIQUE INDEX shares_user_path ON shares (user, path)",
+        ],
+    }),
+]
+
+
+def get_schema_version(cursor):
+    """
+    Returns the version of the schema, creating the schema_version table if
+    the database does not have one yet.
+
+    :param cursor: cursor on the database
+    :returns: the highest applied migration version, 0 for a new database
+    """
+    cursor.execute("CREATE TABLE IF NOT EXISTS schema_version (version integer NOT NULL PRIMARY KEY)")
+    cursor.execute("SELECT max(version) FROM schema_version")
+    row = cursor.fetchone()
+    return row[0] if row and row[0] is not None else 0
+
+
+def get_statements(statements, dbtype):
+    """
+    :param statements: statements of a migration
+    :param dbtype: 'sqlite' or 'mysql'
+    :returns: the statements of the migration for this database type
+    """
+    if isinstance(statements, dict):
+        return statements[dbtype]
+    return statements
+
+
+def migrate(connection, dbtype, log_extra):
+    """
+    Bring the database schema up to date by applying the migrations newer
+    than its schema_version, each one committed with its version.
+
+    :param connection: connection to the database
+    :param dbtype: 'sqlite' or 'mysql'
+    :param log_extra: extra information for the log records
+    :returns: the schema version after migrating
+    """
+    cursor = connection.cursor()
+    version = get_schema_version(cursor)
+    connection.commit()
+    for migration_version, description, statements in MIGRATIONS:
+        if migration_version <= version:
+            continue
+        getLogger("database").info("applying database migration %d: %s" % (migration_version, description),
+                                   extra=log_extra)
+        for sql in get_statements(statements, dbtype):
+            cursor.execute(sql)
+        if dbtype == 'mysql':
+            cursor.execute("INSERT INTO schema_version (version) VALUES (%s)", (migration_version,))
+        else:
+            cursor.execute("INSERT INTO schema_version (version) VALUES (?)", (migration_version,))
+        connection.commit()
+        version = migration_version
+    return version
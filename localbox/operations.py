@@ -0,0 +1,246 @@
+"""
+File operations (create_folder, delete, move and copy) on the files of a
+user, shared by the handlers doing a single operation and the batch handler
+doing a list of them. Every operation returns a tuple of the HTTP status
+and its result: the metadata of the affected file, or an error message.
+"""
+from logging import getLogger
+from os import makedirs
+from os import remove
+from os.path import exists
+from os.path import dirname
+from os.path import isdir
+from os.path import islink
+from os.path import lexists
+from shutil import rmtree
+
+from localbox.changes import get_viewers
+from localbox.changes import record_change
+from localbox.database import database_transaction
+from localbox.database import delete_keys
+from localbox.database import move_keys
+from localbox.dedup import forget_contents
+from localbox.dedup import get_contents_path
+from localbox.dedup import move_contents
+from localbox.files import get_bindpoint_user
+from localbox.files import get_filesystem_path
+from localbox.files import get_key_path
+from localbox.files import copy_tree
+from localbox.files import invalidate_metadata
+from localbox.files import is_below
+from localbox.files import move_tree
+from localbox.files import stat_reader
+from localbox.files import SymlinkCache
+from localbox.trash import move_to_trash
+
+try:
+    STRING_TYPES = basestring  # pylint: disable=E0602
+except NameError:
+    STRING_TYPES = str
+
+#: maximum number of operations in one batch
+MAX_BATCH_OPERATIONS = 10000
+
+
+def change_keys(key_changes, filesystem_path, function, *arguments):
+    """
+    Change keys in the database now, or, during a batch, add the change to
+    the list of those made at the end of the batch (see run_batch).
+
+    :param key_changes: list of the key changes of a batch, None outside a
+                        batch
+    :param filesystem_path: path of the file or directory whose keys change
+    :param function: move_keys or delete_keys
+    :param arguments: the arguments for function
+    """
+    if key_changes is None:
+        function(*arguments)
+    else:
+        key_changes.append((filesystem_path, function, arguments))
+
+
+def create_folder(user, path, key_changes=None):
+    """
+    Create a directory.
+
+    :param user: the user doing the operation
+    :param path: localbox path of the directory to create
+    :param key_changes: unused; for the same signature as the others
+    :returns: tuple of the status and the metadata of the directory or an
+              error message
+    """
+    filepath = get_filesystem_path(path, user)
+    if lexists(filepath):
+        return 409, "Error: Something already exits at path"
+    makedirs(filepath)
+    invalidate_metadata(filepath)
+    record_change('create', filepath)
+    return 200, stat_reader(filepath, user)
+
+
+def delete_path(user, path, key_changes=None):
+    """
+    Remove a file or directory, with its keys and the shares of it. A
+    directory is moved to the trash and removed in the background.
+
+    :param user: the user doing the operation
+    :param path: localbox path of the file or directory to remove
+    :param key_changes: list of the key changes of a batch, see change_keys
+    :returns: tuple of the status and None or an error message
+    """
+    filepath = get_filesystem_path(path, user)
+    if not exists(filepath):
+        return 404, "Error: No file exits at path"
+    # shares below the path disappear with it
+    viewers = get_viewers(filepath, recursive=True)
+    contents_path = get_contents_path(filepath)
+    if isdir(filepath) and not islink(filepath):
+        try:
+            move_to_trash(user, filepath)
+        except OSError:
+            rmtree(filepath)
+    else:
+        remove(filepath)
+    forget_contents(contents_path)
+    change_keys(key_changes, filepath, delete_keys, user, get_key_path(user, localbox_path=path.lstrip('/')))
+    invalidate_metadata(filepath, recursive=True)
+    SymlinkCache().remove(filepath)
+    record_change('delete', filepath, viewers=viewers)
+    return 200, None
+
+
+def move_path(user, from_path, to_path, key_changes=None):
+    """
+    Move (rename) a file or directory, with its keys.
+
+    :param user: the user doing the operation
+    :param from_path: localbox path of the file or directory to move
+    :param to_path: localbox path to move it to
+    :param key_changes: list of the key changes of a batch, see change_keys
+    :returns: tuple of the status and the metadata of the moved file or
+              directory or an error message
+    """
+    move_from = get_filesystem_path(from_path, user)
+    move_to = get_filesystem_path(to_path, user)
+    if not lexists(move_from):
+        return 404, "Error: No file exits at from_path"
+    if lexists(move_to):
+        return 404, "Error: A file already exists at to_path"
+    if is_below(dirname(move_to), move_from):
+        return 400, "Error: Cannot move a folder into itself"
+    # users seeing both sides through a share may see no change at all
+    viewers = get_viewers(move_from)
+    contents_path = get_contents_path(move_from)
+    move_tree(move_from, move_to)
+    move_contents(contents_path, move_to)
+    change_keys(key_changes, move_to, move_keys, user, from_path, to_path)
+    invalidate_metadata(move_from, recursive=True)
+    invalidate_metadata(move_to, recursive=True)
+    record_change('move', move_from, move_to, viewers=viewers)
+    return 200, stat_reader(move_to, user)
+
+
+def copy_path(user, from_path, to_path, key_changes=None):
+    """
+    Copy a file or directory, with its keys.
+
+    :param user: the user doing the operation
+    :param from_path: localbox path of the file or directory to copy
+    :param to_path: localbox path of the copy
+    :param key_changes: list of the key changes of a batch, see change_keys
+    :returns: tuple of the status and the metadata of the copy or an error
+              message
+    """
+    copy_from = get_filesystem_path(from_path, user)
+    copy_to = get_filesystem_path(to_path, user)
+    if not exists(copy_from):
+        return 404, "Error: No file exits at from_path"
+    if lexists(copy_to):
+        return 404, "Error: A file already exists at to_path"
+    if is_below(dirname(copy_to), copy_from):
+        return 400, "Error: Cannot copy a folder into itself"
+    copy_tree(copy_from, copy_to)
+    change_keys(key_changes, copy_to, move_keys, user, from_path, to_path, True)
+    invalidate_metadata(copy_to)
+    record_change('create' if isdir(copy_to) else 'write', copy_to)
+    return 200, stat_reader(copy_to, user)
+
+
+#: the operations by name, with the names of their parameters
+OPERATIONS = {
+    'create_folder': (create_folder, ('path',)),
+    'delete': (delete_path, ('path',)),
+    'move': (move_path, ('from_path', 'to_path')),
+    'copy': (copy_path, ('from_path', 'to_path')),
+}
+
+
+def run_operation(user, operation, log_extra, key_changes=None):
+    """
+    Do an operation given as a dictionary with its name in 'op' and its
+    parameters (see OPERATIONS), e.g. {'op': 'delete', 'path': '/file'}.
+
+    :param user: the user doing the operation
+    :param operation: the operation
+    :param log_extra: 'extra' information for the logger
+    :param key_changes: list of the key changes of a batch, see change_keys
+    :returns: tuple of the status and the result of the operation; an
+              unknown operation or missing parameter gives a 400, an invalid
+              path a 404 and a failing filesystem operation a 500
+    """
+    try:
+        function, names = OPERATIONS[operation['op']]
+        arguments = [operation[name] for name in names]
+    except (KeyError, TypeError):
+        return 400, "Error: Unknown operation or missing parameter"
+    if not all(isinstance(argument, STRING_TYPES) for argument in arguments):
+        return 400, "Error: Paths must be strings"
+    getLogger('api').info("%s %s" % (operation['op'], ' '.join(arguments)), extra=log_extra)
+    try:
+        return function(user, *arguments, key_changes=key_changes)
+    except ValueError as error:
+        return 404, "Error: %s" % error
+    except (IOError, OSError) as error:
+        getLogger('api').error("%s failed: %s" % (operation['op'], error), extra=log_extra)
+        return 500, "Error: The operation failed"
+
+
+def run_batch(user, operations, stop_on_error, log_extra):
+    """
+    Do a list of operations in order. The filesystem work is done outside
+    any database transaction, so other requests can write to the database
+    meanwhile. The key changes of the moved, copied and removed files are
+    collected and made at the end in one short transaction, also when an
+    operation raises, so the keys follow the files that were moved.
+
+    :param user: the user doing the operations
+    :param operations: list of operations, see run_operation
+    :param stop_on_error: whether to skip the operations following one which
+                          failed
+    :param log_extra: 'extra' information for the logger
+    :returns: list of (status, result) tuples of the operations done
+    """
+    results = []
+    key_changes = []
+    try:
+        for operation in operations:
+            status, result = run_operation(user, operation, log_extra, key_changes)
+            results.append((status, result))
+            if stop_on_error and status != 200:
+                break
+    finally:
+        if key_changes:
+            with database_transaction():
+                for _, function, arguments in key_changes:
+                    function(*arguments)
+            for filesystem_path, _, _ in key_changes:
+                invalidate_metadata(filesystem_path, recursive=True)
+    # the metadata in the results was read before the keys changed
+    if key_changes:
+        home = get_bindpoint_user(user)
+        for _, result in results:
+            if isinstance(result, dict):
+                statdict = stat_reader(home + result['path'], user)
+                if statdict is not None:
+                    result['has_keys'] = statdict['has_keys']
+    return results
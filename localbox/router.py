@@ -0,0 +1,57 @@
+"""
+Request router for the LocalBox API. All routes are compiled into one
+regular expression, so finding the handler for a request is a single match
+instead of trying every route in turn.
+"""
+from re import compile as regex_compile
+from re import sub as regex_sub
+
+#: methods of routes which accept both GET and POST
+GET_POST = ('GET', 'POST')
+#: methods of routes which only accept POST
+POST = ('POST',)
+
+
+class Router(object):
+    """
+    Dispatches request paths to handler functions. Routes are given as
+    (pattern, methods, function) tuples; like re.match, a pattern only has to
+    match the start of the path and the first matching route wins. When that
+    route does not allow the method of the request, the response is a 405.
+    Named groups in a pattern are passed to the handler as route parameters.
+
+    The patterns are wrapped in a capturing group each and joined into one
+    alternation. The outer group of a route closes after all of its inner
+    groups, so the lastindex of a match tells which route matched.
+    """
+
+    def __init__(self, routes):
+        alternatives = []
+        self.targets = {}
+        group = 1
+        for pattern, methods, function in routes:
+            compiled = regex_compile(pattern)
+            parameters = dict((name, group + index) for name, index in compiled.groupindex.items())
+            self.targets[group] = (function, methods, parameters)
+            # the names would clash between routes; the numbers are known
+            alternatives.append('(' + regex_sub(r'\(\?P<\w+>', '(', pattern) + ')')
+            group += compiled.groups + 1
+        self.regex = regex_compile('|'.join(alternatives))
+
+    def resolve(self, method, path):
+        """
+        Find the handler for a request.
+
+        :param method: the HTTP method of the request
+        :param path: the path of the request, without query string
+        :returns: tuple of the handler function (None when there is none), the
+                  route parameters and the methods the matching route allows
+                  (empty when no route matches, so a 404 rather than a 405)
+        """
+        match = self.regex.match(path)
+        if match is None:
+            return None, {}, ()
+        function, methods, parameters = self.targets[match.lastindex]
+        if method not in methods:
+            return None, {}, methods
+        return function, dict((name, match.group(index)) for name, index in parameters.items()), methods
@@ -0,0 +1,312 @@
+"""
+HTTP server implementations for LocalBox. Next to the plain (serial)
+HTTPServer this module provides a server which hands accepted connections to
+a bounded pool of worker threads, and a pre-forking runner in which every
+worker process accepts connections on the shared listening socket.
+"""
+import os
+from errno import EINTR
+from logging import getLogger
+from signal import SIGTERM
+from signal import signal
+from threading import Thread
+from time import time
+
+from localbox import config
+from localbox.files import share_caches
+from localbox.tls import log_session_stats
+from localbox.utils import get_logging_empty_extra
+
+try:
+    from Queue import Queue  # pylint: disable=F0401
+except ImportError:
+    from queue import Queue  # pylint: disable=F0401
+
+try:
+    from BaseHTTPServer import HTTPServer
+except ImportError:
+    from http.server import HTTPServer  # pylint: disable=F0401
+
+try:
+    from multiprocessing import cpu_count
+except ImportError:
+    def cpu_count():
+        return 1
+
+#: number of worker threads per process when not configured
+DEFAULT_THREADS = 16
+#: number of seconds to wait for running requests on shutdown
+DEFAULT_DRAIN_TIMEOUT = 30
+#: number of seconds an idle keep-alive connection keeps a worker thread
+DEFAULT_KEEPALIVE_TIMEOUT = 15
+#: maximum number of requests handled on one keep-alive connection
+DEFAULT_KEEPALIVE_REQUESTS = 1000
+
+# servers (or, in the parent of a pre-forked server, worker pids) to stop when
+# a shutdown is requested
+_SERVERS = []
+_CHILDREN = []
+_SHUTDOWN = {'requested': False}
+
+
+class PooledHTTPServer(HTTPServer):
+    """
+    HTTPServer which handles requests in a fixed size pool of worker threads.
+    Accepted connections are put on a bounded queue; when all workers are
+    busy and the queue is full, the accept loop blocks until a worker is
+    available again, which gives back pressure instead of unbounded thread
+    creation.
+    """
+    # do not keep the process alive for stuck clients after a drain timeout
+    daemon_threads = True
+
+    def __init__(self, server_address, request_handler_class, pool_size=DEFAULT_THREADS):
+        HTTPServer.__init__(self, server_address, request_handler_class)
+        self.pool_size = pool_size
+        self.request_queue = Queue(maxsize=pool_size * 2)
+        self.workers = []
+
+    def start_workers(self):
+        """
+        Start the worker threads. This is not done in the constructor so a
+        server can be created before forking worker processes (threads do not
+        survive a fork).
+        """
+        for _ in range(self.pool_size):
+            worker = Thread(target=self.process_request_worker)
+            worker.daemon = self.daemon_threads
+            worker.start()
+            self.workers.append(worker)
+
+    def process_request(self, request, client_address):
+        """
+        Queue an accepted connection for the worker pool.
+        """
+        self.request_queue.put((request, client_address))
+
+    def process_request_worker(self):
+        """
+        Main loop of a worker thread: handle queued connections until the
+        sentinel (None) is received.
+        """
+        while True:
+            item = self.request_queue.get()
+            if item is None:
+                return
+            request, client_address = item
+            try:
+                self.finish_request(request, client_address)
+            except Exception:  # pylint: disable=W0703
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+    def drain(self, timeout=None):
+        """
+        Let the workers finish the queued and running requests, then stop
+        them. Must be called after serve_forever has returned.
+
+        :param timeout: maximum number of seconds to wait for all workers
+        """
+        for _ in self.workers:
+            self.request_queue.put(None)
+        deadline = None if timeout is None else time() + timeout
+        for worker in self.workers:
+            worker.join(None if deadline is None else max(deadline - time(), 0))
+        self.workers = []
+
+
+def signal_children(signum):
+    """
+    Pass a signal on to the worker processes, if any.
+
+    :param signum: the signal to send
+    """
+    for pid in _CHILDREN:
+        try:
+            os.kill(pid, signum)
+        except OSError:
+            pass
+
+
+def terminate_handler(signum, frame):  # pylint: disable=W0613
+    """
+    SIGTERM handler of a worker process, with which the parent process asks
+    for a graceful shutdown (see shutdown). It is ignored when the worker
+    process is shutting down already, e.g. after a SIGINT from the terminal.
+    """
+    shutdown()
+
+
+def shutdown_requested():
+    """
+    :returns: whether this process is shutting down, in which case
+              connections are not kept open for further requests
+    """
+    return _SHUTDOWN['requested']
+
+
+def get_worker_config():
+    """
+    Reads the concurrency settings from the httpd section of the
+    configuration. 'workers' is either 'single' (serial handling, the old
+    behaviour), 'threaded' (one process with a thread pool), 'processes' (one
+    process per CPU core) or a number of processes. 'threads' is the size of
+    the thread pool in each process.
+
+    :returns: tuple of (number of processes, number of threads per process);
+              zero threads means serial handling
+    """
+    workers = str(config.get('httpd', 'workers', default='threaded')).strip().lower()
+    threads = int(config.get('httpd', 'threads', default=DEFAULT_THREADS))
+    if workers == 'single':
+        return 1, 0
+    if workers == 'threaded':
+        return 1, threads
+    if workers == 'processes':
+        return cpu_count(), threads
+    try:
+        processes = int(workers)
+    except ValueError:
+        getLogger(__name__).error("Unknown value '%s' for httpd workers, using 'threaded'" % workers,
+                                  extra=get_logging_empty_extra())
+        return 1, threads
+    return max(processes, 1), threads
+
+
+def create_server(server_address, request_handler_class):
+    """
+    Create the HTTP server for the configured front end ('frontend' in the
+    httpd section: 'basehttpserver' or 'asyncio') and concurrency mode.
+
+    :param server_address: (host, port) tuple to bind to
+    :param request_handler_class: class handling the individual requests for
+                                  the BaseHTTPServer front end
+    :returns: the (bound, not yet serving) server
+    """
+    frontend = str(config.get('httpd', 'frontend', default='basehttpserver')).strip().lower()
+    if frontend == 'asyncio':
+        from localbox.aio import AsyncHTTPServer
+        return AsyncHTTPServer(server_address)
+    threads = get_worker_config()[1]
+    if threads > 0:
+        return PooledHTTPServer(server_address, request_handler_class, threads)
+    return HTTPServer(server_address, request_handler_class)
+
+
+def serve(httpd, start_background=None):
+    """
+    Serve requests with httpd until a shutdown is requested, using the
+    configured number of worker processes. Returns after all running requests
+    have been drained.
+
+    :param httpd: server as created by create_server
+    :param start_background: function starting the background threads of the
+                             server; called once, after forking the worker
+                             processes (threads do not survive a fork, and
+                             a thread holding a lock while forking leaves it
+                             locked in the children)
+    """
+    processes = get_worker_config()[0]
+    if processes > 1 and hasattr(os, 'fork'):
+        serve_forked(httpd, processes, start_background)
+    else:
+        if start_background is not None:
+            start_background()
+        serve_single(httpd)
+
+
+def serve_single(httpd):
+    """
+    Serve requests in the current process until shutdown() is called.
+
+    :param httpd: server to run
+    """
+    _SERVERS.append(httpd)
+    if isinstance(httpd, PooledHTTPServer):
+        httpd.start_workers()
+    try:
+        # a worker process can be told to stop before it got here
+        if not shutdown_requested():
+            httpd.serve_forever()
+    finally:
+        _SERVERS.remove(httpd)
+        if isinstance(httpd, PooledHTTPServer):
+            getLogger(__name__).info("draining running requests", extra=get_logging_empty_extra())
+            httpd.drain(int(config.get('httpd', 'drain_timeout', default=DEFAULT_DRAIN_TIMEOUT)))
+        httpd.server_close()
+        log_session_stats()
+
+
+def serve_forked(httpd, processes, start_background=None):
+    """
+    Fork worker processes which all accept connections on the (already bound)
+    listening socket of httpd and wait for them to finish. The background
+    threads run in this (the parent) process.
+
+    :param httpd: bound server to share between the worker processes
+    :param processes: number of worker processes to start
+    :param start_background: function starting the background threads
+    """
+    # every worker has its own caches; changes made by one are announced to
+    # the others through the database
+    share_caches()
+    for _ in range(processes):
+        pid = os.fork()
+        if pid == 0:
+            del _CHILDREN[:]
+            signal(SIGTERM, terminate_handler)
+            status = 0
+            try:
+                serve_single(httpd)
+            except Exception:  # pylint: disable=W0703
+                getLogger(__name__).exception("worker process failed", extra=get_logging_empty_extra())
+                status = 1
+            finally:
+                os._exit(status)  # pylint: disable=W0212
+        _CHILDREN.append(pid)
+    getLogger(__name__).info("started %d worker processes" % processes, extra=get_logging_empty_extra())
+    httpd.server_close()
+    if start_background is not None:
+        start_background()
+    while _CHILDREN:
+        try:
+            pid = os.wait()[0]
+        except OSError as error:
+            if error.errno == EINTR:
+                continue
+            break
+        if pid in _CHILDREN:
+            _CHILDREN.remove(pid)
+
+
+def shutdown():
+    """
+    Request a graceful shutdown: the servers in this process stop accepting
+    connections and worker processes are told to do the same. Running
+    requests are finished by serve().
+
+    The worker processes get SIGTERM rather than SIGINT: a Ctrl-C in a
+    terminal sends SIGINT to the worker processes as well, and a second
+    SIGINT makes a process exit without finishing its requests.
+
+    :returns: False when there is nothing to shut down gracefully or when a
+              shutdown was already requested, True otherwise.
+    """
+    if _SHUTDOWN['requested']:
+        return False
+    _SHUTDOWN['requested'] = True
+    if not (_SERVERS or _CHILDREN):
+        return False
+    for pid in _CHILDREN:
+        try:
+            os.kill(pid, SIGTERM)
+        except OSError:
+            pass
+    for httpd in _SERVERS:
+        # shutdown() blocks until serve_forever returns, which runs in the
+        # thread that received the signal
+        stopper = Thread(target=httpd.shutdown)
+        stopper.daemon = True
+        stopper.start()
+    return True
@@ -199,11 +199,13 @@ class Share(object):
         """
         params = (self.users, self.item.path)
         if self.identifier is None:
-            sql = 'insert into shares (user, path) values (?, ?)'
+            # a user has one share of a path, which sharing it again reuses
+            sql = 'select id from shares where user = ? and path = ?'
+            if not database_execute(sql, params):
+                database_execute('insert into shares (user, path) values (?, ?)', params)
         else:
             sql = 'update shares set user = ?, path = ? where id = ?'
-            params = params + (self.identifier,)
-        database_execute(sql, params)
+            database_execute(sql, params + (self.identifier,))
 
         if self.identifier is None:
             sql = 'select id from shares where user = ? and path = ?'
@@ -257,7 +259,7 @@ def toggle_invite_state(request_handler, newstate):
                            extract the invite from.
     :param newstate: the new state for the invite
     """
-    invite_identifier = int(request_handler.path.split('/')[3])
+    invite_identifier = int(request_handler.route_params['invite_id'])
     user = request_handler.user
     readsql = "select 1 from invitations where state!=? and receiver = ? and " \
               "id = ?"
@@ -0,0 +1,82 @@
+"""
+TLS setup shared by the HTTP front ends. Both use one SSLContext per process,
+so TLS sessions (session IDs and tickets) of reconnecting clients can be
+resumed without a full handshake, and its certificate can be reloaded while
+the server runs.
+"""
+import ssl
+from logging import getLogger
+
+from localbox import config
+from localbox.utils import get_logging_empty_extra
+
+#: cipher suites for TLS 1.2: forward secret (ECDHE) AEAD ciphers first
+DEFAULT_CIPHERS = 'ECDHE+AESGCM:ECDHE+CHACHA20:ECDHE+AES:DHE+AESGCM:!aNULL:!eNULL:!MD5:!DSS:!RC4:!3DES'
+#: number of TLS 1.3 session tickets sent after a full handshake
+DEFAULT_SESSION_TICKETS = 2
+
+# (context, certfile, keyfile) of the contexts created in this process
+_CONTEXTS = []
+
+
+def create_ssl_context(certfile, keyfile):
+    """
+    Create the server side SSLContext: TLS 1.2 or newer, the server's
+    (ECDHE first) cipher order, session tickets for resumption and ALPN for
+    HTTP/1.1. The ciphers and the number of TLS 1.3 tickets are configured
+    with 'ssl_ciphers' and 'ssl_session_tickets' in the httpd section.
+
+    :param certfile: file with the certificate (chain) of the server
+    :param keyfile: file with the private key of the server
+    :returns: the SSLContext
+    """
+    context = ssl.SSLContext(getattr(ssl, 'PROTOCOL_TLS_SERVER', ssl.PROTOCOL_SSLv23))
+    context.options |= ssl.OP_NO_SSLv2 | ssl.OP_NO_SSLv3 | ssl.OP_NO_TLSv1 | ssl.OP_NO_TLSv1_1
+    context.options |= ssl.OP_NO_COMPRESSION | ssl.OP_CIPHER_SERVER_PREFERENCE | ssl.OP_SINGLE_ECDH_USE
+    context.set_ciphers(config.get('httpd', 'ssl_ciphers', default=DEFAULT_CIPHERS))
+    if getattr(ssl, 'HAS_ALPN', False):
+        context.set_alpn_protocols(['http/1.1'])
+    if hasattr(context, 'num_tickets'):
+        context.num_tickets = int(config.get('httpd', 'ssl_session_tickets', default=DEFAULT_SESSION_TICKETS))
+    context.load_cert_chain(certfile, keyfile)
+    _CONTEXTS.append((context, certfile, keyfile))
+    return context
+
+
+def reload_certificates():
+    """
+    Load the certificates of the contexts of this process again, e.g. after
+    they have been renewed. New connections use the new certificate; the
+    session cache is kept. When loading fails, the old certificate stays in
+    use.
+    """
+    for context, certfile, keyfile in _CONTEXTS:
+        try:
+            context.load_cert_chain(certfile, keyfile)
+            getLogger(__name__).info("reloaded certificate %s" % certfile, extra=get_logging_empty_extra())
+        except (IOError, OSError, ssl.SSLError) as error:
+            getLogger(__name__).error("cannot reload certificate %s: %s" % (certfile, error),
+                                      extra=get_logging_empty_extra())
+
+
+def get_session_stats(context):
+    """
+    :param context: a server SSLContext
+    :returns: tuple of the number of completed handshakes, the number of them
+              that resumed a session, and the fraction resumed
+    """
+    stats = context.session_stats()
+    handshakes = stats.get('accept_good', 0)
+    resumed = stats.get('hits', 0)
+    return handshakes, resumed, float(resumed) / handshakes if handshakes else 0.0
+
+
+def log_session_stats():
+    """
+    Log the handshake counts and resumption ratio of the contexts of this
+    process.
+    """
+    for context, _, _ in _CONTEXTS:
+        handshakes, resumed, ratio = get_session_stats(context)
+        getLogger(__name__).info("TLS handshakes: %d, resumed: %d (%.1f%%)" % (handshakes, resumed, ratio * 100),
+                                 extra=get_logging_empty_extra())
@@ -0,0 +1,810 @@
+"""
+Streaming transfer of file contents between the filesystem and HTTP
+connections, so the memory used by a transfer does not depend on the size of
+the file, support for resuming interrupted transfers (byte ranges and
+upload sessions) and for conditional requests.
+"""
+from base64 import b64decode
+from email.utils import formatdate
+from email.utils import mktime_tz
+from email.utils import parsedate_tz
+from hashlib import sha1
+from hashlib import sha256
+from json import dumps
+from json import loads
+from os import close
+from os import fstat
+from os import listdir
+from os import remove
+from os import rename
+from os import stat
+from os.path import dirname
+from os.path import exists
+from os.path import getmtime
+from os.path import getsize
+from os.path import join
+from re import compile as regex_compile
+from tempfile import mkstemp
+from time import time
+from uuid import uuid4
+
+from localbox import config
+from localbox.files import get_modified_at
+from localbox.files import get_server_directory
+
+#: number of bytes read or written at once when copying through userspace
+CHUNK_SIZE = 65536
+#: prefix of the temporary files uploads are spooled to
+UPLOAD_PREFIX = '.lbupload-'
+#: directory (below the server directory) holding resumable uploads
+UPLOADS_DIRECTORY = 'uploads'
+#: seconds after which an inactive resumable upload is removed
+DEFAULT_UPLOAD_SESSION_TIMEOUT = 7 * 24 * 60 * 60
+#: a single range in a Range header
+BYTE_RANGE = regex_compile(r'^bytes=([0-9]*)-([0-9]*)$')
+#: characters ending a JSON number, boolean or null
+JSON_SCALAR_END = regex_compile(br'[\s,}\]]')
+
+
+class FileBody(object):
+    """
+    Response body sending (a part of) an open file. Handlers set a FileBody
+    as request_handler.body; the front end streams it to the client and
+    closes the file afterwards.
+    """
+
+    def __init__(self, fileobj, offset=0, length=None):
+        """
+        :param fileobj: file opened in binary mode
+        :param offset: position of the first byte to send
+        :param length: number of bytes to send, None for up to the end of the
+                       file
+        """
+        self.fileobj = fileobj
+        self.offset = offset
+        if length is None:
+            length = fstat(fileobj.fileno()).st_size - offset
+        self.length = length
+
+    def chunks(self):
+        """
+        Generator of the body contents in blocks of at most CHUNK_SIZE bytes.
+        """
+        self.fileobj.seek(self.offset)
+        remaining = self.length
+        while remaining > 0:
+            data = self.fileobj.read(min(CHUNK_SIZE, remaining))
+            if not data:
+                break
+            remaining -= len(data)
+            yield data
+
+    def write_to(self, wfile, connection=None):
+        """
+        Send the body and close the file. When connection supports it
+        (python 3), socket.sendfile is used, which copies directly from the
+        file to a plain socket in the kernel (sendfile(2)) and falls back to
+        copying through userspace for TLS connections.
+
+        :param wfile: file object to write the body to
+        :param connection: the socket underneath wfile, if known
+        """
+        try:
+            if hasattr(connection, 'sendfile'):
+                wfile.flush()
+                # a count of 0 would mean 'up to the end of the file'
+                if self.length > 0:
+                    connection.sendfile(self.fileobj, self.offset, self.length)
+            else:
+                for data in self.chunks():
+                    wfile.write(data)
+        finally:
+            self.close()
+
+    def close(self):
+        """
+        Close the file.
+        """
+        self.fileobj.close()
+
+
+def encode_body(body):
+    """
+    Turn a handler response body into bytes.
+
+    :param body: body as set by a handler (None, bytes, str or an object)
+    :returns: bytes to send
+    """
+    if body is None:
+        return b''
+    if isinstance(body, bytes):
+        return body
+    return str(body).encode('UTF-8')
+
+
+def is_body_stream(body):
+    """
+    :param body: body as set by a handler
+    :returns: whether the body is an iterator (e.g. a generator) of pieces
+              of the response, which is sent as they are produced
+    """
+    return not isinstance(body, FileBody) and (hasattr(body, '__next__') or hasattr(body, 'next'))
+
+
+def encode_chunk(data):
+    """
+    :param data: bytes to send as one chunk; empty for the last chunk
+    :returns: the chunk in the chunked transfer coding
+    """
+    return ('%x\r\n' % len(data)).encode('ascii') + data + b'\r\n'
+
+
+class BodyReader(object):
+    """
+    File-like object giving access to exactly the body of a request on a
+    persistent connection, so a handler cannot read into the next request,
+    and the part of the body a handler did not read can be skipped.
+    """
+
+    def __init__(self, fileobj, length):
+        self.fileobj = fileobj
+        self.remaining = length
+
+    def read(self, size=-1):
+        """
+        :param size: maximum number of bytes to read; all when negative
+        :returns: the next part of the body, empty at its end
+        """
+        if size is None or size < 0 or size > self.remaining:
+            size = self.remaining
+        if size == 0:
+            return b''
+        data = self.fileobj.read(size)
+        self.remaining -= len(data)
+        if not data:
+            self.remaining = 0
+        return data
+
+    def skip(self, limit):
+        """
+        Read and discard the rest of the body, if it is not larger than limit.
+
+        :param limit: maximum number of bytes to discard
+        :returns: whether the body has been read completely
+        """
+        if self.remaining > limit:
+            return False
+        while self.remaining > 0:
+            if not self.read(CHUNK_SIZE):
+                return False
+        return True
+
+
+def encode_ndjson(objects, size=CHUNK_SIZE):
+    """
+    Encode objects as newline delimited JSON while they are generated, in
+    pieces of about size bytes, so a streamed body is not sent as many tiny
+    chunks.
+
+    :param objects: iterable of objects to encode
+    :param size: minimum number of characters of a piece (except the last)
+    :returns: generator of the pieces of the encoded text
+    """
+    lines = []
+    length = 0
+    for item in objects:
+        line = dumps(item) + '\n'
+        lines.append(line)
+        length += len(line)
+        if length >= size:
+            yield ''.join(lines)
+            lines = []
+            length = 0
+    if lines:
+        yield ''.join(lines)
+
+
+def file_etag(statstruct, modified_at=None):
+    """
+    Strong entity tag for a file, derived from its inode, size and
+    modification time.
+
+    :param statstruct: result of stat of the file
+    :param modified_at: modification time of the file, when it differs from
+                        that of its inode (see get_modified_at in files)
+    :returns: the quoted entity tag
+    """
+    if modified_at is None:
+        modified_at = statstruct.st_mtime
+    return '"%x-%x-%x"' % (statstruct.st_ino, statstruct.st_size, int(modified_at * 1000000))
+
+
+def body_etag(body):
+    """
+    Strong entity tag for a response body, e.g. a directory listing, derived
+    from its contents.
+
+    :param body: the body, as set by a handler
+    :returns: the quoted entity tag
+    """
+    return '"%s"' % sha1(encode_body(body)).hexdigest()
+
+
+def etag_matches(header, etag):
+    """
+    :param header: value of an If-None-Match header
+    :param etag: the current entity tag
+    :returns: whether the header lists the entity tag (compared weakly, as
+              If-None-Match requires) or is '*'
+    """
+    tags = [tag.strip() for tag in header.split(',')]
+    return '*' in tags or etag in [tag[2:] if tag.startswith('W/') else tag for tag in tags]
+
+
+def check_not_modified(request_handler, etag, modified_at=None):
+    """
+    Set the validators of a response to a request which only reads, and
+    evaluate the If-None-Match and If-Modified-Since headers of the request
+    against them. If-Modified-Since is ignored when If-None-Match is given,
+    or when there is no modification time to compare with. When the client's
+    copy is still current, the response becomes a 304 without body.
+
+    :param request_handler: object to set the response on
+    :param etag: the entity tag of the response
+    :param modified_at: modification time of the resource, if it has one
+                        which changes with every change of the response
+    :returns: whether the response is a 304
+    """
+    request_handler.new_headers['ETag'] = etag
+    if modified_at is not None:
+        request_handler.new_headers['Last-Modified'] = http_date(modified_at)
+    if_none_match = request_handler.headers.get('If-None-Match')
+    if if_none_match is not None:
+        not_modified = etag_matches(if_none_match, etag)
+    else:
+        if_modified_since = request_handler.headers.get('If-Modified-Since')
+        date = None if if_modified_since is None or modified_at is None else parse_http_date(if_modified_since)
+        not_modified = date is not None and int(modified_at) <= date
+    if not_modified:
+        request_handler.status = 304
+        request_handler.body = None
+    return not_modified
+
+
+def http_date(timestamp):
+    """
+    :param timestamp: seconds since the epoch
+    :returns: the timestamp formatted as an HTTP date
+    """
+    return formatdate(timestamp, usegmt=True)
+
+
+def parse_http_date(value):
+    """
+    :param value: an HTTP date
+    :returns: seconds since the epoch, or None if value is not a valid date
+    """
+    parsed = parsedate_tz(value)
+    if parsed is None:
+        return None
+    return mktime_tz(parsed)
+
+
+def parse_range(header, size):
+    """
+    Parse a Range header with a single byte range. Multiple ranges are not
+    supported; such requests are answered with the complete file.
+
+    :param header: value of the Range header
+    :param size: size of the file
+    :returns: tuple (first byte, number of bytes), None when the header does
+              not hold a usable single byte range, or False when the range
+              cannot be satisfied
+    """
+    match = BYTE_RANGE.match(header.strip())
+    if match is None:
+        return None
+    first, last = match.groups()
+    if first == '':
+        if last == '':
+            return None
+        length = min(int(last), size)
+        if length == 0:
+            return False
+        return size - length, length
+    first = int(first)
+    last = size - 1 if last == '' else min(int(last), size - 1)
+    if first >= size or last < first:
+        return False
+    return first, last - first + 1
+
+
+def if_range_matches(header, statstruct, modified_at):
+    """
+    :param header: value of the If-Range header
+    :param statstruct: result of stat of the file
+    :param modified_at: modification time of the file
+    :returns: whether the validator in the header still matches the file
+    """
+    header = header.strip()
+    if header.startswith('"'):
+        return header == file_etag(statstruct, modified_at)
+    date = parse_http_date(header)
+    return date is not None and int(modified_at) <= date
+
+
+def send_file(request_handler, filepath):
+    """
+    Respond to a request with the contents of a file, without reading the
+    file into memory. A Range header with a single byte range (guarded by an
+    optional If-Range header) results in a 206 response with that part of the
+    file, so interrupted downloads can be resumed. When the client's copy is
+    still current (see check_not_modified), the response is a 304.
+
+    :param request_handler: object to set the response on
+    :param filepath: filesystem path of the file to send
+    """
+    fileobj = open(filepath, 'rb')
+    statstruct = fstat(fileobj.fileno())
+    modified_at = get_modified_at(filepath, statstruct)
+    request_handler.new_headers['Accept-Ranges'] = 'bytes'
+    if check_not_modified(request_handler, file_etag(statstruct, modified_at), modified_at):
+        fileobj.close()
+        return
+
+    byte_range = None
+    range_header = request_handler.headers.get('Range')
+    if range_header is not None:
+        if_range = request_handler.headers.get('If-Range')
+        if if_range is None or if_range_matches(if_range, statstruct, modified_at):
+            byte_range = parse_range(range_header, statstruct.st_size)
+    if byte_range is False:
+        fileobj.close()
+        request_handler.status = 416
+        request_handler.new_headers['Content-Range'] = 'bytes */%d' % statstruct.st_size
+        request_handler.body = None
+    elif byte_range is not None:
+        first, length = byte_range
+        request_handler.status = 206
+        request_handler.new_headers['Content-Range'] = 'bytes %d-%d/%d' % (first, first + length - 1,
+                                                                          statstruct.st_size)
+        request_handler.body = FileBody(fileobj, first, length)
+    else:
+        request_handler.status = 200
+        request_handler.body = FileBody(fileobj, 0, statstruct.st_size)
+
+
+class Base64Decoder(object):
+    """
+    Incremental base64 decoder writing the decoded data to a file object.
+    """
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.pending = b''
+
+    def write(self, data):
+        """
+        Decode and write data; an incomplete trailing group of characters is
+        kept until the next call.
+
+        :param data: base64 encoded data
+        """
+        data = self.pending + b''.join(data.split())
+        usable = len(data) - len(data) % 4
+        self.fileobj.write(b64decode(data[:usable]))
+        self.pending = data[usable:]
+
+    def close(self):
+        """
+        Check that all data has been decoded.
+        """
+        if self.pending:
+            raise ValueError("Incomplete base64 data")
+
+
+class HashingWriter(object):
+    """
+    File object wrapper updating a hash with the data written through it.
+    """
+
+    def __init__(self, fileobj, digest):
+        """
+        :param fileobj: file object to write to
+        :param digest: hash object to update
+        """
+        self.fileobj = fileobj
+        self.digest = digest
+
+    def write(self, data):
+        """
+        :param data: bytes to write
+        """
+        self.digest.update(data)
+        self.fileobj.write(data)
+
+
+class JSONUploadParser(object):
+    """
+    Parser for the JSON form of an upload: an object like
+    {"path": "/file", "contents": "<base64 data>"}. The object is read from a
+    file in blocks, and the contents member is decoded while it is read, so
+    memory use does not depend on the size of the contents. Only members with
+    string, number, boolean or null values are supported.
+    """
+
+    def __init__(self, fileobj, contents_fileobj):
+        """
+        :param fileobj: file object holding the JSON text
+        :param contents_fileobj: file object to write the decoded contents to
+        """
+        self.fileobj = fileobj
+        self.contents_fileobj = contents_fileobj
+        self.buffer = b''
+        self.position = 0
+
+    def fill(self):
+        """
+        Read more data into the buffer.
+
+        :returns: False at the end of the file
+        """
+        data = self.fileobj.read(CHUNK_SIZE)
+        if not data:
+            return False
+        self.buffer = self.buffer[self.position:] + data
+        self.position = 0
+        return True
+
+    def next_char(self):
+        """
+        Skip whitespace and return the next character without consuming it.
+        """
+        while True:
+            while self.position < len(self.buffer) and self.buffer[self.position:self.position + 1].isspace():
+                self.position += 1
+            if self.position < len(self.buffer):
+                return self.buffer[self.position:self.position + 1]
+            if not self.fill():
+                raise ValueError("Unexpected end of JSON data")
+
+    def expect(self, char):
+        """
+        Consume char (after whitespace) or raise a ValueError.
+        """
+        if self.next_char() != char:
+            raise ValueError("Expected %r in JSON data" % char)
+        self.position += 1
+
+    def read_string(self, write):
+        """
+        Read a JSON string (the opening quote has been consumed) and pass its
+        still escaped contents to write in pieces which never split an escape
+        sequence.
+        """
+        while True:
+            end = self.position
+            while True:
+                quote = self.buffer.find(b'"', end)
+                backslash = self.buffer.find(b'\\', end, quote if quote >= 0 else len(self.buffer))
+                if backslash < 0:
+                    break
+                escape_length = 6 if self.buffer[backslash + 1:backslash + 2] == b'u' else 2
+                if backslash + escape_length > len(self.buffer):
+                    quote = -1
+                    end = backslash
+                    break
+                end = backslash + escape_length
+            if quote >= 0:
+                write(self.buffer[self.position:quote])
+                self.position = quote + 1
+                return
+            if backslash < 0:
+                end = len(self.buffer)
+            write(self.buffer[self.position:end])
+            self.position = end
+            if not self.fill():
+                raise ValueError("Unterminated string in JSON data")
+
+    def read_scalar(self):
+        """
+        Read a number, boolean or null.
+        """
+        token = b''
+        while True:
+            match = JSON_SCALAR_END.search(self.buffer, self.position)
+            if match:
+                token += self.buffer[self.position:match.start()]
+                self.position = match.start()
+                return loads(token.decode('ascii'))
+            token += self.buffer[self.position:]
+            self.position = len(self.buffer)
+            if not self.fill():
+                return loads(token.decode('ascii'))
+
+    def parse(self):
+        """
+        Parse the object.
+
+        :returns: dictionary of the members except contents, and whether the
+                  contents member was present
+        """
+        members = {}
+        has_contents = False
+        self.expect(b'{')
+        if self.next_char() == b'}':
+            self.position += 1
+            return members, has_contents
+        while True:
+            self.expect(b'"')
+            key = []
+            self.read_string(key.append)
+            key = unescape_json_string(b''.join(key))
+            self.expect(b':')
+            if self.next_char() == b'"':
+                self.position += 1
+                if key == 'contents':
+                    decoder = Base64Decoder(self.contents_fileobj)
+                    self.read_string(lambda data: decoder.write(unescape_json_string(data).encode('ascii')))
+                    decoder.close()
+                    has_contents = True
+                else:
+                    value = []
+                    self.read_string(value.append)
+                    members[key] = unescape_json_string(b''.join(value))
+            elif self.next_char() in (b'{', b'['):
+                raise ValueError("Nested JSON values are not supported in uploads")
+            else:
+                members[key] = self.read_scalar()
+            if self.next_char() == b'}':
+                self.position += 1
+                break
+            self.expect(b',')
+        while self.position < len(self.buffer) or self.fill():
+            if not self.buffer[self.position:].isspace():
+                raise ValueError("Extra data after JSON object")
+            self.position = len(self.buffer)
+        return members, has_contents
+
+
+def unescape_json_string(data):
+    """
+    :param data: contents of a JSON string, without the quotes
+    :returns: the (unicode) string it represents
+    """
+    if b'\\' not in data:
+        return data.decode('UTF-8')
+    return loads((b'"' + data + b'"').decode('UTF-8'))
+
+
+def create_temporary_file(directory):
+    """
+    Create an (empty) temporary file for an upload in directory, so it can be
+    renamed over its destination atomically.
+
+    :param directory: directory to create the file in
+    :returns: the path of the new file
+    """
+    descriptor, path = mkstemp(prefix=UPLOAD_PREFIX, dir=directory)
+    close(descriptor)
+    return path
+
+
+def replace_file(source, destination):
+    """
+    Atomically replace destination by source (POSIX rename semantics; on
+    platforms where rename does not overwrite, destination is removed first).
+
+    :param source: path of the new file
+    :param destination: path to move it to
+    """
+    try:
+        rename(source, destination)
+    except OSError:
+        if not exists(destination):
+            raise
+        remove(destination)
+        rename(source, destination)
+
+
+def spool_request_body(request_handler, fileobj, digest=None):
+    """
+    Copy the request body (Content-Length bytes of request_handler.rfile) to
+    fileobj in blocks.
+
+    :param request_handler: the request to read the body of
+    :param fileobj: file object to write the body to
+    :param digest: hash object to update with the body, if any
+    """
+    length = int(request_handler.headers.get('content-length') or 0)
+    while length > 0:
+        data = request_handler.rfile.read(min(CHUNK_SIZE, length))
+        if not data:
+            raise IOError("Connection closed while reading the request body")
+        if digest is not None:
+            digest.update(data)
+        fileobj.write(data)
+        length -= len(data)
+
+
+def starts_with_json_object(path):
+    """
+    :param path: file to check
+    :returns: whether the first non whitespace character in the file is '{'
+    """
+    with open(path, 'rb') as fileobj:
+        data = fileobj.read(CHUNK_SIZE).lstrip()
+        while data == b'':
+            data = fileobj.read(CHUNK_SIZE)
+            if not data:
+                return False
+            data = data.lstrip()
+        return data[:1] == b'{'
+
+
+def receive_upload(request_handler, filepath, resolve_path, hash_contents=False):
+    """
+    Store the body of an upload. The body is either the raw file contents or
+    a JSON object with a 'path' member and base64 encoded 'contents'. The
+    body is spooled to a temporary file next to the destination and decoded
+    block by block, and the result is renamed over the destination when it
+    is complete, so peak memory use does not depend on the size of the file
+    and readers never see a partially written file.
+
+    :param request_handler: the upload request
+    :param filepath: destination when the body holds the raw contents
+    :param resolve_path: function returning the filesystem path for the
+                         'path' member of a JSON body
+    :param hash_contents: whether to compute the SHA-256 digest of the
+                          stored contents while they are written
+    :returns: tuple of the filesystem path the upload refers to, whether
+              contents were stored there (a JSON body may omit contents),
+              the hexadecimal digest of the contents (None when not stored
+              or not hashed) and the stat of the stored file (None when not
+              stored), which tells whether the file has been replaced since
+    """
+    spooled = create_temporary_file(dirname(filepath))
+    decoded = None
+    raw_digest = sha256() if hash_contents else None
+    try:
+        with open(spooled, 'wb') as fileobj:
+            spool_request_body(request_handler, fileobj, raw_digest)
+        if starts_with_json_object(spooled):
+            decoded = create_temporary_file(dirname(filepath))
+            decoded_digest = sha256() if hash_contents else None
+            try:
+                with open(spooled, 'rb') as fileobj, open(decoded, 'wb') as contents_fileobj:
+                    if decoded_digest is not None:
+                        contents_fileobj = HashingWriter(contents_fileobj, decoded_digest)
+                    members, has_contents = JSONUploadParser(fileobj, contents_fileobj).parse()
+                path = members['path']
+            except (ValueError, KeyError, TypeError):
+                # not the JSON form after all; keep the body as raw contents
+                path = None
+            if path is not None:
+                destination = resolve_path(path)
+                if not has_contents:
+                    return destination, False, None, None
+                statstruct = stat(decoded)
+                replace_file(decoded, destination)
+                decoded = None
+                return destination, True, decoded_digest.hexdigest() if hash_contents else None, statstruct
+        statstruct = stat(spooled)
+        replace_file(spooled, filepath)
+        spooled = None
+        return filepath, True, raw_digest.hexdigest() if hash_contents else None, statstruct
+    finally:
+        for path in (spooled, decoded):
+            if path is not None and exists(path):
+                remove(path)
+
+
+class UploadSession(object):
+    """
+    A resumable upload. The contents are appended piece by piece to a file in
+    the server directory, so an interrupted upload can continue at the offset
+    the server has received, and are moved to their destination on commit.
+    """
+
+    def __init__(self, user, identifier):
+        """
+        :param user: name of the user uploading
+        :param identifier: hexadecimal identifier of the session
+        """
+        self.user = user
+        self.identifier = identifier
+        self.data_path = join(get_server_directory(UPLOADS_DIRECTORY, user), identifier)
+        self.info_path = self.data_path + '.json'
+
+    @classmethod
+    def create(cls, user, path):
+        """
+        Start a new upload session, removing expired sessions of the user.
+
+        :param user: name of the user uploading
+        :param path: localbox path the upload is meant for
+        :returns: the new UploadSession
+        """
+        expire_upload_sessions(user)
+        session = cls(user, uuid4().hex)
+        with open(session.info_path, 'w') as fileobj:
+            fileobj.write(dumps({'path': path}))
+        open(session.data_path, 'wb').close()
+        return session
+
+    def exists(self):
+        """
+        :returns: whether this session has been started and not finished
+        """
+        return exists(self.info_path) and exists(self.data_path)
+
+    def get_path(self):
+        """
+        :returns: the localbox path the upload is meant for
+        """
+        with open(self.info_path) as fileobj:
+            return loads(fileobj.read())['path']
+
+    def get_offset(self):
+        """
+        :returns: the number of bytes received so far
+        """
+        return getsize(self.data_path)
+
+    def append(self, request_handler, offset):
+        """
+        Append the request body to the upload.
+
+        :param request_handler: request with the next piece as its body
+        :param offset: position of the piece in the file; must be equal to
+                       the number of bytes received so far
+        :returns: False when offset does not match, True otherwise
+        """
+        if offset != self.get_offset():
+            return False
+        with open(self.data_path, 'ab') as fileobj:
+            spool_request_body(request_handler, fileobj)
+        return True
+
+    def commit(self, filepath):
+        """
+        Finish the upload by moving the contents to filepath.
+
+        :param filepath: filesystem path of the destination
+        :returns: the stat of the stored file
+        """
+        statstruct = stat(self.data_path)
+        replace_file(self.data_path, filepath)
+        remove(self.info_path)
+        return statstruct
+
+    def cancel(self):
+        """
+        Abandon the upload and remove what has been received.
+        """
+        for path in (self.data_path, self.info_path):
+            if exists(path):
+                remove(path)
+
+    def to_json(self):
+        """
+        :returns: JSON representation of the session
+        """
+        return {'id': self.identifier, 'path': self.get_path(), 'offset': self.get_offset()}
+
+
+def expire_upload_sessions(user):
+    """
+    Remove the upload sessions of a user which have not received data for
+    longer than the upload_session_timeout setting (in seconds) of the
+    filesystem section.
+
+    :param user: name of the user to expire sessions for
+    """
+    timeout = int(config.get('filesystem', 'upload_session_timeout', default=DEFAULT_UPLOAD_SESSION_TIMEOUT))
+    directory = get_server_directory(UPLOADS_DIRECTORY, user)
+    limit = time() - timeout
+    for name in listdir(directory):
+        path = join(directory, name)
+        if getmtime(path) < limit:
+            remove(path)
@@ -0,0 +1,160 @@
+"""
+Background removal of deleted folders. A deleted folder is renamed into the
+trash directory of its user in the server directory, which is instant, and
+removed from there by a reaper thread at a limited rate, so deleting a large
+tree neither blocks the request nor floods the disk with work.
+"""
+from errno import ENOENT
+from logging import getLogger
+from os import listdir
+from os import remove
+from os import rename
+from os import rmdir
+from os import walk
+from os.path import isdir
+from os.path import islink
+from os.path import join
+from threading import Lock
+from threading import Thread
+from time import sleep
+from time import time
+from uuid import uuid4
+
+try:
+    from Queue import Queue  # pylint: disable=F0401
+except ImportError:
+    from queue import Queue  # pylint: disable=F0401
+
+from localbox import config
+from localbox import defaults
+from localbox.files import get_server_directory
+from localbox.utils import get_logging_empty_extra
+
+#: directory (below the server directory) holding the trash of every user
+TRASH_DIRECTORY = 'trash'
+#: number of entries removed between checks of the delete_rate
+REAP_BATCH_SIZE = 100
+
+
+def move_to_trash(user, filesystem_path):
+    """
+    Move a file or directory into the trash of a user and have it removed in
+    the background.
+
+    :param user: the user deleting the path
+    :param filesystem_path: the path to delete
+    :raises OSError: when the path cannot be renamed into the trash, e.g.
+                     because it is on another filesystem
+    """
+    trashed = join(get_server_directory(TRASH_DIRECTORY, user), uuid4().hex)
+    rename(filesystem_path, trashed)
+    TrashReaper().add(trashed)
+
+
+def reap_trash():
+    """
+    Have the trash left by an earlier run of the server removed in the
+    background.
+    """
+    directory = get_server_directory(TRASH_DIRECTORY)
+    reaper = TrashReaper()
+    for user in listdir(directory):
+        for name in listdir(join(directory, user)):
+            reaper.add(join(directory, user, name))
+
+
+def iterate_removal(path):
+    """
+    Generate the entries of a tree in an order in which they can be removed:
+    the contents of a directory before the directory itself.
+
+    :param path: path of a file or directory
+    :returns: generator of tuples of the path of an entry and whether it is
+              removed with remove (files and symlinks) rather than rmdir
+    """
+    if not isdir(path) or islink(path):
+        yield path, True
+        return
+    for directory, directories, files in walk(path, topdown=False):
+        for name in files:
+            yield join(directory, name), True
+        # symlinks to directories are listed as directories
+        for name in directories:
+            yield join(directory, name), islink(join(directory, name))
+    yield path, False
+
+
+class TrashReaper(object):
+    """
+    Singleton removing trashed files and directories, one by one, in a
+    background thread. The thread is started when there is something to
+    remove; at most 'delete_rate' entries (files, symlinks and directories)
+    per second are removed, as set in the filesystem section.
+    """
+    _instance = None
+
+    def __new__(cls, *args, **kwargs):
+        if not cls._instance:
+            cls._instance = super(TrashReaper, cls).__new__(cls)
+        return cls._instance
+
+    def __init__(self):
+        if not hasattr(self, 'queue'):
+            self.queue = Queue()
+            self.lock = Lock()
+            self.thread = None
+
+    def add(self, path):
+        """
+        Schedule a trashed path for removal.
+
+        :param path: path of the file or directory in the trash
+        """
+        self.queue.put(path)
+        with self.lock:
+            # the thread of a parent process does not survive a fork
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = Thread(target=self.run, name='trash-reaper')
+                self.thread.daemon = True
+                self.thread.start()
+
+    def run(self):
+        """
+        Remove the scheduled paths, forever.
+        """
+        while True:
+            path = self.queue.get()
+            try:
+                self.reap(path)
+            except Exception as error:  # pylint: disable=W0703
+                getLogger('files').exception("cannot remove %s from the trash: %s" % (path, error),
+                                             extra=get_logging_empty_extra())
+
+    def reap(self, path):
+        """
+        Remove a file or directory tree, bottom up, at no more than the
+        configured rate. Entries which are already gone (e.g. removed by
+        another process) are skipped.
+
+        :param path: path of the file or directory to remove
+        """
+        rate = int(config.get('filesystem', 'delete_rate', default=defaults.DELETE_RATE))
+        started = time()
+        removed = 0
+        for entry, is_file in iterate_removal(path):
+            try:
+                if is_file:
+                    remove(entry)
+                else:
+                    rmdir(entry)
+            except OSError as error:
+                if error.errno != ENOENT:
+                    getLogger('files').warning("cannot remove %s: %s" % (entry, error),
+                                               extra=get_logging_empty_extra())
+            removed += 1
+            if rate > 0 and removed % REAP_BATCH_SIZE == 0:
+                delay = float(removed) / rate - (time() - started)
+                if delay > 0:
+                    sleep(delay)
+        getLogger('files').info("removed %d entries of %s from the trash in %.1f seconds" %
+                                (removed, path, time() - started), extra=get_logging_empty_extra())